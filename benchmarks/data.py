@@ -0,0 +1,124 @@
+import datetime
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+photo_host = "https://dl.airtable.invalid/"
+
+pet_statuses = [
+    ("Published - Available for Adoption", 40),
+    ("Adoption Pending", 10),
+    ("Adopted", 25),
+    ("Removed from Program", 10),
+    ("Accepted, Not Yet Published", 10),
+    ("", 5),
+]
+first_names = ["Sam", "Alex", "Jordan", "Casey", "Riley", "Morgan", "Taylor", "Jamie"]
+last_names = ["Garcia", "Nguyen", "Smith", "Patel", "Johnson", "Lee", "Brown", "Davis"]
+
+
+def make_photo(rng, size):
+    # a few random blocks of colour are enough to give every photo its own
+    # perceptual hash, and cost about as much to decode as a real one
+    width, height = size
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(6):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle(
+            [x, y, x + rng.randrange(width // 2), y + rng.randrange(height // 2)],
+            fill=tuple(rng.randrange(256) for _ in range(3)),
+        )
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+def generate_dataset(
+    pets=100,
+    applicants=50,
+    owners=40,
+    photos_per_pet=3,
+    photo_size=(1200, 900),
+    seed=1,
+    participants=None,
+):
+    # returns the four tables as lists of Airtable records, plus the bytes
+    # of every photo by URL
+    rng = random.Random(seed)
+    today = datetime.date.today().isoformat()
+    statuses = [status for status, _ in pet_statuses]
+    weights = [weight for _, weight in pet_statuses]
+
+    owner_records = []
+    for i in range(owners):
+        owner_records.append({
+            "id": f"recOwner{i:06d}",
+            "fields": {
+                "Name": f"{rng.choice(first_names)} {rng.choice(last_names)}",
+                "Email Address": f"owner{i}@example.com",
+            },
+        })
+
+    photos = {}
+    pet_records = []
+    for i in range(pets):
+        pet_id = f"recPet{i:06d}"
+        status = rng.choices(statuses, weights)[0]
+        fields = {
+            "Pet Name": f"Pet {i}",
+            "Pet ID - do not edit": i + 1,
+            "Pet Species": rng.choice(["Dog", "Cat"]),
+            "Status": status,
+            "Original Owner": [rng.choice(owner_records)["id"]] if owner_records else [],
+            "Pictures": [],
+        }
+        if rng.random() < 0.3:
+            fields["Disclaimers"] = "Needs a fenced yard."
+        # about half of the pets were stamped on an earlier run
+        if status and status != "Accepted, Not Yet Published" and rng.random() < 0.5:
+            fields["Made Available for Adoption Date"] = today
+
+        for j in range(photos_per_pet):
+            url = f"{photo_host}{pet_id}/{j}.jpg"
+            photos[url] = make_photo(rng, photo_size)
+            fields["Pictures"].append({
+                "id": f"att{i:06d}{j:02d}",
+                "url": url,
+                "filename": f"IMG_{rng.randrange(10000):04d}.jpg",
+                "size": len(photos[url]),
+                "type": "image/jpeg",
+                "thumbnails": {"large": {"url": url}},
+            })
+        pet_records.append({"id": pet_id, "fields": fields})
+
+    applicant_records = []
+    for i in range(applicants):
+        fields = {
+            "Name": f"{rng.choice(first_names)} {rng.choice(last_names)}",
+            "Applied For": [rng.choice(pet_records)["id"]] if pet_records else [],
+        }
+        # most applicants were sent their contract on an earlier run
+        if rng.random() < 0.7:
+            fields["Contract Link"] = f"https://rebrand.ly/old{i}"
+        applicant_records.append({"id": f"recApp{i:06d}", "fields": fields})
+
+    # only read by the table exports
+    participant_records = []
+    for i in range(owners if participants is None else participants):
+        participant_records.append({
+            "id": f"recPart{i:06d}",
+            "fields": {
+                "Name": f"{rng.choice(first_names)} {rng.choice(last_names)}",
+                "Email Address": f"participant{i}@example.com",
+                "Number of Pets": rng.randrange(1, 4),
+            },
+        })
+
+    return {
+        "/Pets": pet_records,
+        "/Adoption%20Applicants": applicant_records,
+        "/Participant%20Applicants": participant_records,
+        "/Original%20Owners": owner_records,
+    }, photos
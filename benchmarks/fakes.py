@@ -0,0 +1,211 @@
+import collections
+import datetime
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from contextlib import contextmanager
+from .data import photo_host
+
+# Airtable's page size when none is asked for, and its limits
+airtable_page_size = 100
+airtable_max_batch_size = 10
+airtable_requests_per_second = 5
+
+
+class FakeAirtable:
+    # serves the tables from memory the way the Airtable REST API does:
+    # pages with an offset, fields[] projection, LAST_MODIFIED_TIME filters
+    # and PATCHes of at most 10 records. requests over the rate limit are
+    # counted rather than refused so a benchmark still finishes.
+    def __init__(self, tables):
+        self.tables = {
+            name: {record["id"]: dict(record, fields=dict(record["fields"])) for record in records}
+            for name, records in tables.items()
+        }
+        now = iso_now()
+        self.modified = {
+            name: {record_id: now for record_id in records}
+            for name, records in self.tables.items()
+        }
+        self.lock = threading.Lock()
+        self.recent_requests = collections.deque()
+        self.rate_limit_violations = 0
+        self.rejected_batches = 0
+
+    def table_name(self, request):
+        return "/" + urllib.parse.urlparse(request.url).path.rsplit("/", 1)[1]
+
+    def count_request(self):
+        with self.lock:
+            now = time.monotonic()
+            self.recent_requests.append(now)
+            while self.recent_requests[0] < now - 1:
+                self.recent_requests.popleft()
+            if len(self.recent_requests) > airtable_requests_per_second:
+                self.rate_limit_violations += 1
+
+    def get(self, request, context):
+        self.count_request()
+        table_name = self.table_name(request)
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(request.url).query)
+        fields = query.get("fields[]")
+        offset = int(query.get("offset", ["0"])[0])
+        page_size = int(query.get("pageSize", [airtable_page_size])[0])
+
+        with self.lock:
+            records = list(self.tables[table_name].values())
+            modified = dict(self.modified[table_name])
+
+        formula = query.get("filterByFormula", [""])[0]
+        since = re.match(r"IS_AFTER\(LAST_MODIFIED_TIME\(\), '(.*)'\)", formula)
+        if since:
+            records = [
+                record for record in records
+                if modified[record["id"]] > since.group(1)
+            ]
+
+        page = records[offset:offset + page_size]
+        response = {
+            "records": [
+                {
+                    "id": record["id"],
+                    "createdTime": "2021-01-01T00:00:00.000Z",
+                    "fields": {
+                        name: value for name, value in record["fields"].items()
+                        if fields is None or name in fields
+                    },
+                }
+                for record in page
+            ],
+        }
+        if offset + page_size < len(records):
+            response["offset"] = str(offset + page_size)
+        return response
+
+    def patch(self, request, context):
+        self.count_request()
+        table_name = self.table_name(request)
+        batch = json.loads(request.body)["records"]
+        if len(batch) > airtable_max_batch_size:
+            with self.lock:
+                self.rejected_batches += 1
+            context.status_code = 422
+            return {"error": {"type": "INVALID_RECORDS", "message": "Too many records"}}
+
+        updated = []
+        now = iso_now()
+        with self.lock:
+            for change in batch:
+                record = self.tables[table_name].get(change["id"])
+                if record is None:
+                    context.status_code = 404
+                    return {"error": "NOT_FOUND"}
+                record["fields"].update(change["fields"])
+                self.modified[table_name][change["id"]] = now
+                updated.append({"id": record["id"], "fields": dict(record["fields"])})
+        return {"records": updated}
+
+
+class FakeRebrandly:
+    def __init__(self):
+        self.links = {}
+        self.lock = threading.Lock()
+
+    def create(self, request, context):
+        destination = json.loads(request.body)["destination"]
+        with self.lock:
+            link_id = f"link{len(self.links)}"
+            self.links[link_id] = destination
+        return {
+            "id": link_id,
+            "destination": destination,
+            "shortUrl": f"rebrand.ly/{link_id}",
+        }
+
+    def list(self, request, context):
+        # pages of links in the order they were made, after the "last" one
+        limit = int(request.qs.get("limit", ["25"])[0])
+        last = request.qs.get("last", [""])[0]
+        with self.lock:
+            link_ids = list(self.links)
+        start = link_ids.index(last) + 1 if last in link_ids else 0
+        return [
+            {"id": link_id, "destination": self.links[link_id], "shortUrl": f"rebrand.ly/{link_id}"}
+            for link_id in link_ids[start:start + limit]
+        ]
+
+    def delete(self, request, context):
+        # a batch of links, the way delete_links sends them
+        with self.lock:
+            for link_id in json.loads(request.body)["links"]:
+                self.links.pop(link_id, None)
+        return {}
+
+
+def photo_response(photos):
+    def respond(request, context):
+        content = photos.get(request.url)
+        if content is None:
+            context.status_code = 404
+            return b""
+        context.headers["Content-Length"] = str(len(content))
+        return content
+    return respond
+
+
+def iso_now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+@contextmanager
+def offline_environment(tables, photos):
+    # everything automations() talks to, served locally: the Airtable base,
+    # the photo CDN, Rebrandly, Slack and (through moto) S3 and Secrets
+    # Manager. yields the fake Airtable so its counters can be read after.
+    import boto3
+    import requests_mock
+
+    from moto import mock_aws
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-2")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+    from new_digs_automation import airtable, automation, clients, photos as photo_store, rebrandly, state
+
+    airtable_fake = FakeAirtable(tables)
+    rebrandly_fake = FakeRebrandly()
+
+    with tempfile.TemporaryDirectory() as state_dir, mock_aws():
+        # nothing carries over from the previous environment
+        state.local_state_dir = state_dir + "/"
+        clients.aws_clients.clear()
+        photo_store.photo_inventory.clear()
+        automation.slack_webhook["url"] = None
+
+        boto3.client("s3").create_bucket(
+            Bucket=photo_store.photo_bucket,
+            CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_DEFAULT_REGION"]},
+        )
+        boto3.client("secretsmanager").create_secret(
+            Name="slack_nd_alerts_webhook",
+            SecretString=json.dumps({"url": "https://hooks.slack.invalid/benchmark"}),
+        )
+
+        with requests_mock.Mocker() as m:
+            table_url = re.compile(re.escape(airtable.base_url) + r"/[^/?]+")
+            m.get(table_url, json=airtable_fake.get)
+            m.patch(table_url, json=airtable_fake.patch)
+            m.post(rebrandly.links_url, json=rebrandly_fake.create)
+            m.get(rebrandly.links_url, json=rebrandly_fake.list)
+            m.delete(rebrandly.links_url, json=rebrandly_fake.delete)
+            m.post("https://hooks.slack.invalid/benchmark", text="ok")
+            m.get(re.compile(re.escape(photo_host) + ".*"), content=photo_response(photos))
+            yield airtable_fake
+
+        clients.aws_clients.clear()
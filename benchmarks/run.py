@@ -0,0 +1,197 @@
+# Times automations() against local stand-ins for Airtable, S3, Rebrandly
+# and Slack at several sizes of base, e.g.
+#
+#     python -m benchmarks.run --pets 50 200 800 --photos-per-pet 3
+#     python -m benchmarks.run --output bench.json
+#     python -m benchmarks.run --baseline bench.json
+#
+# Every size gets a fresh environment and two runs: a cold one that has to
+# rename, thumbnail and mirror everything, and a warm one straight after
+# where nothing has changed, which is what most hourly runs look like
+# (except at midnight, when every pet's pictures are checked again).
+# Memory is the peak of Python allocations seen by tracemalloc (Pillow's own
+# buffers and the image worker processes aren't included) along with the
+# process's peak resident size.
+import argparse
+import json
+import logging
+import resource
+import sys
+import time
+import tracemalloc
+
+from .data import generate_dataset
+from .fakes import offline_environment
+
+# the stage timings compared against a baseline must be at least this long
+# to count, so noise in stages that take a few milliseconds is ignored
+min_compared_seconds = 0.05
+
+
+def run_once(automations, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = automations()
+    seconds = time.perf_counter() - started
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    metrics = result.pop("metrics")
+    return {
+        "seconds": round(seconds, 3),
+        "python_peak_mb": round(peak / 2 ** 20, 1),
+        "stages_seconds": metrics["stages_seconds"],
+        "requests": {
+            upstream: upstream_metrics["requests"]
+            for upstream, upstream_metrics in metrics["upstreams"].items()
+        },
+        "image_timings": metrics["timings"],
+        "result": result,
+    }
+
+
+def benchmark_size(pets, args):
+    tables, photos = generate_dataset(
+        pets=pets,
+        applicants=max(1, pets // 2),
+        owners=max(1, pets * 2 // 5),
+        photos_per_pet=args.photos_per_pet,
+        photo_size=(args.photo_width, args.photo_height),
+        seed=args.seed,
+    )
+
+    with offline_environment(tables, photos) as airtable_fake:
+        from new_digs_automation.automation import automations
+
+        runs = {}
+        for name in ("cold", "warm"):
+            runs[name] = run_once(automations, not args.no_tracemalloc)
+            run = runs[name]
+            run["pets_per_second"] = round(pets / run["seconds"], 1)
+            photos_uploaded = run["result"].get("photos_uploaded", 0)
+            upload_seconds = run["stages_seconds"].get("upload_photos")
+            if photos_uploaded and upload_seconds:
+                run["photos_per_second"] = round(photos_uploaded / upload_seconds, 1)
+            thumbnails = run["result"].get("thumbnails_updated", 0)
+            thumbnail_seconds = run["stages_seconds"].get("update_thumbnails")
+            if thumbnails and thumbnail_seconds:
+                run["thumbnails_per_second"] = round(thumbnails / thumbnail_seconds, 1)
+
+    return {
+        "pets": pets,
+        "photos": len(photos),
+        "runs": runs,
+        "airtable_rate_limit_violations": airtable_fake.rate_limit_violations,
+        "airtable_rejected_batches": airtable_fake.rejected_batches,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def print_report(report):
+    for size in report["sizes"]:
+        print(
+            f"\n{size['pets']} pets, {size['photos']} photos "
+            f"(max RSS {size['max_rss_mb']} MB, "
+            f"{size['airtable_rate_limit_violations']} requests over Airtable's rate limit)"
+        )
+        stages = []
+        for run in size["runs"].values():
+            for stage in run["stages_seconds"]:
+                if stage not in stages:
+                    stages.append(stage)
+
+        print(f"  {'':24}{'cold':>10}{'warm':>10}")
+        for stage in stages:
+            print("  {:24}{:>10}{:>10}".format(
+                stage,
+                *[
+                    size["runs"][name]["stages_seconds"].get(stage, "-")
+                    for name in ("cold", "warm")
+                ],
+            ))
+        for label, key in (
+            ("total seconds", "seconds"),
+            ("pets/s", "pets_per_second"),
+            ("thumbnails/s", "thumbnails_per_second"),
+            ("photos/s", "photos_per_second"),
+            ("python peak MB", "python_peak_mb"),
+        ):
+            print("  {:24}{:>10}{:>10}".format(
+                label,
+                *[size["runs"][name].get(key, "-") for name in ("cold", "warm")],
+            ))
+        for name in ("cold", "warm"):
+            requests = ", ".join(
+                f"{upstream} {count}"
+                for upstream, count in sorted(size["runs"][name]["requests"].items())
+            )
+            print(f"  {name} requests: {requests}")
+
+
+def compare(report, baseline, tolerance):
+    # every stage of every run that got slower than the baseline allows
+    regressions = []
+    baseline_sizes = {size["pets"]: size for size in baseline["sizes"]}
+    for size in report["sizes"]:
+        previous = baseline_sizes.get(size["pets"])
+        if not previous:
+            continue
+        for name, run in size["runs"].items():
+            previous_run = previous["runs"].get(name, {})
+            timings = dict(run["stages_seconds"], total=run["seconds"])
+            previous_timings = dict(
+                previous_run.get("stages_seconds", {}),
+                total=previous_run.get("seconds"),
+            )
+            for stage, seconds in timings.items():
+                before = previous_timings.get(stage)
+                if not before or max(before, seconds) < min_compared_seconds:
+                    continue
+                if seconds > before * (1 + tolerance):
+                    regressions.append(
+                        f"{size['pets']} pets, {name} {stage}: {before}s -> {seconds}s"
+                    )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark automations() offline")
+    parser.add_argument("--pets", type=int, nargs="+", default=[25, 100, 400])
+    parser.add_argument("--photos-per-pet", type=int, default=3)
+    parser.add_argument("--photo-width", type=int, default=1200)
+    parser.add_argument("--photo-height", type=int, default=900)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-tracemalloc", action="store_true", help="tracemalloc slows the runs down")
+    parser.add_argument("--output", help="write the report here as JSON")
+    parser.add_argument("--baseline", help="a report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower a stage may get")
+    parser.add_argument("--verbose", action="store_true", help="keep the automation's own logging")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    report = {"sizes": [benchmark_size(pets, args) for pets in args.pets]}
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(report, json.load(fp), args.tolerance)
+        if regressions:
+            print("\nslower than the baseline:")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print("\nno stage is slower than the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
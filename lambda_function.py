@@ -1,5 +1,20 @@
-from new_digs_automation import automations
+import logging
+import time
+
+# how long loading the automation takes is the part of a cold start we control
+import_started = time.perf_counter()
+from new_digs_automation.automation import automations  # noqa: E402
+import_seconds = time.perf_counter() - import_started
+
+cold_start = True
 
 
 def lambda_handler(event, context):
-    return automations()
+    global cold_start
+    if cold_start:
+        logging.getLogger().info(f"cold start, imports took {import_seconds:.3f}s")
+    result = automations(context)
+    result["cold_start"] = cold_start
+    result["import_seconds"] = round(import_seconds, 3) if cold_start else 0
+    cold_start = False
+    return result
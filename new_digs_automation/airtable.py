@@ -0,0 +1,284 @@
+import datetime
+import json
+import logging
+import requests
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from .config import api_key, base
+from .http_client import HttpClient
+from .state import load_state, save_state
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+base_url = "https://api.airtable.com/v0/" + base
+headers = {"Authorization": "Bearer " + api_key}
+
+# start each incremental fetch a little before the previous run began so
+# edits made while that run was paging (or small clock skew) aren't missed
+incremental_overlap = datetime.timedelta(minutes=5)
+# deleted records never show up in a modified-since query, so rebuild the
+# snapshot from scratch once a day
+full_refresh_interval = datetime.timedelta(hours=24)
+
+# Airtable accepts at most 10 records per PATCH and 5 requests per second
+# per base, and answers a client over that with 429s for 30 seconds
+max_batch_size = 10
+max_requests_per_second = 5
+rate_limited_seconds = 30
+
+
+# one client shared by every Airtable call, so connections are reused and
+# the rate limit holds across all the threads fetching and patching
+client = HttpClient(
+    headers=headers,
+    rate_limits={"api.airtable.com": max_requests_per_second},
+    rate_limited_waits={"api.airtable.com": rate_limited_seconds},
+)
+
+
+class UpdateQueue:
+    # collects field changes from every stage so each record is patched once
+    def __init__(self):
+        self.pending = {}
+        # what Airtable returned for every record flushed so far, since a
+        # long stage may flush as it goes rather than only at the end
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def add(self, table_name, record_id, fields):
+        with self.lock:
+            table = self.pending.setdefault(table_name, {})
+            table.setdefault(record_id, {}).update(fields)
+
+    def flush(self, fields=None):
+        # fields limits the flush to those fields, for a stage that sends its
+        # own changes as it goes; everything else stays queued so each record
+        # still gets the other stages' changes in one patch
+        with self.lock:
+            if fields is None:
+                pending = self.pending
+                self.pending = {}
+            else:
+                pending = {}
+                for table_name, records in self.pending.items():
+                    for record_id, record_fields in records.items():
+                        taken = {
+                            field: record_fields.pop(field)
+                            for field in fields
+                            if field in record_fields
+                        }
+                        if taken:
+                            pending.setdefault(table_name, {})[record_id] = taken
+                    self.pending[table_name] = {
+                        record_id: record_fields
+                        for record_id, record_fields in records.items()
+                        if record_fields
+                    }
+
+        results = {}
+        for table_name, records in pending.items():
+            results[table_name] = update_records(
+                table_name,
+                [
+                    {"id": record_id, "fields": fields}
+                    for record_id, fields in records.items()
+                ],
+            )
+
+        with self.lock:
+            for table_name, table_results in results.items():
+                flushed = self.results.setdefault(table_name, {})
+                for record_id, fields in table_results.items():
+                    # a record stays failed if any of its patches failed
+                    if record_id in flushed and flushed[record_id] is None:
+                        continue
+                    if fields is not None and record_id in flushed:
+                        fields = {**flushed[record_id], **fields}
+                    flushed[record_id] = fields
+        return results
+
+
+def union_fields(*field_lists):
+    # a stable order keeps the request (and any snapshot keyed on it) the same
+    # from run to run
+    return sorted(set().union(*field_lists))
+
+
+def index_records(records):
+    return {record["id"]: record for record in records}
+
+
+def get_table(table_name, params=None, fields=None):
+    records = []
+    for page in iter_table_pages(table_name, params, fields):
+        records += page
+    return records
+
+
+def iter_table_pages(table_name, params=None, fields=None):
+    # yields the records a page at a time, for callers that don't need the
+    # whole table in memory at once
+    url = base_url + table_name
+
+    params = dict(params or {})
+    # without a field list Airtable returns every field of every record
+    if fields:
+        params["fields[]"] = list(fields)
+
+    while True:
+        # transient failures are retried by the client; anything left (or
+        # an error status) fails the fetch, since a partial table would look
+        # like deleted records
+        response = client.get(url, params=params)
+        if response.status_code != requests.codes.ok:
+            logger.error(f"Fetching {table_name} failed with status code {response.status_code}")
+            logger.error(response.content)
+            response.raise_for_status()
+
+        airtable_response = response.json()
+        yield airtable_response["records"]
+
+        offset = airtable_response.get("offset")
+        if not offset:
+            break
+        params["offset"] = offset
+
+
+def get_table_incremental(table_name, params=None, fields=None):
+    params = dict(params or {})
+    if fields:
+        params["fields[]"] = list(fields)
+    snapshot_name = "snapshot-" + table_name.strip("/").replace("%20", "_")
+    snapshot = load_state(snapshot_name)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    full_refresh = (
+        not snapshot
+        or snapshot.get("params") != params
+        or now - datetime.datetime.fromisoformat(snapshot["last_full_refresh"])
+        > full_refresh_interval
+    )
+
+    if full_refresh:
+        logger.info(f"fetching all of {table_name}")
+        records = get_table(table_name, params)
+        last_full_refresh = now
+    else:
+        high_water_mark = snapshot["high_water_mark"]
+        changed_params = dict(params)
+        changed_params["filterByFormula"] = (
+            f"IS_AFTER(LAST_MODIFIED_TIME(), '{high_water_mark}')"
+        )
+        changed_records = get_table(table_name, changed_params)
+        logger.info(
+            f"fetched {len(changed_records)} records of {table_name} "
+            f"modified since {high_water_mark}"
+        )
+
+        records_by_id = index_records(snapshot["records"])
+        for record in changed_records:
+            records_by_id[record["id"]] = record
+        records = list(records_by_id.values())
+        last_full_refresh = datetime.datetime.fromisoformat(
+            snapshot["last_full_refresh"]
+        )
+
+    save_state(snapshot_name, {
+        "params": params,
+        "high_water_mark": (now - incremental_overlap).strftime(
+            "%Y-%m-%dT%H:%M:%S.000Z"
+        ),
+        "last_full_refresh": last_full_refresh.isoformat(),
+        "records": records,
+    })
+
+    return records
+
+
+def get_tables(table_names, incremental=False, fields=None):
+    fetch = get_table_incremental if incremental else get_table
+    fields = fields or {}
+
+    # each table is its own chain of pages, so fetch the tables side by side
+    with ThreadPoolExecutor(max_workers=len(table_names) or 1) as executor:
+        futures = {
+            table_name: executor.submit(
+                fetch,
+                table_name,
+                fields=fields.get(table_name),
+            )
+            for table_name in table_names
+        }
+        return {
+            table_name: future.result()
+            for table_name, future in futures.items()
+        }
+
+
+def update_records(table_name, records):
+    # returns the fields Airtable sent back for each record id, or None for
+    # records whose batch failed
+    coalesced = {}
+    for record in records:
+        coalesced.setdefault(record["id"], {}).update(record["fields"])
+    records = [
+        {"id": record_id, "fields": fields}
+        for record_id, fields in coalesced.items()
+    ]
+    batches = [
+        records[i:i + max_batch_size]
+        for i in range(0, len(records), max_batch_size)
+    ]
+
+    results = {}
+    if not batches:
+        return results
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_requests_per_second, len(batches))
+    ) as executor:
+        for batch_results in executor.map(
+            lambda batch: send_batch(table_name, batch),
+            batches,
+        ):
+            results.update(batch_results)
+
+    failed = sum(1 for fields in results.values() if fields is None)
+    logger.info(
+        f"patched {len(results) - failed} {table_name} records, {failed} failed"
+    )
+    return results
+
+
+def send_batch(table_name, batch):
+    url = base_url + table_name
+    failed = {record["id"]: None for record in batch}
+
+    try:
+        response = client.patch(
+            url,
+            headers={"Content-Type": "application/json"},
+            data=json.dumps({"records": batch}, default=str),
+        )
+    except requests.RequestException:
+        logger.exception(f"Error patching {table_name} records")
+        return failed
+
+    if response.status_code != requests.codes.ok:
+        logger.error(f"Patch failed. status code {response.status_code}")
+        logger.error(response.content)
+        return failed
+
+    returned = response.json().get("records", [])
+    if len(returned) != len(batch):
+        logger.error("Patch returned the wrong number of records.")
+        logger.error(response.content)
+        return failed
+
+    returned_fields = {record["id"]: record["fields"] for record in returned}
+    return {
+        record["id"]: returned_fields.get(record["id"])
+        for record in batch
+    }
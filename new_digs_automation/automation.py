@@ -1,173 +1,166 @@
-import boto3
-import copy
 import datetime
+import io
 import json
 import logging
 import os
 import random
-import requests
 import string
+import time
 import urllib.parse
 
-from botocore.exceptions import ClientError
-from .config import api_key, base, rebrandly_domain_key, rebrandly_api_key
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .airtable import UpdateQueue, get_tables, union_fields
+from .clients import get_secrets_client, http_session
+from .duplicates import find_duplicate_photos
+from .exports import export_tables_if_due
+from .metrics import metrics
+from .images import (
+    download_image,
+    image_worker_pool,
+    io_workers,
+    thumbnail_bytes,
+)
+from .records import Applicant, Owner, PetStatus, as_pets
+from .photos import (
+    abort_stale_uploads,
+    add_to_inventory,
+    upload_image,
+    get_content_addressed_inventory,
+    get_photo_inventory,
+    mirror_photos,
+    mirror_photos_content_addressed,
+    get_pets_with_changed_pictures,
+    picture_fingerprints_name,
+    prune_pet_manifests,
+)
+from .rebrandly import delete_links, list_links, shorten_links
+from .stages import Stage, deadline_from_context, process_backlog, run_stages
+from .settings import (
+    avif_variants,
+    content_addressed_photos,
+    emit_metrics_emf,
+    incremental_sync,
+    responsive_variants,
+    table_exports,
+)
+from .state import load_state, save_state
+from .variants import update_variants
 from datetime import date
-from PIL import Image, ImageOps, UnidentifiedImageError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-secrets_client = boto3.client("secretsmanager")
+# the Slack webhook is re-read from Secrets Manager at most this often
+slack_webhook_ttl = 15 * 60
+slack_webhook = {
+    "url": None,
+    "fetched": 0,
+}
+
+possible_pet_statuses = [status.value for status in PetStatus]
+
+# keeps the duplicate photo alert inside Slack's message size limit
+max_duplicates_reported = 20
+
+# the picture stages stop this many seconds before the deadline so the
+# updates they queued can still be sent to Airtable
+stage_reserve = 30
+# the stages whose progress decides whether a pet's pictures are done
+picture_stages = [
+    "rename_photos",
+    "update_thumbnails",
+    "update_variants",
+    "upload_photos",
+    "flush_updates",
+]
 
-possible_pet_statuses = [
-    "Accepted, Not Yet Published",
-    "Published - Available for Adoption",
-    "Adoption Pending",
-    "Adopted",
-    "Removed from Program"
+# thumbnails are made this many at a time to bound memory during a backfill
+thumbnail_chunk_size = 32
+# photos are mirrored this many pets at a time
+upload_chunk_size = 8
+# a backlog of pictures is worked through in this order of status, so pets
+# that are on the site are seen to first
+backlog_status_priority = [
+    PetStatus.AVAILABLE,
+    PetStatus.PENDING,
+    PetStatus.ACCEPTED,
 ]
-base_url = "https://api.airtable.com/v0/" + base
-headers = {"Authorization": "Bearer " + api_key}
-
-
-def automations():
-    url = base_url + "/Pets"
-
-    quit = False
-    pets = []
-    offset = None
-
-    while not quit:
-        
-        params = {}
-
-        if offset:
-            params = {
-                "offset": offset,
-            }
-
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code != requests.codes.ok:
-            logger.error("Airtable response: ")
-            logger.error(response)
-            logger.error("URL: %s", url)
-            logger.error("Headers: %s", str(headers))
-            raise Exception
-    
-        airtable_response = response.json()
-        
-        if not airtable_response.get("offset"):
-            quit = True
-        else:
-            offset = airtable_response["offset"]
-        
-        pets += airtable_response["records"]
-
-    # check for repeat photo names
-    check_photo_names(pets)
-
-    # rename photos
-    photos_renamed = rename_photos(pets)
-
-    # get pets that are available but don't have an available date
-    available_pets_to_update = get_available_pets_to_update(pets)
-    available_pets_updated = 0
-    if available_pets_to_update:
-        available_pets_updated = update_available_pets(
-            available_pets_to_update
-        )
-        if not available_pets_updated:
-            logger.error("Updating available pets failed.")
-
-    # get pets that are adopted without an adopted date
-    adopted_pets_to_update = get_adopted_pets_to_update(pets)
-    adopted_pets_updated = 0
-    if adopted_pets_to_update:
-        adopted_pets_updated = update_adopted_pets(
-            adopted_pets_to_update
-        )
-        if not adopted_pets_updated:
-            logger.error("Updating adopted pets failed.")
-
-    # get pets that are removed without a removed date
-    removed_pets_to_update = get_removed_pets_to_update(pets)
-    removed_pets_updated = 0
-    if removed_pets_to_update:
-        removed_pets_updated = update_removed_pets(
-            removed_pets_to_update
-        )
-        if not removed_pets_updated:
-            logger.error("Updating removed pets failed.")
-
-    url = base_url + "/Adoption%20Applicants"
-
-    quit = False
-    adopt_apps = []
-    offset = None
-
-    while not quit:
-        
-        params = {}
-
-        if offset:
-            params = {
-                "offset": offset,
-            }
-
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code != requests.codes.ok:
-            logger.error("Airtable response: ")
-            logger.error(response)
-            logger.error("URL: %s", url)
-            logger.error("Headers: %s", str(headers))
-            raise Exception
-    
-        airtable_response = response.json()
-        
-        if not airtable_response.get("offset"):
-            quit = True
-        else:
-            offset = airtable_response["offset"]
-        
-        adopt_apps += airtable_response["records"]
-
-    url = base_url + "/Original%20Owners"
-
-    quit = False
-    owners = []
-    offset = None
-
-    while not quit:
-        
-        params = {}
-
-        if offset:
-            params = {
-                "offset": offset,
-            }
-
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code != requests.codes.ok:
-            logger.error("Airtable response: ")
-            logger.error(response)
-            logger.error("URL: %s", url)
-            logger.error("Headers: %s", str(headers))
-            raise Exception
-    
-        airtable_response = response.json()
-        
-        if not airtable_response.get("offset"):
-            quit = True
-        else:
-            offset = airtable_response["offset"]
-        
-        owners += airtable_response["records"]
-
-    contracts_added = add_adoption_contracts(
-        adopt_apps,
-        pets,
-        owners,
+
+# the date each status gets stamped with, and the statuses that need it
+status_date_fields = {
+    "Made Available for Adoption Date": [
+        PetStatus.AVAILABLE,
+        PetStatus.PENDING,
+        PetStatus.ADOPTED,
+        PetStatus.REMOVED,
+    ],
+    "Adopted Date": [PetStatus.ADOPTED],
+    "Removed from Program Date": [PetStatus.REMOVED],
+}
+# the result key each date stamp is counted under
+status_date_results = {
+    "Made Available for Adoption Date": "available_pets_updated",
+    "Adopted Date": "adopted_pets_updated",
+    "Removed from Program Date": "removed_pets_updated",
+}
+
+# the Pets fields each stage reads; only their union is fetched
+pet_fields_by_stage = {
+    "check_photo_names": ["Pet Name", "Pictures"],
+    "rename_photos": ["Pictures", "PictureMap-DoNotModify"],
+    "status_dates": [
+        "Status",
+        "Made Available for Adoption Date",
+        "Adopted Date",
+        "Removed from Program Date",
+    ],
+    "add_adoption_contracts": [
+        "Pet Name",
+        "Pet ID - do not edit",
+        "Pet Species",
+        "Original Owner",
+        "Disclaimers",
+    ],
+    "cleanup_links": ["Status", "Pet ID - do not edit"],
+    "update_thumbnails": [
+        "Pictures",
+        "PictureMap-DoNotModify",
+        "ThumbnailURL",
+        "Status",
+    ],
+    "upload_photos": ["Pictures", "PictureMap-DoNotModify", "Status"],
+}
+if responsive_variants:
+    # only requested when enabled, since Airtable rejects unknown fields
+    pet_fields_by_stage["update_variants"] = [
+        "Pictures",
+        "PictureMap-DoNotModify",
+        "VariantsManifestURL",
+    ]
+adoption_app_fields = ["Name", "Applied For", "Contract Link"]
+owner_fields = ["Name", "Email Address"]
+
+
+def automations(context=None):
+    # the lambda container is reused between runs, so start from zero
+    metrics.reset()
+
+    # every stage queues its field changes here so each record is patched
+    # once no matter how many stages touched it
+    updates = UpdateQueue()
+
+    values, timed_out, failed = run_stages(
+        automation_stages(),
+        {"updates": updates},
+        deadline=deadline_from_context(context),
     )
+    pets_by_id = values["pets_by_id"]
+    pets_with_new_pictures = values["pets_with_new_pictures"]
+    status_dates_to_update = values["status_dates_to_update"]
+    status_report = values["status_report"]
+    thumbnails_to_update = values["thumbnails_to_update"]
+    thumbnail_pet_ids = values["thumbnail_pet_ids"]
+    photo_results = values["photo_results"]
 
     # links_cleaned_up = cleanup_links(
     #     pets,
@@ -176,519 +169,489 @@ def automations():
 
     # sheets_rows = google_sheets_synchronization()
     sheets_rows = 0
-    # update thumbnails for pets that don't have one
-    thumbnails_to_update = get_thumbnails_to_update(pets)
-    thumbnails_updated = 0
-    if thumbnails_to_update:
-        thumbnails_updated = update_thumbnails(
-            pets,
-            thumbnails_to_update,
+
+    results = values["update_results"]
+    pet_results = results.get("/Pets", {})
+
+    status_dates_updated = {}
+    for field, pet_ids in status_dates_to_update.items():
+        result_key = status_date_results[field]
+        status_dates_updated[result_key] = check_date_updates(
+            pet_results,
+            pet_ids,
+            field,
         )
-        if not thumbnails_updated:
-            logger.error("Updating thumbnails failed.")
+        if pet_ids and not status_dates_updated[result_key]:
+            logger.error(f"Updating {field} failed.")
 
-    # move photos to s3
-    photos_in_s3 = get_photos()
-    photos_uploaded = upload_photos(photos_in_s3, pets)
+    app_results = results.get("/Adoption%20Applicants", {})
+    contracts_added = sum(
+        1 for app_id in values["contract_app_ids"]
+        if app_results.get(app_id) is not None
+    )
+
+    thumbnails_updated = sum(
+        1 for pet_id in thumbnail_pet_ids
+        if (pet_results.get(pet_id) or {}).get("ThumbnailURL")
+    )
+    if thumbnail_pet_ids and not thumbnails_updated:
+        logger.error("Updating thumbnails failed.")
+
+    photos_uploaded = sum(1 for result in photo_results if result["uploaded"])
+
+    # remember the pets that made it through every stage so they're skipped
+    # until their pictures change again. if a picture stage failed or ran out
+    # of time it's unknown how far it got, so every changed pet is tried again
+    fingerprints = values["fingerprints"]
+    unfinished_stages = set(timed_out) | set(failed)
+    if unfinished_stages & set(picture_stages):
+        logger.error(f"{sorted(unfinished_stages)} didn't finish, pictures will be retried")
+        pets_with_new_pictures = []
+    unfinished_pet_ids = {
+        pet_id for pet_id, fields in pet_results.items() if fields is None
+    }
+    unfinished_pet_ids.update(set(thumbnails_to_update) - set(thumbnail_pet_ids))
+    unfinished_pet_ids.update(
+        result["pet_id"] for result in photo_results if not result["uploaded"]
+    )
+    for pet in pets_with_new_pictures:
+        if pet.id not in unfinished_pet_ids:
+            fingerprints[pet.id] = pet.picture_fingerprint()
+    # without the tables or the saved fingerprints there's nothing to
+    # compare against, so leave the saved ones as they are
+    if not unfinished_stages & {"fetch_tables", "find_changed_pictures"}:
+        save_state(picture_fingerprints_name, {
+            pet_id: fingerprints[pet_id]
+            for pet_id in pets_by_id
+            if pet_id in fingerprints
+        })
 
     return {
-        "available_pets_updated": available_pets_updated,
-        "adopted_pets_updated": adopted_pets_updated,
-        "removed_pets_updated": removed_pets_updated,
+        **status_dates_updated,
+        "pets_with_invalid_status": (
+            len(status_report["unknown_status"])
+            + len(status_report["missing_status"])
+        ),
         "adoption_contracts_added": contracts_added,
         "google_sheets_rows_written": sheets_rows,
+        "table_records_exported": sum(
+            count or 0 for count in values.get("tables_exported", {}).values()
+        ),
         "thumbnails_updated": thumbnails_updated,
+        "variant_manifests_updated": values.get("variant_manifests_updated", 0),
         "photos_uploaded": photos_uploaded,
         "links_cleaned_up": links_cleaned_up,
-        "photos_renamed": photos_renamed,
+        "photos_renamed": values["photos_renamed"],
+        "duplicate_photos_found": values["duplicate_photos_found"],
+        "stages_timed_out": timed_out,
+        "stages_failed": failed,
+        "metrics": metrics.emit(emf=emit_metrics_emf),
     }
 
 
-def check_photo_names(pets):
-    # only run this once a day
-    current_hour = datetime.datetime.today().hour
-    if current_hour != 0:
-        return
+def automation_stages():
+    # the stages of a run and what each one needs. the status dates and
+    # contracts only read the tables, so they go ahead while the pictures are
+    # renamed, and the thumbnails, variants and S3 mirroring all run side by
+    # side once the renamed pictures have their final names
+    stages = [
+        Stage(
+            "fetch_tables",
+            fetch_tables,
+            outputs=("pets", "adopt_apps", "pets_by_id", "owners_by_id"),
+            defaults={
+                "pets": [],
+                "adopt_apps": [],
+                "pets_by_id": {},
+                "owners_by_id": {},
+            },
+        ),
+        Stage(
+            "check_photo_names",
+            check_photo_names,
+            inputs=("pets", "deadline"),
+            outputs=("duplicate_photos_found",),
+            reserve=stage_reserve,
+            defaults={"duplicate_photos_found": 0},
+        ),
+        Stage(
+            "find_changed_pictures",
+            get_pets_to_process,
+            inputs=("pets",),
+            outputs=("fingerprints", "pets_with_new_pictures"),
+            defaults={"fingerprints": {}, "pets_with_new_pictures": []},
+        ),
+        Stage(
+            "rename_photos",
+            rename_photos,
+            inputs=("pets_with_new_pictures", "updates"),
+            outputs=("photos_renamed",),
+            reserve=stage_reserve,
+            defaults={"photos_renamed": 0},
+        ),
+        Stage(
+            "status_dates",
+            stamp_status_dates,
+            inputs=("pets", "updates"),
+            outputs=("status_dates_to_update", "status_report"),
+            reserve=stage_reserve,
+            defaults={
+                "status_dates_to_update": {},
+                "status_report": {"unknown_status": [], "missing_status": []},
+            },
+        ),
+        Stage(
+            "add_adoption_contracts",
+            add_adoption_contracts,
+            inputs=("adopt_apps", "pets_by_id", "owners_by_id", "updates"),
+            outputs=("contract_app_ids",),
+            reserve=stage_reserve,
+            defaults={"contract_app_ids": []},
+        ),
+        Stage(
+            "update_thumbnails",
+            update_changed_thumbnails,
+            inputs=("pets_by_id", "pets_with_new_pictures", "updates", "deadline"),
+            outputs=("thumbnails_to_update", "thumbnail_pet_ids"),
+            after=("rename_photos",),
+            reserve=stage_reserve,
+            defaults={"thumbnails_to_update": [], "thumbnail_pet_ids": []},
+        ),
+        Stage(
+            "upload_photos",
+            mirror_changed_photos,
+            inputs=("pets_with_new_pictures", "deadline"),
+            outputs=("photo_results",),
+            after=("rename_photos",),
+            reserve=stage_reserve,
+            defaults={"photo_results": []},
+        ),
+    ]
+
+    queueing_stages = [
+        "rename_photos",
+        "status_dates",
+        "add_adoption_contracts",
+        "update_thumbnails",
+    ]
+    if responsive_variants:
+        # responsive sizes of every picture, listed in a manifest per pet
+        stages.append(Stage(
+            "update_variants",
+            lambda pets_by_id, updates, deadline: update_variants(
+                pets_by_id,
+                updates,
+                avif=avif_variants,
+                deadline=deadline,
+                priority=backlog_priority,
+            ),
+            inputs=("pets_by_id", "updates", "deadline"),
+            outputs=("variant_manifests_updated",),
+            after=("rename_photos",),
+            reserve=stage_reserve,
+            defaults={"variant_manifests_updated": 0},
+        ))
+        queueing_stages.append("update_variants")
+
+    if table_exports:
+        stages.append(Stage(
+            "export_tables",
+            export_tables_if_due,
+            inputs=("deadline",),
+            outputs=("tables_exported",),
+            reserve=stage_reserve,
+            defaults={"tables_exported": {}},
+        ))
+
+    stages.append(Stage(
+        "flush_updates",
+        flush_updates,
+        inputs=("updates",),
+        outputs=("update_results",),
+        after=queueing_stages,
+        defaults={"update_results": {}},
+    ))
+    return stages
+
+
+def fetch_tables():
+    tables = get_tables(
+        [
+            "/Pets",
+            "/Adoption%20Applicants",
+            "/Original%20Owners",
+        ],
+        incremental=incremental_sync,
+        fields={
+            "/Pets": union_fields(*pet_fields_by_stage.values()),
+            "/Adoption%20Applicants": adoption_app_fields,
+            "/Original%20Owners": owner_fields,
+        },
+    )
+    # parse the records once, up front, so no stage has to pick through
+    # the raw fields
+    pets = as_pets(tables["/Pets"])
+    adopt_apps = [
+        Applicant.from_record(record)
+        for record in tables["/Adoption%20Applicants"]
+    ]
+    owners = [Owner.from_record(record) for record in tables["/Original%20Owners"]]
+
+    # look records up by id instead of scanning the tables in every stage
+    return (
+        pets,
+        adopt_apps,
+        {pet.id: pet for pet in pets},
+        {owner.id: owner for owner in owners},
+    )
 
-    pets_with_bad_photos = []
 
-    for pet in pets:
-        try:
-            pet_fields = pet["fields"]
-            if (
-                "Pictures" in pet_fields
-                and pet_fields["Pictures"]
-            ):
-                pictures = pet_fields["Pictures"]
+def get_pets_to_process(pets):
+    # only pets whose attachments changed since they were last handled go
+    # through the rename, thumbnail and mirror stages; everyone is checked
+    # once a day in case something was changed behind our back
+    fingerprints = load_state(picture_fingerprints_name, {})
+    if datetime.datetime.today().hour == 0:
+        pets_with_new_pictures = pets
+    else:
+        pets_with_new_pictures = get_pets_with_changed_pictures(pets, fingerprints)
+    logger.info(f"{len(pets_with_new_pictures)} pets have changed pictures")
+    return fingerprints, pets_with_new_pictures
 
-                photo_names = [picture["filename"] for picture in pictures]
-                if len(photo_names) != len(set(photo_names)):
-                    pets_with_bad_photos.append(pet_fields["Pet Name"])
 
-        except Exception:
-            logger.exception(f"Error checking photo names for pet {pet['id']}")
+def stamp_status_dates(pets, updates):
+    # stamp the status dates that haven't been set yet
+    status_dates_to_update, status_report = plan_status_dates(pets)
+    for field, pet_ids in status_dates_to_update.items():
+        queue_date_updates(updates, pet_ids, field)
+    return status_dates_to_update, status_report
+
+
+def update_changed_thumbnails(pets_by_id, pets, updates, deadline=None):
+    # update thumbnails for pets that don't have one
+    thumbnails_to_update = get_thumbnails_to_update(pets)
+    thumbnail_pet_ids = []
+    if thumbnails_to_update:
+        thumbnail_pet_ids = update_thumbnails(
+            pets_by_id,
+            thumbnails_to_update,
+            updates,
+            deadline,
+        )
+    return thumbnails_to_update, thumbnail_pet_ids
+
+
+def flush_updates(updates):
+    # some stages flush as they go, so the results are everything flushed
+    updates.flush()
+    return updates.results
+
+
+def backlog_priority(pet):
+    if pet.status in backlog_status_priority:
+        return backlog_status_priority.index(pet.status)
+    return len(backlog_status_priority)
+
+
+def mirror_changed_photos(pets, deadline=None):
+    # move photos to s3, only listing the prefixes of pets with pictures
+    if content_addressed_photos:
+        # the manifest only gains references as photos are mirrored, so the
+        # ones pets no longer have are dropped first
+        prune_pet_manifests({
+            pet.id: {filename for _, filename in pet.photo_filenames()}
+            for pet in pets
+        })
+        photos_in_s3 = get_content_addressed_inventory()
+    else:
+        photos_in_s3 = get_photo_inventory([
+            pet.id for pet in pets
+            if pet.attachments
+        ])
+    return upload_photos(photos_in_s3, pets, deadline)
+
+
+def check_photo_names(pets, deadline=None):
+    # near-duplicate pictures are looked for every run since only new
+    # attachments get hashed, but everything is only reported once a day
+    full_report = datetime.datetime.today().hour == 0
+
+    duplicates = []
+    try:
+        duplicates, attachments = find_duplicate_photos(pets, full_report, deadline)
+    except Exception:
+        logger.exception("Error checking for duplicate photos")
+
+    if duplicates:
+        lines = [
+            "{} ({}) and {} ({})".format(
+                attachments[first]["pet_name"],
+                attachments[first]["filename"],
+                attachments[second]["pet_name"],
+                attachments[second]["filename"],
+            )
+            for first, second in duplicates[:max_duplicates_reported]
+        ]
+        if len(duplicates) > max_duplicates_reported:
+            lines.append(f"and {len(duplicates) - max_duplicates_reported} more")
+        post_to_slack("The following photos look like duplicates of each other:\n{}".format("\n".join(lines)))
+
+    # only check names once a day
+    if not full_report:
+        return len(duplicates)
+
+    pets_with_bad_photos = []
+
+    for pet in pets:
+        photo_names = [attachment.filename for attachment in pet.attachments]
+        if len(photo_names) != len(set(photo_names)):
+            pets_with_bad_photos.append(pet.name)
 
     if pets_with_bad_photos:
         post_to_slack("The following pets have duplicate photo names that must be renamed:\n{}".format("\n".join(pets_with_bad_photos)))
 
+    return len(duplicates)
+
 
-def rename_photos(pets):
+def rename_photos(pets, updates):
     photos_renamed = 0
-    records_to_update = []
 
     for pet in pets:
         try:
-            pet_fields = pet["fields"]
-            if (
-                "Pictures" in pet_fields
-                and pet_fields["Pictures"]
-            ):
-                photo_name_map_str = pet_fields.get("PictureMap-DoNotModify", "")
-                photo_name_map = {}
-                if photo_name_map_str:
-                    photo_name_map = json.loads(photo_name_map_str)
-
-                renamed = False
-                fields_copy = copy.deepcopy(pet_fields)
-                for photo in fields_copy["Pictures"]:
-                    mapped_name = photo_name_map.get(photo["filename"], "")
-                    _, photo_extension = os.path.splitext(photo["filename"])
-                    if not mapped_name.startswith("nd_"):
-                        new_photo_name = "nd_" + "".join(random.choices(string.ascii_uppercase + string.digits, k=10))
-                        if not photo_extension:
-                            photo_extension = ".jpg"
-                        new_photo_name += photo_extension
-
-                        logger.info(f"renaming {photo['filename']} to {new_photo_name}")
-                        photo_name_map[photo["filename"]] = new_photo_name
-                        photos_renamed += 1
-
-                        renamed = True
-
-                if renamed:
-                    records_to_update.append({
-                        "id": pet["id"],
-                        "fields": {
-                            "PictureMap-DoNotModify": json.dumps(photo_name_map),
-                        },
-                    })
-
-                    pet_fields["PictureMap-DoNotModify"] = json.dumps(photo_name_map)
+            if not pet.attachments:
+                continue
+
+            photo_name_map = dict(pet.picture_map)
+            renamed = False
+            for attachment in pet.attachments:
+                mapped_name = photo_name_map.get(attachment.filename, "")
+                _, photo_extension = os.path.splitext(attachment.filename)
+                if not mapped_name.startswith("nd_"):
+                    new_photo_name = "nd_" + "".join(random.choices(string.ascii_uppercase + string.digits, k=10))
+                    if not photo_extension:
+                        photo_extension = ".jpg"
+                    new_photo_name += photo_extension
+
+                    logger.info(f"renaming {attachment.filename} to {new_photo_name}")
+                    photo_name_map[attachment.filename] = new_photo_name
+                    photos_renamed += 1
+
+                    renamed = True
+
+            if renamed:
+                updates.add("/Pets", pet.id, {
+                    "PictureMap-DoNotModify": pet.set_picture_map(photo_name_map),
+                })
 
         except Exception:
-            logger.exception(f"Error renaming photos for pet {pet['id']}")
-
-    if records_to_update:
-        send_update(records_to_update)
+            logger.exception(f"Error renaming photos for pet {pet.id}")
 
     return photos_renamed
 
 
-def send_update(records_to_update):
-    batchsize = 10
-    for i in range(0, len(records_to_update), batchsize):
-        batch = records_to_update[i:i+batchsize]
-        try:
-            payload = {
-                "records": batch,
-            }
-            payload = json.dumps(payload, indent=4, default=str)
-            url = base_url + "/Pets"
-            patch_headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + api_key
-            }
-
-            response = requests.patch(url, headers=patch_headers, data=payload)
-            logger.info(response.text)
-            if(response.status_code != requests.codes.ok):
-                logger.error(f"Patch failed status code {response.status_code}")
-                logger.error(response.content)
-                return False
-
-            airtable_response = response.json()
-            records = airtable_response["records"]
-            if len(records) != len(batch):
-                logger.error("Patch returned the wrong number of records.")
-                logger.error(response.content)
-                return False
-        except Exception:
-            logger.exception("Error updating pet records")
-                
-
+def queue_date_updates(updates, pet_ids, field):
+    today = date.today()
+    for id in pet_ids:
+        updates.add("/Pets", id, {field: today})
 
-def get_available_pets_to_update(pets):
-    pets_to_update = []
-    for pet in pets:
-        pet_fields = pet["fields"]
 
-        # make sure there's no funny business
-        if (
-            "Status" in pet_fields
-            and pet_fields["Status"] not in possible_pet_statuses
-            and len(pet_fields["Status"]) > 0
-        ):
-            error_status = pet_fields["Status"]
-            id = pet["id"]
-            logger.warning(f"Unknown pet status: {error_status} id: {id}")
+def check_date_updates(results, pet_ids, field):
+    today = str(date.today())
+    updated = 0
+    for id in pet_ids:
+        fields = results.get(id)
+        if fields is None:
             continue
-        if (
-            "Status" not in pet_fields
-            or pet_fields["Status"] == ""
-        ):
-            id = pet["id"]
-            logger.warning(f"Empty/missing pet status id: {id}")
+        if fields.get(field) != today:
+            logger.error("Patch returned the wrong date.")
+            logger.error(fields)
             continue
+        updated += 1
+    return updated
 
-        # check if pet is available and available date has not been set
-        if (
-            "Status" in pet_fields
-            and pet_fields["Status"] in [
-                "Published - Available for Adoption",
-                "Adoption Pending",
-                "Adopted",
-                "Removed from Program"
-            ]
-            and (
-                "Made Available for Adoption Date" not in pet_fields
-                or not pet_fields["Made Available for Adoption Date"]
-            )
-        ):
-            pets_to_update.append(pet["id"])
-    return pets_to_update
 
+def update_date_field(pet_ids, field):
+    updates = UpdateQueue()
+    queue_date_updates(updates, pet_ids, field)
+    results = updates.flush().get("/Pets", {})
 
-def update_available_pets(pet_ids):
-    today = date.today()
-    update_records = []
-    for id in pet_ids:
-        record = {
-            "id": id,
-            "fields": {
-                "Made Available for Adoption Date": today,
-            }
-        }
-        update_records.append(record)
-
-    if len(update_records) > 0:
-        payload = {
-            "records": update_records
-        }
-        payload = json.dumps(payload, indent=4, default=str)
-        logger.info(payload)
-        url = base_url + "/Pets"
-        patch_headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + api_key
-        }
-
-        response = requests.patch(url, headers=patch_headers, data=payload)
-        logger.info(response.text)
-        if(response.status_code != requests.codes.ok):
-            logger.error("Patch failed.")
-            logger.error(response.content)
-            return False
-
-        airtable_response = response.json()
-        records = airtable_response["records"]
-        if len(records) != len(update_records):
-            logger.error("Patch returned the wrong number of records.")
-            logger.error(response.content)
-            return False
-        for record in records:
-            if (
-                record["fields"]["Made Available for Adoption Date"]
-                != str(today)
-            ):
-                logger.error("Patch returned the wrong date.")
-                logger.error(response.content)
-                return False
-    return len(update_records)
-
-
-def get_adopted_pets_to_update(pets):
-    pets_to_update = []
-    for pet in pets:
-        pet_fields = pet["fields"]
+    updated = check_date_updates(results, pet_ids, field)
+    if updated != len(pet_ids):
+        return False
+    return updated
+
+
+def plan_status_dates(pets):
+    # one pass over the pets works out every date stamp that is missing
+    pets_to_update = {field: [] for field in status_date_fields}
+    report = {
+        "unknown_status": [],
+        "missing_status": [],
+    }
 
+    for pet in as_pets(pets):
         # make sure there's no funny business
-        if (
-            "Status" in pet_fields
-            and pet_fields["Status"] not in possible_pet_statuses
-            and len(pet_fields["Status"]) > 0
-        ):
-            error_status = pet_fields["Status"]
-            id = pet["id"]
-            logger.warning(f"Unknown pet status: {error_status} id: {id}")
+        if pet.status_name and not pet.status:
+            logger.warning(f"Unknown pet status: {pet.status_name} id: {pet.id}")
+            report["unknown_status"].append(pet.id)
             continue
-        if (
-            "Status" not in pet_fields
-            or pet_fields["Status"] == ""
-        ):
-            id = pet["id"]
-            logger.warning(f"Empty/missing pet status id: {id}")
+        if not pet.status:
+            logger.warning(f"Empty/missing pet status id: {pet.id}")
+            report["missing_status"].append(pet.id)
             continue
 
-        # check if pet is adopted and adopted date has not been set
-        if (
-            "Status" in pet_fields
-            and pet_fields["Status"] == "Adopted"
-            and (
-                "Adopted Date" not in pet_fields
-                or not pet_fields["Adopted Date"]
-            )
-        ):
-            pets_to_update.append(pet["id"])
-    return pets_to_update
+        for field, statuses in status_date_fields.items():
+            if pet.status in statuses and not pet.dates[field]:
+                pets_to_update[field].append(pet.id)
 
+    return pets_to_update, report
 
-def update_adopted_pets(pet_ids):
-    today = date.today()
-    update_records = []
-    for id in pet_ids:
-        record = {
-            "id": id,
-            "fields": {
-                "Adopted Date": today,
-            }
-        }
-        update_records.append(record)
-
-    if len(update_records) > 0:
-        payload = {
-            "records": update_records
-        }
-        payload = json.dumps(payload, indent=4, default=str)
-        logger.info(payload)
-        url = base_url + "/Pets"
-        patch_headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + api_key
-        }
-
-        response = requests.patch(url, headers=patch_headers, data=payload)
-        logger.info(response.text)
-        if(response.status_code != requests.codes.ok):
-            logger.error("Patch failed.")
-            logger.error(response.content)
-            return False
-
-        airtable_response = response.json()
-        records = airtable_response["records"]
-        if len(records) != len(update_records):
-            logger.error("Patch returned the wrong number of records.")
-            logger.error(response.content)
-            return False
-        for record in records:
-            if (
-                record["fields"]["Adopted Date"]
-                != str(today)
-            ):
-                logger.error("Patch returned the wrong date.")
-                logger.error(response.content)
-                return False
-    return len(update_records)
-
-
-def get_removed_pets_to_update(pets):
-    pets_to_update = []
-    for pet in pets:
-        pet_fields = pet["fields"]
 
-        # make sure there's no funny business
-        if (
-            "Status" in pet_fields
-            and pet_fields["Status"] not in possible_pet_statuses
-            and len(pet_fields["Status"]) > 0
-        ):
-            error_status = pet_fields["Status"]
-            id = pet["id"]
-            logger.warning(f"Unknown pet status: {error_status} id: {id}")
+def get_available_pets_to_update(pets):
+    pets_to_update, _ = plan_status_dates(pets)
+    return pets_to_update["Made Available for Adoption Date"]
+
+
+def update_available_pets(pet_ids):
+    return update_date_field(pet_ids, "Made Available for Adoption Date")
+
+
+def add_adoption_contracts(records, pets_by_id, owners_by_id, updates):
+    destinations = {}
+    for app in records:
+        if app.contract_link:
             continue
-        if (
-            "Status" not in pet_fields
-            or pet_fields["Status"] == ""
-        ):
-            id = pet["id"]
-            logger.warning(f"Empty/missing pet status id: {id}")
+
+        pet = pets_by_id.get(app.pet_id)
+        owner = owners_by_id.get(pet.owner_id) if pet else None
+        destinations[app.id] = build_adoption_app_link(
+            app,
+            pet.name if pet else None,
+            pet.number if pet else None,
+            owner.name if owner else None,
+            owner.email if owner else None,
+            pet.is_dog if pet else False,
+            pet.disclaimers if pet else None,
+        )
+
+    # shorten every new contract link at once
+    short_urls = shorten_links(list(destinations.values()))
+
+    app_ids = []
+    for app_id, destination in destinations.items():
+        contract_link = short_urls.get(destination)
+        if not contract_link:
+            # leave the link empty so the next run tries again
             continue
+        updates.add("/Adoption%20Applicants", app_id, {
+            "Contract Link": contract_link,
+        })
+        app_ids.append(app_id)
 
-        # check if pet is removed and removed date has not been set
-        if (
-            "Status" in pet_fields
-            and pet_fields["Status"] == "Removed from Program"
-            and (
-                "Removed from Program Date" not in pet_fields
-                or not pet_fields["Removed from Program Date"]
-            )
-        ):
-            pets_to_update.append(pet["id"])
-    return pets_to_update
+    return app_ids
 
 
-def update_removed_pets(pet_ids):
-    today = date.today()
-    update_records = []
-    for id in pet_ids:
-        record = {
-            "id": id,
-            "fields": {
-                "Removed from Program Date": today,
-            }
-        }
-        update_records.append(record)
-
-    if len(update_records) > 0:
-        payload = {
-            "records": update_records
-        }
-        payload = json.dumps(payload, indent=4, default=str)
-        logger.info(payload)
-        url = base_url + "/Pets"
-        patch_headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + api_key
-        }
-
-        response = requests.patch(url, headers=patch_headers, data=payload)
-        logger.info(response.text)
-        if(response.status_code != requests.codes.ok):
-            logger.error("Patch failed.")
-            logger.error(response.content)
-            return False
-
-        airtable_response = response.json()
-        records = airtable_response["records"]
-        if len(records) != len(update_records):
-            logger.error("Patch returned the wrong number of records.")
-            logger.error(response.content)
-            return False
-        for record in records:
-            if (
-                record["fields"]["Removed from Program Date"]
-                != str(today)
-            ):
-                logger.error("Patch returned the wrong date.")
-                logger.error(response.content)
-                return False
-    return len(update_records)
-
-
-def add_adoption_contracts(records, pets, owners):
-    update_records = []
-    for app in records:
-        app_fields = app["fields"]
-        if (
-            "Contract Link" not in app_fields or
-            (
-                "Contract Link" in app_fields
-                and not app_fields["Contract Link"]
-            )
-        ):
-            pet_name = None
-            pet_id = None
-            is_dog = False
-            disclaimer = None
-            current_owner_name = None
-            current_owner_id = None
-            current_owner_email = None
-            if (
-                "Applied For" in app_fields
-                and app_fields["Applied For"]
-            ):
-                pet_record_id = app_fields["Applied For"][0]
-                for pet in pets:
-                    if pet_record_id == pet["id"]:
-                        pet_fields = pet["fields"]
-                        if (
-                            "Pet Name" in pet_fields
-                            and pet_fields["Pet Name"]
-                        ):
-                            pet_name = pet_fields["Pet Name"]
-                        if (
-                            "Pet ID - do not edit" in pet_fields
-                            and pet_fields["Pet ID - do not edit"]
-                        ):
-                            pet_id = pet_fields["Pet ID - do not edit"]
-                        if (
-                            "Pet Species" in pet_fields
-                            and pet_fields["Pet Species"]
-                        ):
-                            is_dog = pet_fields["Pet Species"] == "Dog"
-                        if (
-                            "Original Owner" in pet_fields
-                            and pet_fields["Original Owner"]
-                        ):
-                            current_owner_id = pet_fields["Original Owner"][0]
-                        if (
-                            "Disclaimers" in pet_fields
-                            and pet_fields["Disclaimers"]
-                        ):
-                            disclaimer = pet_fields["Disclaimers"]
-                        break
-
-                for owner in owners:
-                    if current_owner_id == owner["id"]:
-                        owner_fields = owner["fields"]
-                        if (
-                            "Name" in owner_fields
-                            and owner_fields["Name"]
-                        ):
-                            current_owner_name = owner_fields["Name"]
-                        if (
-                            "Email Address" in owner_fields
-                            and owner_fields["Email Address"]
-                        ):
-                            current_owner_email = owner_fields["Email Address"]
-
-            contract_link = get_adoption_app_link(
-                app,
-                pet_name,
-                pet_id,
-                current_owner_name,
-                current_owner_email,
-                is_dog,
-                disclaimer,
-            )
-            record = {
-                "id": app["id"],
-                "fields": {
-                    "Contract Link": contract_link,
-                }
-            }
-            update_records.append(record)
-
-    if len(update_records) > 0:
-        for i in range(0, len(update_records), 10):
-            payload = {
-                "records": update_records[i:i+10]
-            }
-            payload = json.dumps(payload, indent=4, default=str)
-            logger.info(payload)
-            url = base_url + "/Adoption%20Applicants"
-            patch_headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + api_key
-            }
-    
-            response = requests.patch(url, headers=patch_headers, data=payload)
-            logger.info(response.text)
-            if(response.status_code != requests.codes.ok):
-                logger.error("Patch failed.")
-                logger.error(response.content)
-                return False
-    
-            airtable_response = response.json()
-            records = airtable_response["records"]
-            if len(records) != 10:
-                logger.error("Patch returned the wrong number of records.")
-                logger.error(response.content)
-                return False
-
-    return len(update_records)
-
-
-def get_adoption_app_link(app, pet_name, pet_id, owner_name, owner_email, dog, disclaimer):
+def build_adoption_app_link(app, pet_name, pet_id, owner_name, owner_email, dog, disclaimer):
     link = "https://form.jotform.com/212055719626154?"
     if not dog:
         link = "https://form.jotform.com/212054429850049?"
@@ -708,306 +671,195 @@ def get_adoption_app_link(app, pet_name, pet_id, owner_name, owner_email, dog, d
     if disclaimer:
         params["petSpecific"] = disclaimer
 
-    app_fields = app["fields"]
-    if (
-        "Name" in app_fields
-        and app_fields["Name"]
-    ):
-        app_name = app_fields["Name"]
-        space = app_name.find(" ")
-        app_first_name = app_name[:space]
-        app_last_name = app_name[space:]
+    if app.name:
+        space = app.name.find(" ")
+        app_first_name = app.name[:space]
+        app_last_name = app.name[space:]
         params["input6[firstname-4]"] = app_first_name
         params["input6[lastname-4]"] = app_last_name
 
     link += urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
-
-    linkRequest = {
-        "destination": link,
-        "domain": {
-            "id": rebrandly_domain_key
-        },
-    }
-
-    requestHeaders = {
-        "Content-type": "application/json",
-        "apikey": rebrandly_api_key,
-    }
-
-    r = requests.post(
-        "https://api.rebrandly.com/v1/links",
-        data=json.dumps(linkRequest),
-        headers=requestHeaders
-    )
-
-    if (r.status_code == requests.codes.ok):
-        link = r.json()
-        logger.info("Long URL was %s, short URL is %s" % (link["destination"], link["shortUrl"]))
-        return link["shortUrl"]
-    return None
+    return link
 
 
 def get_thumbnails_to_update(pets):
-    pets_to_update = []
-    for pet in pets:
-        pet_fields = pet["fields"]
-
-        # check if pet has images but no thumbnail
-        if (
-            "Pictures" in pet_fields
-            and pet_fields["Pictures"]
-            and (
-                "ThumbnailURL" not in pet_fields
-                or not pet_fields["ThumbnailURL"]
-            )
-        ):
-            pets_to_update.append(pet["id"])
-    return pets_to_update
-
+    # pets with pictures but no thumbnail
+    return [
+        pet.id for pet in pets
+        if pet.attachments and not pet.thumbnail_url
+    ]
 
-def update_thumbnails(pets, pet_ids):
-    update_records = []
 
-    for pet in pets:
+def get_thumbnail_jobs(pets_by_id, pet_ids):
+    jobs = []
+    for pet_id in pet_ids:
         try:
-            if pet["id"] in pet_ids:
-                # get the first image
-                pet_fields = pet["fields"]
-                if (
-                    "Pictures" in pet_fields
-                    and pet_fields["Pictures"]
-                ):
-                    logger.info(f"updating thumbnail for ID {pet['id']}")
-
-                    filename_map = pet_fields.get("PictureMap-DoNotModify", "")
-                    filename_map = json.loads(filename_map)
-
-                    filename = pet_fields["Pictures"][0]["filename"]
-                    if filename in filename_map:
-                        filename = filename_map[filename]
-
-                    url = pet_fields["Pictures"][0]["url"]
-                    filename = filename.replace(" ", "_")
-                    filename = filename.replace("%20", "_")
-
-                    file_extension = os.path.splitext(filename)[1]
-                    if "pdf" in file_extension.lower():
-                        logger.warning(f"Skipping PDF image {filename}")
-                        post_to_slack(f"Pet {pet['id']} has a PDF image {filename} that needs to be converted.")
-                        continue
-
-                    thumbnail_file = thumbnail_image(url, filename)
-                    if thumbnail_file:
-                        thumbnail_url = upload_image(thumbnail_file, "new-digs-thumbnails/")
-                        os.remove("/tmp/" + thumbnail_file)
-
-                        record = {
-                            "id": pet["id"],
-                            "fields": {
-                                "ThumbnailURL": thumbnail_url,
-                            }
-                        }
-                        update_records.append(record)
+            # get the first image
+            photos = pets_by_id[pet_id].photo_filenames()
+            if photos:
+                photo, filename = photos[0]
+                url = photo.url
+
+                file_extension = os.path.splitext(filename)[1]
+                if "pdf" in file_extension.lower():
+                    logger.warning(f"Skipping PDF image {filename}")
+                    post_to_slack(f"Pet {pet_id} has a PDF image {filename} that needs to be converted.")
+                    continue
+
+                jobs.append((pet_id, url, filename))
         except Exception:
-            logger.exception(f"Error updating thumbnail for pet {pet['id']}")
-
-    count = 0
-    while len(update_records) > 0:
-        batch_size = min(10, len(update_records))
-        count += batch_size
-        update_batch = update_records[:batch_size]
-        update_records = update_records[batch_size:]
-        payload = {
-            "records": update_batch
-        }
-        payload = json.dumps(payload, indent=4, default=str)
-        logger.info(payload)
-        url = base_url + "/Pets"
-        patch_headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + api_key
-        }
-
-        response = requests.patch(url, headers=patch_headers, data=payload)
-        logger.info(response.text)
-        if(response.status_code != requests.codes.ok):
-            logger.error("Patch failed.")
-            logger.error(response.content)
-            return False
-
-        airtable_response = response.json()
-        records = airtable_response["records"]
-        if len(records) != len(update_batch):
-            logger.error("Patch returned the wrong number of records.")
-            logger.error(response.content)
-            return False
-        for record in records:
-            if (
-                not record["fields"].get("ThumbnailURL")
-            ):
-                logger.error("Upload seemed to fail.")
-                logger.error(response.content)
-                return False
-    return count
-
-
-def thumbnail_image(url, filename):
-    r = requests.get(url)
-    logger.info(filename)
-    with open('/tmp/' + filename, 'wb') as fp:
-        fp.write(r.content)
-    try:
-        with Image.open('/tmp/' + filename) as img:
-            img = ImageOps.exif_transpose(img)
-            width, height = img.size
-
-            if height < width:
-                # make square by cutting off equal amounts left and right
-                left = (width - height) / 2
-                right = (width + height) / 2
-                top = 0
-                bottom = height
-                img = img.crop((left, top, right, bottom))
-
-            elif width < height:
-                # make square by cutting off bottom
-                left = 0
-                right = width
-                top = 0
-                bottom = width
-                img = img.crop((left, top, right, bottom))
-
-            if width > 400 and height > 400:
-                img.thumbnail((400, 400))
-
-            if img.mode in ("RGBA", "P"):
-                img = img.convert("RGB")
-            img.save('/tmp/' + filename)
-    except UnidentifiedImageError:
-        logger.error("Could not open image " + filename)
-        return None
-
-    return filename
-
-
-def upload_image(filename, path):
-    logger.info(f"uploading {path}/{filename}")
-
-    s3 = boto3.client('s3')
-
-    # Upload the file
-    try:
-        s3.upload_file(
-            "/tmp/" + filename,
-            "dpa-media",
-            path + filename,
-            ExtraArgs={'ACL': 'public-read'},
+            logger.exception(f"Error updating thumbnail for pet {pet_id}")
+    return jobs
+
+
+def update_thumbnails(pets_by_id, pet_ids, updates, deadline=None):
+    jobs = get_thumbnail_jobs(pets_by_id, pet_ids)
+
+    # downloads and uploads overlap on threads while the decoding and
+    # resizing happens in worker processes; work through the backlog in
+    # chunks so only a few full size photos are held in memory at once, and
+    # send each chunk's thumbnail URLs off before starting the next so a
+    # run that runs out of time keeps what it made. only the thumbnail URLs
+    # go; the other stages' changes wait for flush_updates
+    with ThreadPoolExecutor(max_workers=io_workers) as io_pool, image_worker_pool() as image_pool:
+        def make_chunk(chunk):
+            updated_pet_ids = make_thumbnails(chunk, io_pool, image_pool, updates)
+            updates.flush(fields=["ThumbnailURL"])
+            return updated_pet_ids
+
+        updated_pet_ids, remaining = process_backlog(
+            "thumbnails",
+            jobs,
+            make_chunk,
+            key=lambda job: job[0],
+            priority=lambda job: backlog_priority(pets_by_id[job[0]]),
+            deadline=deadline,
+            chunk_size=thumbnail_chunk_size,
         )
-    except ClientError as e:
-        logging.error(e)
 
-    return "https://dpa-media.s3.us-east-2.amazonaws.com/new-digs-thumbnails/" + filename
+    if remaining:
+        logger.warning(f"{len(remaining)} thumbnails left for the next run")
+    return updated_pet_ids
 
 
-def get_photos():
-    # get the current photos
+def make_thumbnails(jobs, io_pool, image_pool, updates):
+    updated_pet_ids = []
 
-    s3 = boto3.client('s3')
+    downloads = {}
+    for pet_id, url, filename in jobs:
+        logger.info(f"updating thumbnail for ID {pet_id}")
+        downloads[io_pool.submit(download_image, url)] = (pet_id, filename)
 
-    photos = []
-
-    try:
-        paginator = s3.get_paginator("list_objects_v2")
-        page_iterator = paginator.paginate(Bucket="dpa-media", Prefix="new-digs-photos/")
-        for page in page_iterator:
-            logger.debug("response: %s", page)
+    thumbnails = {}
+    for future in as_completed(downloads):
+        pet_id, filename = downloads[future]
+        try:
+            data = future.result()
+            if data:
+                thumbnails[image_pool.submit(thumbnail_bytes, data.getvalue(), filename)] = (pet_id, filename)
+        except Exception:
+            logger.exception(f"Error downloading thumbnail image for pet {pet_id}")
 
-            contents = page.get("Contents")
-            for item in contents:
-                photos.append(item.get("Key"))
+    uploads = {}
+    for future in as_completed(thumbnails):
+        pet_id, filename = thumbnails[future]
+        try:
+            thumbnail, timings = future.result()
+            metrics.record_timings(timings)
+            if thumbnail:
+                uploads[io_pool.submit(
+                    upload_image,
+                    io.BytesIO(thumbnail),
+                    "new-digs-thumbnails/",
+                    filename,
+                )] = pet_id
+        except Exception:
+            logger.exception(f"Error making thumbnail for pet {pet_id}")
 
-    except ClientError as e:
-        logging.error(e)
+    for future in as_completed(uploads):
+        pet_id = uploads[future]
+        try:
+            thumbnail_url = future.result()
+            if thumbnail_url:
+                updates.add("/Pets", pet_id, {
+                    "ThumbnailURL": thumbnail_url,
+                })
+                updated_pet_ids.append(pet_id)
+        except Exception:
+            logger.exception(f"Error uploading thumbnail for pet {pet_id}")
 
-    return photos
+    return updated_pet_ids
 
 
-def upload_photos(photos_in_s3, pets):
-    photos_to_upload = []
+def upload_photos(photos_in_s3, pets, deadline=None):
+    # the photos are grouped by pet so a pet's photos (and its manifest) are
+    # always mirrored together
+    photos_by_pet = []
     for pet in pets:
-        pet_id = pet["id"]
-        pet_fields = pet["fields"]
-        if (
-            "Pictures" in pet_fields
-            and pet_fields["Pictures"]
-        ):
-            for photo in pet_fields["Pictures"]:
-                photo_url = photo["url"]
-
-                filename_map = pet_fields.get("PictureMap-DoNotModify", "")
-                filename_map = json.loads(filename_map)
-
-                photo_filename = photo["filename"]
-                if photo_filename in filename_map:
-                    photo_filename = filename_map[photo_filename]
-
-                photo_filename = photo_filename.replace(" ", "_")
-                photo_filename = photo_filename.replace("%20", "_")
-                photo_key = "new-digs-photos/" + pet_id + "/" + photo_filename
-                if photo_key not in photos_in_s3:
-                    logger.info(f"going to upload {photo_key}")
-                    photos_to_upload.append((photo_key, photo_url, photo_filename, pet_id))
-
-    for photo_key, photo_url, photo_filename, pet_id in photos_to_upload:
-        r = requests.get(photo_url)
-        logger.info(pet_id)
-        logger.info(photo_filename)
-        with open("/tmp/" + photo_filename, "wb") as fp:
-            fp.write(r.content)
-        upload_image(photo_filename, "new-digs-photos/" + pet_id + "/")
-        os.remove("/tmp/" + photo_filename)
-
-    return len(photos_to_upload)
+        pet_id = pet.id
+        photos_to_upload = []
+        for photo, photo_filename in pet.photo_filenames():
+            photo_key = "new-digs-photos/" + pet_id + "/" + photo_filename
+            if photo_filename not in photos_in_s3.get(pet_id, ()):
+                logger.info(f"going to upload {photo_key}")
+                photos_to_upload.append({
+                    "key": photo_key,
+                    "url": photo.url,
+                    "filename": photo_filename,
+                    "pet_id": pet_id,
+                    "attachment_id": photo.id,
+                })
+        if photos_to_upload:
+            photos_by_pet.append((pet, photos_to_upload))
+
+    def mirror_chunk(chunk):
+        photos = [photo for _, pet_photos in chunk for photo in pet_photos]
+        if content_addressed_photos:
+            return mirror_photos_content_addressed(photos)
+
+        results = mirror_photos(photos)
+        for result in results:
+            if result["uploaded"]:
+                add_to_inventory(result["pet_id"], result["filename"])
+        return results
+
+    # once per run rather than per chunk
+    abort_stale_uploads()
+    results, remaining = process_backlog(
+        "photo-uploads",
+        photos_by_pet,
+        mirror_chunk,
+        key=lambda item: item[0].id,
+        priority=lambda item: backlog_priority(item[0]),
+        deadline=deadline,
+        chunk_size=upload_chunk_size,
+    )
+
+    # the photos that weren't reached count as not uploaded, so their pets
+    # are tried again
+    for _, pet_photos in remaining:
+        for photo in pet_photos:
+            results.append({
+                "key": photo["key"],
+                "pet_id": photo["pet_id"],
+                "filename": photo["filename"],
+                "uploaded": False,
+            })
+    if remaining:
+        logger.warning(f"photos of {len(remaining)} pets left for the next run")
+    return results
 
 
 def cleanup_links(pets):
     active_pet_ids = []
 
     for pet in pets:
-        if (
-            pet.get("fields", {}).get("Status") not in [
-                "Adopted",
-                "Removed from Program"
-            ]
-        ):
-            active_pet_ids.append(str(pet.get("fields", {}).get("Pet ID - do not edit", "")))
-
-    current_links = []
-
-    requestHeaders = {
-        "Content-type": "application/json",
-        "apikey": rebrandly_api_key,
-    }
-
-    done = False
-    last_link = ""
-    while not done:
-        r = requests.get(
-            "https://api.rebrandly.com/v1/links?limit=20&last={}".format(last_link),
-            headers=requestHeaders
-        )
-
-        if (r.status_code == requests.codes.ok):
-            response = r.json()
-            current_links.extend(response)
-            if not response:
-                done = True
-            else:
-                last_link = response[-1]["id"]
+        if pet.status not in (PetStatus.ADOPTED, PetStatus.REMOVED):
+            active_pet_ids.append(str(pet.number or ""))
 
     links_to_delete = []
-    
-    for link in current_links:
+
+    for link in list_links():
         destination = link.get("destination", "")
         if "jotform" not in destination:
             continue
@@ -1024,25 +876,7 @@ def cleanup_links(pets):
             if parsed_pet_id not in active_pet_ids:
                 links_to_delete.append(link.get("id"))
 
-    batch_to_delete = []
-    for link in links_to_delete:
-        batch_to_delete.append(link)
-        if len(batch_to_delete) == 25:
-            r = requests.delete(
-                "https://api.rebrandly.com/v1/links",
-                headers=requestHeaders,
-                json={"links": batch_to_delete},
-            )
-            batch_to_delete = []
-
-    if batch_to_delete:
-        r = requests.delete(
-            "https://api.rebrandly.com/v1/links",
-            headers=requestHeaders,
-            json={"links": batch_to_delete},
-        )
-
-    return len(links_to_delete)
+    return len(delete_links(links_to_delete))
 
 
 def post_to_slack(message):
@@ -1058,10 +892,18 @@ def post_to_slack(message):
         ],
     }
 
-    webhook = json.loads(secrets_client.get_secret_value(SecretId="slack_nd_alerts_webhook")["SecretString"])
-    url = webhook.get("url")
-
-    requests.post(
-        url,
+    http_session.post(
+        get_slack_webhook_url(),
         json=message,
     )
+
+
+def get_slack_webhook_url():
+    if (
+        not slack_webhook["url"]
+        or time.monotonic() - slack_webhook["fetched"] > slack_webhook_ttl
+    ):
+        webhook = json.loads(get_secrets_client().get_secret_value(SecretId="slack_nd_alerts_webhook")["SecretString"])
+        slack_webhook["url"] = webhook.get("url")
+        slack_webhook["fetched"] = time.monotonic()
+    return slack_webhook["url"]
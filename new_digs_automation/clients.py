@@ -0,0 +1,31 @@
+import threading
+
+from .http_client import HttpClient
+from .metrics import metrics
+
+# clients are made on first use and kept at module level, so warm
+# invocations reuse them and a cold start doesn't pay for boto3 up front
+aws_clients = {}
+aws_clients_lock = threading.Lock()
+
+# attachment downloads and Slack posts share one pooled client, with the
+# same timeouts and retries as the API calls but no rate limit
+http_session = HttpClient(pool_maxsize=16)
+
+
+def get_aws_client(service):
+    # boto3 clients are thread safe once made, but making them isn't
+    with aws_clients_lock:
+        if service not in aws_clients:
+            import boto3
+            aws_clients[service] = boto3.client(service)
+            metrics.instrument_client(aws_clients[service], service)
+        return aws_clients[service]
+
+
+def get_s3():
+    return get_aws_client("s3")
+
+
+def get_secrets_client():
+    return get_aws_client("secretsmanager")
@@ -0,0 +1,168 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .images import dhash_bytes, download_image, image_worker_pool, io_workers
+from .metrics import metrics
+from .stages import process_backlog
+from .state import load_state, save_state
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# {attachment_id: dHash as hex} for every attachment seen so far, with None
+# for the ones that couldn't be downloaded or decoded so they aren't retried
+photo_hashes_name = "photo-hashes"
+# hashes at most this many bits apart are treated as the same picture
+max_hash_distance = 6
+# new attachments are hashed this many at a time, and the hashes saved after
+# each chunk, so a backlog of them carries over from run to run
+hash_chunk_size = 32
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    # finds every hash within a distance without comparing against them all
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            node_value, items, children = node
+            distance = hamming_distance(value, node_value)
+            if distance == 0:
+                items.append(item)
+                return
+            if distance not in children:
+                children[distance] = (value, [item], {})
+                return
+            node = children[distance]
+
+    def search(self, value, max_distance):
+        found = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node_value, items, children = nodes.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                found += items
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return found
+
+
+def get_attachments(pets):
+    attachments = {}
+    for pet in pets:
+        for attachment in pet.attachments:
+            attachments[attachment.id] = {
+                "pet_name": pet.name or pet.id,
+                "filename": attachment.filename,
+                "url": attachment.hash_url,
+            }
+    return attachments
+
+
+def hash_attachments(attachments, io_pool, image_pool):
+    # the hash of every attachment, or None where it couldn't be made
+    hashes = dict.fromkeys(attachments)
+    downloads = {
+        io_pool.submit(download_image, attachment["url"]): attachment_id
+        for attachment_id, attachment in attachments.items()
+    }
+    decodes = {}
+    for future in as_completed(downloads):
+        attachment_id = downloads[future]
+        try:
+            data = future.result()
+            if data:
+                decodes[image_pool.submit(dhash_bytes, data.getvalue())] = attachment_id
+        except Exception:
+            logger.exception(f"Error downloading attachment {attachment_id}")
+
+    for future in as_completed(decodes):
+        attachment_id = decodes[future]
+        try:
+            hashes[attachment_id], timings = future.result()
+            metrics.record_timings(timings)
+        except Exception:
+            logger.exception(f"Error hashing attachment {attachment_id}")
+    return hashes
+
+
+def find_duplicate_photos(pets, full_report=False, deadline=None):
+    # returns pairs of attachment ids that look like the same picture; only
+    # pairs involving a newly seen attachment unless full_report is set.
+    # new attachments that there wasn't time to hash before the deadline are
+    # hashed (and checked) by a later run
+    attachments = get_attachments(pets)
+    cached = load_state(photo_hashes_name, {})
+
+    # forget attachments that were removed from their pets
+    hashes = {
+        attachment_id: None if value is None else int(value, 16)
+        for attachment_id, value in cached.items()
+        if attachment_id in attachments
+    }
+
+    def save_hashes():
+        save_state(photo_hashes_name, {
+            attachment_id: None if value is None else format(value, "016x")
+            for attachment_id, value in hashes.items()
+        })
+
+    if len(hashes) != len(cached):
+        save_hashes()
+
+    new_attachments = [
+        (attachment_id, attachment)
+        for attachment_id, attachment in attachments.items()
+        if attachment_id not in cached
+    ]
+    new_hashes = {}
+    if new_attachments:
+        with ThreadPoolExecutor(max_workers=io_workers) as io_pool, image_worker_pool() as image_pool:
+            def hash_chunk(chunk):
+                chunk_hashes = hash_attachments(dict(chunk), io_pool, image_pool)
+                hashes.update(chunk_hashes)
+                save_hashes()
+                return list(chunk_hashes.items())
+
+            results, _ = process_backlog(
+                "photo-hashes",
+                new_attachments,
+                hash_chunk,
+                key=lambda item: item[0],
+                deadline=deadline,
+                chunk_size=hash_chunk_size,
+            )
+        new_hashes = dict(results)
+
+    # attachments that couldn't be hashed can't match anything
+    usable = {
+        attachment_id: value
+        for attachment_id, value in hashes.items()
+        if value is not None
+    }
+    tree = BKTree()
+    for attachment_id, value in usable.items():
+        tree.add(value, attachment_id)
+
+    to_check = usable if full_report else [
+        attachment_id for attachment_id, value in new_hashes.items()
+        if value is not None
+    ]
+    duplicates = set()
+    for attachment_id in to_check:
+        for other_id in tree.search(usable[attachment_id], max_hash_distance):
+            if other_id != attachment_id:
+                duplicates.add(tuple(sorted((attachment_id, other_id))))
+
+    return sorted(duplicates), attachments
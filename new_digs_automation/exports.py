@@ -0,0 +1,281 @@
+import csv
+import datetime
+import gzip
+import importlib.util
+import io
+import json
+import logging
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from .airtable import iter_table_pages
+from .clients import get_s3
+from .google_sheets import flatten_record
+from .photos import get_transfer_config
+from .stages import remaining_seconds
+from .state import load_state, save_state
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+export_bucket = "dpa-media"
+export_prefix = "new-digs-exports/"
+export_tables = [
+    "/Pets",
+    "/Adoption%20Applicants",
+    "/Participant%20Applicants",
+    "/Original%20Owners",
+]
+# remembers the day of the last complete export
+export_state_name = "table-exports"
+# rows are written in row groups of this size
+row_group_size = 5000
+# the spooled rows and the part file are kept on disk, in memory only while
+# they're this small
+spool_size = 8 * 1024 * 1024
+
+# the column types, narrowest first; an int column that sees a float becomes
+# a float column, and any other mix becomes a string column
+column_types = ["bool", "int", "float", "string"]
+
+
+def value_type(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    return "string"
+
+
+def merge_type(first, second):
+    if first is None or first == second:
+        return second
+    if {first, second} == {"int", "float"}:
+        return "float"
+    return "string"
+
+
+def cell_value(value, column_type):
+    if value is None:
+        return None
+    if column_type == "string":
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return str(value)
+    if column_type == "float":
+        return float(value)
+    return value
+
+
+def table_slug(table_name):
+    return table_name.strip("/").replace("%20", "_").lower()
+
+
+class ParquetPart:
+    extension = "parquet"
+    upload_args = {"ContentType": "application/vnd.apache.parquet"}
+
+    def __init__(self, fileobj, schema):
+        import pyarrow
+        import pyarrow.parquet
+
+        arrow_types = {
+            "bool": pyarrow.bool_(),
+            "int": pyarrow.int64(),
+            "float": pyarrow.float64(),
+            "string": pyarrow.string(),
+        }
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            (column, arrow_types[column_type])
+            for column, column_type in schema.items()
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(fileobj, self.schema, compression="snappy")
+
+    def write(self, rows):
+        self.writer.write_table(
+            self.pyarrow.Table.from_pylist(rows, schema=self.schema),
+        )
+
+    def close(self):
+        self.writer.close()
+
+
+class CsvPart:
+    extension = "csv.gz"
+    # the part is stored gzipped; clients that honor Content-Encoding get
+    # the CSV back
+    upload_args = {"ContentType": "text/csv", "ContentEncoding": "gzip"}
+
+    def __init__(self, fileobj, schema):
+        # closing the text wrapper finishes the gzip stream but leaves the
+        # part file open for uploading
+        self.text = io.TextIOWrapper(
+            gzip.GzipFile(fileobj=fileobj, mode="wb"),
+            encoding="utf-8",
+            newline="",
+        )
+        self.columns = list(schema)
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(self.columns)
+
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow([
+                "" if row.get(column) is None else row[column]
+                for column in self.columns
+            ])
+
+    def close(self):
+        self.text.close()
+
+
+def part_format():
+    # Parquet when pyarrow is installed, gzipped CSV otherwise
+    if importlib.util.find_spec("pyarrow") is None:
+        return CsvPart
+    return ParquetPart
+
+
+class TableExport:
+    # streams one table's pages into a part file under its export_date
+    # partition. every column's type has to be known before the first row is
+    # written, so the pages are spooled to a temporary file while their types
+    # are inferred, and written out once the last page is in. that way the
+    # whole partition reads as one table with one schema
+    def __init__(self, table_name, export_date, part_class=None):
+        self.table_name = table_name
+        self.prefix = (
+            f"{export_prefix}{table_slug(table_name)}/export_date={export_date}/"
+        )
+        self.part_class = part_class or part_format()
+        # None until a value of the column is seen
+        self.schema = {}
+        self.spool = tempfile.SpooledTemporaryFile(
+            max_size=spool_size,
+            mode="w+",
+            encoding="utf-8",
+        )
+        self.keys = []
+        self.rows = 0
+
+    def add_page(self, records):
+        for record in records:
+            row = flatten_record(record)
+            for column, value in row.items():
+                column_type = self.schema.get(column)
+                if value is not None:
+                    column_type = merge_type(column_type, value_type(value))
+                self.schema[column] = column_type
+            self.spool.write(json.dumps(row, default=str) + "\n")
+            self.rows += 1
+
+    def row_groups(self):
+        self.spool.seek(0)
+        rows = []
+        for line in self.spool:
+            rows.append(json.loads(line))
+            if len(rows) >= row_group_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    def write_part(self):
+        # columns only ever seen empty are still kept, as strings
+        schema = {
+            column: column_type or "string"
+            for column, column_type in sorted(self.schema.items())
+        }
+        key = f"{self.prefix}part-{len(self.keys):05d}.{self.part_class.extension}"
+        with tempfile.SpooledTemporaryFile(max_size=spool_size) as part_file:
+            part = self.part_class(part_file, schema)
+            for rows in self.row_groups():
+                part.write([
+                    {
+                        column: cell_value(row.get(column), column_type)
+                        for column, column_type in schema.items()
+                    }
+                    for row in rows
+                ])
+            part.close()
+            part_file.seek(0)
+            get_s3().upload_fileobj(
+                part_file,
+                export_bucket,
+                key,
+                ExtraArgs=dict(self.part_class.upload_args),
+                Config=get_transfer_config(),
+            )
+        self.keys.append(key)
+
+    def close(self):
+        if self.rows:
+            self.write_part()
+        self.spool.close()
+        remove_stale_parts(self.prefix, self.keys)
+        return self.keys
+
+
+def remove_stale_parts(prefix, keys):
+    # an earlier export on the same day may have written more parts
+    s3 = get_s3()
+    paginator = s3.get_paginator("list_objects_v2")
+    stale = [
+        {"Key": item["Key"]}
+        for page in paginator.paginate(Bucket=export_bucket, Prefix=prefix)
+        for item in page.get("Contents", [])
+        if item["Key"] not in keys
+    ]
+    for i in range(0, len(stale), 1000):
+        s3.delete_objects(
+            Bucket=export_bucket,
+            Delete={"Objects": stale[i:i + 1000]},
+        )
+
+
+def export_table(table_name, export_date, deadline=None):
+    export = TableExport(table_name, export_date)
+    for page in iter_table_pages(table_name):
+        left = remaining_seconds(deadline)
+        if left is not None and left <= 0:
+            # the partition is rewritten by the next run that has the time
+            raise TimeoutError(f"no time left to finish exporting {table_name}")
+        export.add_page(page)
+    keys = export.close()
+    logger.info(f"exported {export.rows} {table_name} records to {len(keys)} parts")
+    return export.rows
+
+
+def export_all_tables(export_date=None, deadline=None):
+    # returns the number of records exported from each table, None for the
+    # tables that failed
+    export_date = export_date or datetime.date.today().isoformat()
+    with ThreadPoolExecutor(max_workers=len(export_tables)) as executor:
+        futures = {
+            table_name: executor.submit(export_table, table_name, export_date, deadline)
+            for table_name in export_tables
+        }
+    rows = {}
+    for table_name, future in futures.items():
+        try:
+            rows[table_name] = future.result()
+        except Exception:
+            logger.exception(f"Exporting {table_name} failed")
+            rows[table_name] = None
+    return rows
+
+
+def export_tables_if_due(deadline=None):
+    # the tables are exported once a day, by the first run that day that
+    # gets through all of them
+    export_date = datetime.date.today().isoformat()
+    if load_state(export_state_name, {}).get("export_date") == export_date:
+        return {}
+
+    rows = export_all_tables(export_date, deadline)
+    if all(count is not None for count in rows.values()):
+        save_state(export_state_name, {"export_date": export_date})
+    return rows
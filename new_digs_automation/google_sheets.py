@@ -1,11 +1,8 @@
-import gspread
-import json
 import logging
-import requests
 
+from concurrent.futures import ThreadPoolExecutor
+from .airtable import get_table
 from .config import (
-    api_key,
-    base,
     pets_file_key,
     adoption_app_file_key,
     participant_app_file_key,
@@ -15,89 +12,181 @@ from .config import (
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-base_url = "https://api.airtable.com/v0/" + base
-headers = {"Authorization": "Bearer " + api_key}
-
 fields_to_ignore = ["Pictures", "Medical Records"]
 
+# the spreadsheet each table is mirrored to
+sheet_tables = [
+    (pets_file_key, "/Pets"),
+    (adoption_app_file_key, "/Adoption%20Applicants"),
+    (participant_app_file_key, "/Participant%20Applicants"),
+    (original_owners_file_key, "/Original%20Owners"),
+]
+
 
 def google_sheets_synchronization():
+    # gspread pulls in the Google auth stack, so only load it when syncing
+    import gspread
+
     sheets = gspread.service_account(filename="new_digs_automation/service_account.json")
-    total_rows = 0
-    total_rows += sync_sheet(sheets, pets_file_key, "/Pets")
-    total_rows += sync_sheet(sheets, adoption_app_file_key, "/Adoption%20Applicants")
-    total_rows += sync_sheet(sheets, participant_app_file_key, "/Participant%20Applicants")
-    total_rows += sync_sheet(sheets, original_owners_file_key, "/Original%20Owners")
-    return total_rows
 
+    # the tables are independent, so export them side by side
+    with ThreadPoolExecutor(max_workers=len(sheet_tables)) as executor:
+        rows = executor.map(
+            lambda sheet_table: sync_sheet(sheets, *sheet_table),
+            sheet_tables,
+        )
+        return sum(rows)
+
+
+def flatten_record(record):
+    # the values that fit in a cell: no attachments and no linked records
+    output_record = {
+        "id": record["id"],
+        "createdTime": record["createdTime"],
+    }
+    for field, value in record["fields"].items():
+        if field not in fields_to_ignore and type(value) is not list:
+            output_record[field] = value
+    return output_record
+
+
+def table_rows(records):
+    # a header row of every field any record has, then a row per record
+    table_data = []
+    fields = set()
+    for record in records:
+        output_record = flatten_record(record)
+        fields.update(output_record)
+        table_data.append(output_record)
 
-def sync_sheet(sheets, file_key, table_name):
-    file = sheets.open_by_key(file_key)
-    sheet = file.get_worksheet(0)
+    field_list = sorted(fields)
+    output_data = [field_list]
+    for record in table_data:
+        output_data.append([record.get(field, "") for field in field_list])
+    return output_data
 
-    url = base_url + table_name
 
-    # get data from Airtable
-    response = requests.get(url, headers=headers)
-    logger.info(json.dumps(json.loads(response.text)))
-    if(response.status_code != requests.codes.ok):
-        logger.error("Airtable response: ")
-        logger.error(response)
-        logger.error("URL: " + url)
-        logger.error("Headers: " + str(headers))
+def sync_sheet(sheets, file_key, table_name):
+    # get data from Airtable, every page of it
+    try:
+        records = get_table(table_name)
+    except Exception:
+        logger.exception(f"Fetching {table_name} for Google Sheets failed")
         return 0
 
-    airtable_response = response.json()
-
-    records = airtable_response.get("records")
     if not records:
         logger.info(f"No records found for table {table_name}")
         return 0
-    number_of_records = len(records)
-
-    # sort the data into a list of dicts
-    table_data = []
-
-    for record in records:
-        output_record = {
-            "id": record["id"],
-            "createdTime": record["createdTime"],
-        }
-        for field in record["fields"]:
-            if (
-                field not in fields_to_ignore
-                and type(record["fields"][field]) is not list
-            ):
-                output_record[field] = record["fields"][field]
-        table_data.append(output_record)
-
-    # get field list
-    field_list = []
-    for record in table_data:
-        for field in record:
-            field_list.append(field)
-    field_list = sorted(list(set(field_list)))
-
-    # the output data for google sheets should be a list of lists
-    output_data = []
-    # first row is headers aka fields
-    output_data.append(field_list)
-    # now add all the data
-    for record in table_data:
-        record_data = []
-        for field in field_list:
-            record_data.append(record.get(field, ""))
-        output_data.append(record_data)
 
+    output_data = table_rows(records)
     output_rows_len = len(output_data)
-
     logger.info(f"writing out {output_rows_len} rows for {table_name}")
-    if number_of_records + 1 != output_rows_len:
-        logger.error("Number of records/rows mismatch")
-        logger.error(f"Expected {number_of_records} + 1 rows")
-        return 0
 
-    # finally write it all out to sheets
-    sheet.update("A1", output_data)
+    file = sheets.open_by_key(file_key)
+    sheet = file.get_worksheet(0)
+
+    # only send the cells that differ from what's in the sheet now; reading
+    # the values unformatted gives numbers and booleans back as they were
+    # written, so they compare equal to the Airtable values
+    current_data = sheet.get_all_values(value_render_option="UNFORMATTED_VALUE")
+    updates = sheet_updates(current_data, output_data)
+    logger.info(f"sending {len(updates)} changed ranges for {table_name}")
+    if updates:
+        sheet.batch_update(updates)
 
     return output_rows_len
+
+
+def sheet_updates(current_data, output_data):
+    # works out the value ranges that turn the sheet's current_data into
+    # output_data, with rows matched up by record id. rows of deleted
+    # records are reused for new records, or filled with the last rows of
+    # the sheet, and whatever is left past the end is blanked out, so the
+    # rows stay together at the top of the sheet without moving the rest
+    header = output_data[0]
+    width = len(header)
+    if not current_data or current_data[0] != header:
+        # the columns moved, so rewrite the whole sheet over the old one
+        old_width = max((len(row) for row in current_data), default=0)
+        padded_width = max(width, old_width)
+        rows = [row + [""] * (padded_width - len(row)) for row in output_data]
+        rows += [[""] * padded_width] * (len(current_data) - len(output_data))
+        return [{"range": "A1", "values": rows}]
+
+    id_column = header.index("id")
+    current_rows = [
+        list(row) + [""] * (width - len(row))
+        for row in current_data[1:]
+    ]
+    new_rows = output_data[1:]
+    new_rows_by_id = {row[id_column]: row for row in new_rows}
+
+    kept = {}
+    free = []
+    for index, row in enumerate(current_rows):
+        record_id = row[id_column]
+        if record_id in new_rows_by_id and record_id not in kept:
+            kept[record_id] = index
+        else:
+            free.append(index)
+
+    # the record rows have to end up in the first len(new_rows) rows
+    row_count = len(new_rows)
+    to_place = [
+        record_id for record_id, index in kept.items() if index >= row_count
+    ]
+    to_place += [row[id_column] for row in new_rows if row[id_column] not in kept]
+    free = [index for index in free if index < row_count]
+    free += range(len(current_rows), row_count)
+
+    full_rows = {}
+    for record_id, index in zip(to_place, free):
+        kept[record_id] = index
+        full_rows[index] = new_rows_by_id[record_id]
+    for index in range(row_count, len(current_rows)):
+        full_rows[index] = [""] * width
+
+    updates = []
+    for record_id, index in kept.items():
+        if index in full_rows:
+            continue
+        current_row = current_rows[index]
+        new_row = new_rows_by_id[record_id]
+        changed = [
+            column for column in range(width)
+            if current_row[column] != new_row[column]
+        ]
+        if changed:
+            first, last = changed[0], changed[-1]
+            updates.append({
+                "range": cell_name(index + 2, first + 1),
+                "values": [new_row[first:last + 1]],
+            })
+
+    # runs of whole rows go in one range each
+    run = []
+    for index in sorted(full_rows):
+        if run and index != run[-1] + 1:
+            updates.append(full_rows_range(run, full_rows))
+            run = []
+        run.append(index)
+    if run:
+        updates.append(full_rows_range(run, full_rows))
+
+    return updates
+
+
+def full_rows_range(indexes, full_rows):
+    return {
+        "range": cell_name(indexes[0] + 2, 1),
+        "values": [full_rows[index] for index in indexes],
+    }
+
+
+def cell_name(row, column):
+    # the A1 name of a cell, from 1-based row and column numbers
+    letters = ""
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return f"{letters}{row}"
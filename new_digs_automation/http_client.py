@@ -0,0 +1,236 @@
+import email.utils
+import logging
+import random
+import requests
+import threading
+import time
+import urllib.parse
+
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from .metrics import metrics
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# (connect, read) seconds; a connect that takes longer than a few seconds
+# won't succeed, but a big page or download can take a while to read
+default_timeout = (3.05, 30)
+# statuses worth another try: rate limited, or the upstream having a bad moment
+retry_statuses = frozenset([429, 500, 502, 503, 504])
+# methods that are safe to send again after they may have reached the host.
+# the PATCHes sent here only set fields, so repeating one changes nothing;
+# a repeated POST could make a second short link or Slack alert, so POSTs
+# are only resent when they never got through (or were rate limited)
+idempotent_methods = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE", "PATCH"])
+max_retries = 4
+# the backoff before retry n is a random wait of up to
+# backoff_base * 2 ** n seconds, capped at max_backoff
+backoff_base = 0.5
+max_backoff = 30
+# a Retry-After longer than this isn't waited out; the response is returned
+# as it is so the caller fails now rather than after the Lambda's deadline
+max_retry_after = 60
+# consecutive failed requests to a host that open its circuit, and how long
+# it stays open before one request is let through to try it again
+failure_threshold = 5
+reset_timeout = 30
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    # stops sending requests to a host that keeps failing, so a run that's
+    # down to its last few seconds doesn't spend them on retries that won't
+    # work. rate limiting (429) is the upstream working as intended and
+    # doesn't count as a failure
+    def __init__(self, threshold=failure_threshold, timeout=reset_timeout):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened < self.timeout or self.trial:
+                return False
+            # half open: let one request through to see if the host is back
+            self.trial = True
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened = time.monotonic()
+            self.trial = False
+
+
+def retry_after(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def connect_failed(error):
+    # the connection was never made, so nothing was sent
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def backoff(attempt):
+    return random.uniform(0, min(max_backoff, backoff_base * 2 ** attempt))
+
+
+class HttpClient:
+    # a pooled session that spaces requests out to each host's rate limit,
+    # retries transient failures with jittered exponential backoff (or as
+    # long as Retry-After asks), times out stuck connections and stops
+    # calling hosts that keep failing. failures that outlast the retries
+    # come back as the last response, or raise the last connection error.
+    # rate_limited_waits is how long to wait after a 429 from a host that
+    # doesn't say in Retry-After, for hosts that lock clients out for a while
+    def __init__(
+        self,
+        headers=None,
+        rate_limits=None,
+        rate_limited_waits=None,
+        pool_maxsize=10,
+        timeout=default_timeout,
+    ):
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        self.session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize),
+        )
+        metrics.instrument_session(self.session)
+        self.timeout = timeout
+        # no bursts: a full bucket plus its refill would put twice the rate
+        # into one second
+        self.rate_limiters = {
+            host: TokenBucket(rate, 1)
+            for host, rate in (rate_limits or {}).items()
+        }
+        self.rate_limited_waits = dict(rate_limited_waits or {})
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker()
+            return self.breakers[host]
+
+    def request(self, method, url, **kwargs):
+        host = urllib.parse.urlparse(url).hostname
+        breaker = self.breaker(host)
+        rate_limiter = self.rate_limiters.get(host)
+        kwargs.setdefault("timeout", self.timeout)
+        idempotent = method.upper() in idempotent_methods
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(f"Too many failed requests to {host}, not trying again yet")
+            if rate_limiter:
+                rate_limiter.acquire()
+
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                breaker.failed()
+                if attempt >= max_retries or not (idempotent or connect_failed(error)):
+                    raise
+                logger.warning(f"{method} {host} failed, retrying", exc_info=True)
+                time.sleep(backoff(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code not in retry_statuses:
+                breaker.succeeded()
+                return response
+
+            rate_limited = response.status_code == requests.codes.too_many_requests
+            if rate_limited:
+                breaker.succeeded()
+            else:
+                breaker.failed()
+                if not idempotent:
+                    return response
+
+            wait = retry_after(response)
+            if wait is None and rate_limited:
+                wait = self.rate_limited_waits.get(host)
+            if wait is None:
+                wait = backoff(attempt)
+            if attempt >= max_retries or wait > max_retry_after:
+                return response
+
+            logger.warning(
+                f"{method} {host} returned {response.status_code}, "
+                f"retrying in {wait:.1f}s"
+            )
+            response.close()
+            time.sleep(wait)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
@@ -0,0 +1,203 @@
+import io
+import logging
+import multiprocessing
+import os
+import requests
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .clients import http_session
+from .metrics import timed
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+thumbnail_size = 400
+download_chunk_size = 64 * 1024
+# widths of the responsive variants made for every picture
+variant_widths = [200, 400, 800, 1600]
+variant_quality = 80
+# downloads and uploads are network bound and can run well past the core count
+io_workers = 8
+
+
+def download_image(url):
+    # stream into memory rather than holding the response and a /tmp copy
+    buffer = io.BytesIO()
+    with http_session.get(url, stream=True) as r:
+        if r.status_code != requests.codes.ok:
+            logger.error(f"Downloading {url} failed with status code {r.status_code}")
+            return None
+        for chunk in r.iter_content(chunk_size=download_chunk_size):
+            buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+
+def image_format(filename, default=None):
+    from PIL import Image
+
+    extension = os.path.splitext(filename)[1].lower()
+    return Image.registered_extensions().get(extension, default)
+
+
+def make_thumbnail(data, filename, timings=None):
+    # Pillow is only imported once there's an image to work on
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    timings = {} if timings is None else timings
+    try:
+        with Image.open(data) as img:
+            output_format = image_format(filename, img.format)
+
+            # let the JPEG decoder scale down while decoding so a large photo
+            # is never fully decoded just to be thrown away
+            with timed(timings, "image_decode"):
+                img.draft(None, (thumbnail_size, thumbnail_size))
+                img.load()
+
+            img = ImageOps.exif_transpose(img)
+            width, height = img.size
+
+            if height < width:
+                # make square by cutting off equal amounts left and right
+                left = (width - height) / 2
+                right = (width + height) / 2
+                top = 0
+                bottom = height
+                img = img.crop((left, top, right, bottom))
+
+            elif width < height:
+                # make square by cutting off bottom
+                left = 0
+                right = width
+                top = 0
+                bottom = width
+                img = img.crop((left, top, right, bottom))
+
+            if width > thumbnail_size and height > thumbnail_size:
+                with timed(timings, "image_resize"):
+                    img.thumbnail((thumbnail_size, thumbnail_size))
+
+            if img.mode in ("RGBA", "P"):
+                img = img.convert("RGB")
+
+            output = io.BytesIO()
+            with timed(timings, "image_encode"):
+                img.save(output, format=output_format)
+    except UnidentifiedImageError:
+        logger.error("Could not open image " + filename)
+        return None
+
+    output.seek(0)
+    return output
+
+
+def thumbnail_bytes(data, filename):
+    # runs in a worker process, so it takes and returns plain bytes, along
+    # with its timings since the worker's own metrics would be lost
+    timings = {}
+    output = make_thumbnail(io.BytesIO(data), filename, timings)
+    if not output:
+        return None, timings
+    return output.getvalue(), timings
+
+
+def image_worker_pool():
+    workers = os.cpu_count() or 1
+    # forked workers would inherit the HTTP pools and any lock another
+    # thread was holding at the time; forkserver starts them from a clean
+    # process instead
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    try:
+        return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    except (OSError, NotImplementedError):
+        # Lambda has no /dev/shm for the process pool's semaphores; Pillow
+        # releases the GIL while decoding and resizing so threads still help
+        logger.info("process pool unavailable, decoding images on threads")
+        return ThreadPoolExecutor(max_workers=workers)
+
+
+def make_variants(data, filename, widths=None, avif=False, timings=None):
+    # decodes the picture once and returns (name, bytes, width) for every
+    # size and format, largest first
+    from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+    timings = {} if timings is None else timings
+    widths = sorted(widths or variant_widths, reverse=True)
+    formats = [("webp", "WEBP")]
+    if avif:
+        if features.check("avif"):
+            formats.append(("avif", "AVIF"))
+        else:
+            logger.warning("Pillow was built without AVIF support, skipping AVIF variants")
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            with timed(timings, "image_decode"):
+                img.draft(None, (widths[0], widths[0]))
+                img.load()
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+
+            # never upscale, but always make at least one variant
+            sizes = [width for width in widths if width < img.width] or [img.width]
+            if sizes[0] != img.width and widths[0] >= img.width:
+                sizes.insert(0, img.width)
+
+            variants = []
+            for width in sizes:
+                # each size is resized from the previous, larger one
+                if width != img.width:
+                    height = max(1, round(img.height * width / img.width))
+                    with timed(timings, "image_resize"):
+                        img = img.resize((width, height), Image.LANCZOS)
+                for extension, output_format in formats:
+                    output = io.BytesIO()
+                    with timed(timings, "image_encode"):
+                        img.save(output, format=output_format, quality=variant_quality)
+                    variants.append((f"{width}w.{extension}", output.getvalue(), width))
+    except UnidentifiedImageError:
+        logger.error("Could not open image " + filename)
+        return None
+
+    return variants
+
+
+def variants_bytes(data, filename, widths=None, avif=False):
+    # the variant counterpart of thumbnail_bytes for the worker pool
+    timings = {}
+    return make_variants(data, filename, widths, avif, timings), timings
+
+
+def dhash_bytes(data):
+    # the hashing counterpart of thumbnail_bytes for the worker pool
+    timings = {}
+    with timed(timings, "image_hash"):
+        value = dhash(data)
+    return value, timings
+
+
+def dhash(data, hash_size=8):
+    # difference hash: one bit per horizontally adjacent pixel pair of a tiny
+    # greyscale copy, so resized or recompressed copies land a few bits apart
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft("L", (hash_size * 8, hash_size * 8))
+            img = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+            pixels = img.tobytes()
+    except UnidentifiedImageError:
+        return None
+
+    value = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
@@ -0,0 +1,250 @@
+import bisect
+import io
+import json
+import logging
+import threading
+import time
+import urllib.parse
+
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+emf_namespace = "NewDigsAutomation"
+# upper bounds of the request latency histogram buckets, in milliseconds
+latency_buckets_ms = [50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# EMF accepts at most 100 values per metric in a document
+max_emf_values = 100
+# the upstream each request is counted under, by host
+upstream_hosts = {
+    "api.airtable.com": "airtable",
+    "api.rebrandly.com": "rebrandly",
+    "hooks.slack.com": "slack",
+}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.upstreams = {}
+            self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def record_request(self, upstream, seconds, size, failed=False):
+        with self.lock:
+            upstream_metrics = self.upstreams.setdefault(upstream, {
+                "requests": 0,
+                "errors": 0,
+                "bytes": 0,
+                "latencies_ms": [],
+            })
+            upstream_metrics["requests"] += 1
+            upstream_metrics["errors"] += int(failed)
+            upstream_metrics["bytes"] += size
+            upstream_metrics["latencies_ms"].append(seconds * 1000)
+
+    def record_timings(self, timings):
+        # timings is {name: seconds}, such as the image decode and encode
+        # times sent back by the worker pool
+        with self.lock:
+            for name, seconds in timings.items():
+                timing = self.timings.setdefault(name, {"count": 0, "seconds": 0, "max_seconds": 0})
+                timing["count"] += 1
+                timing["seconds"] += seconds
+                timing["max_seconds"] = max(timing["max_seconds"], seconds)
+
+    def response_hook(self, r, *args, **kwargs):
+        # requests calls this for every response on the instrumented sessions.
+        # bytes counts what was sent as well as received; a streamed body
+        # hasn't been read yet, so its size comes from Content-Length
+        host = urllib.parse.urlparse(r.url).hostname or ""
+        upstream = upstream_hosts.get(host, "downloads")
+        received = int(r.headers.get("Content-Length") or 0)
+        if not received and not kwargs.get("stream"):
+            received = len(r.content)
+        self.record_request(
+            upstream,
+            r.elapsed.total_seconds(),
+            body_size(r.request.body, r.request.headers) + received,
+            failed=r.status_code >= 400,
+        )
+
+    def instrument_session(self, session):
+        session.hooks["response"].append(self.response_hook)
+
+    def instrument_client(self, client, upstream):
+        def before_call(context, params, **kwargs):
+            context["metrics_started"] = time.perf_counter()
+            # uploads are most of the S3 traffic, and only their request
+            # says how big they are
+            context["metrics_sent"] = body_size(params.get("body"), params.get("headers"))
+
+        def after_call(http_response, context, **kwargs):
+            started = context.get("metrics_started")
+            if started is None:
+                return
+            self.record_request(
+                upstream,
+                time.perf_counter() - started,
+                context.get("metrics_sent", 0)
+                + int(http_response.headers.get("Content-Length") or 0),
+                failed=http_response.status_code >= 400,
+            )
+
+        client.meta.events.register("before-call.*.*", before_call)
+        client.meta.events.register("after-call.*.*", after_call)
+
+    def summary(self):
+        with self.lock:
+            return {
+                "stages_seconds": {
+                    name: round(seconds, 3) for name, seconds in self.stages.items()
+                },
+                "upstreams": {
+                    upstream: upstream_summary(upstream_metrics)
+                    for upstream, upstream_metrics in self.upstreams.items()
+                },
+                "timings": {
+                    name: {
+                        "count": timing["count"],
+                        "seconds": round(timing["seconds"], 3),
+                        "max_seconds": round(timing["max_seconds"], 3),
+                    }
+                    for name, timing in self.timings.items()
+                },
+            }
+
+    def emf_documents(self):
+        # CloudWatch Embedded Metric Format, one document per dimension value
+        timestamp = int(time.time() * 1000)
+        with self.lock:
+            stages = dict(self.stages)
+            upstreams = {
+                upstream: dict(upstream_metrics, latencies_ms=list(upstream_metrics["latencies_ms"]))
+                for upstream, upstream_metrics in self.upstreams.items()
+            }
+
+        documents = []
+        for name, seconds in stages.items():
+            documents.append(emf_document(timestamp, "Stage", name, {
+                "StageDuration": (seconds * 1000, "Milliseconds"),
+            }))
+        for upstream, upstream_metrics in upstreams.items():
+            documents.append(emf_document(timestamp, "Upstream", upstream, {
+                "Requests": (upstream_metrics["requests"], "Count"),
+                "Errors": (upstream_metrics["errors"], "Count"),
+                "Bytes": (upstream_metrics["bytes"], "Bytes"),
+                "Latency": (upstream_metrics["latencies_ms"][-max_emf_values:], "Milliseconds"),
+            }))
+        return documents
+
+    def emit(self, emf=False):
+        summary = self.summary()
+        logger.info(json.dumps({"metrics": summary}))
+        if emf:
+            # EMF has to be the whole log line, which the logging module's
+            # Lambda formatter wouldn't leave alone
+            for document in self.emf_documents():
+                print(json.dumps(document), flush=True)
+        return summary
+
+
+def upstream_summary(upstream_metrics):
+    latencies = sorted(upstream_metrics["latencies_ms"])
+    histogram = [0] * (len(latency_buckets_ms) + 1)
+    for latency in latencies:
+        histogram[bisect.bisect_left(latency_buckets_ms, latency)] += 1
+
+    labels = [f"<={bucket}" for bucket in latency_buckets_ms] + [f">{latency_buckets_ms[-1]}"]
+    return {
+        "requests": upstream_metrics["requests"],
+        "errors": upstream_metrics["errors"],
+        "bytes": upstream_metrics["bytes"],
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 1),
+            "p90": round(percentile(latencies, 90), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "max": round(latencies[-1], 1) if latencies else 0,
+            "histogram": dict(zip(labels, histogram)),
+        },
+    }
+
+
+def body_size(body, headers=None):
+    if not body:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    length = (headers or {}).get("Content-Length")
+    if length:
+        return int(length)
+    # file like bodies, such as the chunks of a multipart upload
+    try:
+        return len(body)
+    except TypeError:
+        pass
+    try:
+        position = body.tell()
+        end = body.seek(0, io.SEEK_END)
+        body.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[index]
+
+
+def emf_document(timestamp, dimension, value, values):
+    document = {
+        "_aws": {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [{
+                "Namespace": emf_namespace,
+                "Dimensions": [[dimension]],
+                "Metrics": [
+                    {"Name": name, "Unit": unit}
+                    for name, (_, unit) in values.items()
+                ],
+            }],
+        },
+        dimension: value,
+    }
+    for name, (metric_value, _) in values.items():
+        document[name] = metric_value
+    return document
+
+
+@contextmanager
+def timed(timings, name):
+    # adds the time spent in the block to timings[name]
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - started
+
+
+# one set of metrics per run, reset at the start of each invocation
+metrics = Metrics()
@@ -0,0 +1,355 @@
+import datetime
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import requests
+import tempfile
+import threading
+
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from .clients import get_s3, http_session
+from .records import as_pet
+from .state import load_state, save_state
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+photo_bucket = "dpa-media"
+photo_prefix = "new-digs-photos/"
+mirror_workers = 8
+# anything bigger than this goes up in parts, straight from the download
+multipart_size = 8 * 1024 * 1024
+transfer_config = None
+# keys already in S3 under each pet's prefix, kept between warm invocations
+photo_inventory = {}
+# re-list a pet's prefix once its cached listing is this old, so photos
+# removed outside this automation are noticed
+inventory_ttl = datetime.timedelta(hours=6)
+# past this many prefixes one listing of the whole photo prefix is cheaper
+max_prefix_listings = 50
+# {pet_id: picture fingerprint} as of the last run that fully handled the pet
+picture_fingerprints_name = "picture-fingerprints"
+# with content addressed storage each distinct photo is stored once under
+# new-digs-photos/sha256/ and pets reference it through a manifest
+content_addressed_folder = "sha256"
+photo_manifest_name = "photo-manifest"
+photo_base_url = "https://dpa-media.s3.us-east-2.amazonaws.com/"
+# photos are hashed in memory up to this size, and spill to /tmp beyond it
+spool_size = 8 * 1024 * 1024
+# a multipart upload this old was left behind by a run that was cut short
+stale_upload_age = datetime.timedelta(days=1)
+
+
+def get_transfer_config():
+    global transfer_config
+    if transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+        transfer_config = TransferConfig(
+            multipart_threshold=multipart_size,
+            multipart_chunksize=multipart_size,
+            max_concurrency=2,
+        )
+    return transfer_config
+
+
+def get_pets_with_changed_pictures(pets, fingerprints):
+    changed = []
+    for pet in pets:
+        parsed = as_pet(pet)
+        if fingerprints.get(parsed.id) != parsed.picture_fingerprint():
+            changed.append(pet)
+    return changed
+
+
+def upload_image(fileobj, path, filename):
+    logger.info(f"uploading {path}{filename}")
+
+    extra_args = {"ACL": "public-read"}
+    content_type, _ = mimetypes.guess_type(filename)
+    if content_type:
+        extra_args["ContentType"] = content_type
+
+    # Upload the file
+    try:
+        get_s3().upload_fileobj(
+            fileobj,
+            photo_bucket,
+            path + filename,
+            ExtraArgs=extra_args,
+        )
+    except ClientError as e:
+        logger.error(e)
+        return None
+
+    return photo_base_url + path + filename
+
+
+def mirror_photo(photo_key, photo_url, photo_filename):
+    extra_args = {"ACL": "public-read"}
+    content_type, _ = mimetypes.guess_type(photo_filename)
+    if content_type:
+        extra_args["ContentType"] = content_type
+
+    with http_session.get(photo_url, stream=True) as r:
+        if r.status_code != requests.codes.ok:
+            logger.error(f"Downloading {photo_url} failed with status code {r.status_code}")
+            return False
+        r.raw.decode_content = True
+        # a failed multipart upload is aborted, so the key is either complete
+        # or missing and the next run picks it up again
+        get_s3().upload_fileobj(
+            r.raw,
+            photo_bucket,
+            photo_key,
+            ExtraArgs=extra_args,
+            Config=get_transfer_config(),
+        )
+    return True
+
+
+def mirror_photos(photos):
+    def mirror(photo):
+        logger.info(f"uploading {photo['key']}")
+        # a dropped download surfaces from urllib3 and a failed multipart
+        # upload from boto3, and neither should take the other photos with it
+        try:
+            uploaded = mirror_photo(photo["key"], photo["url"], photo["filename"])
+        except Exception:
+            logger.exception(f"Error uploading {photo['key']}")
+            uploaded = False
+        return {
+            "key": photo["key"],
+            "pet_id": photo["pet_id"],
+            "filename": photo["filename"],
+            "uploaded": uploaded,
+        }
+
+    if not photos:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(mirror_workers, len(photos))) as executor:
+        results = list(executor.map(mirror, photos))
+
+    failed = [result["key"] for result in results if not result["uploaded"]]
+    if failed:
+        logger.error(f"{len(failed)} photos failed to upload: {failed}")
+    return results
+
+
+def abort_stale_uploads():
+    # parts of uploads cut off by a timeout are billed until they're aborted
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - stale_upload_age
+    try:
+        paginator = get_s3().get_paginator("list_multipart_uploads")
+        for page in paginator.paginate(Bucket=photo_bucket, Prefix=photo_prefix):
+            for upload in page.get("Uploads", []):
+                if upload["Initiated"] < cutoff:
+                    logger.info(f"aborting stale upload of {upload['Key']}")
+                    get_s3().abort_multipart_upload(
+                        Bucket=photo_bucket,
+                        Key=upload["Key"],
+                        UploadId=upload["UploadId"],
+                    )
+    except ClientError as e:
+        logger.error(e)
+
+
+def get_photo_inventory(pet_ids=None):
+    # returns {pet_id: set of filenames} for the given pets, or every pet
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if pet_ids is None:
+        stale = None
+    else:
+        stale = [
+            pet_id for pet_id in pet_ids
+            if pet_id not in photo_inventory
+            or now - photo_inventory[pet_id]["listed"] > inventory_ttl
+        ]
+
+    if stale is None or len(stale) > max_prefix_listings:
+        list_photo_prefix(photo_prefix, now, stale)
+    elif stale:
+        with ThreadPoolExecutor(max_workers=mirror_workers) as executor:
+            list(executor.map(
+                lambda pet_id: list_photo_prefix(photo_prefix + pet_id + "/", now, [pet_id]),
+                stale,
+            ))
+
+    if pet_ids is None:
+        pet_ids = photo_inventory.keys()
+    return {
+        pet_id: photo_inventory[pet_id]["keys"]
+        for pet_id in pet_ids
+        if pet_id in photo_inventory
+    }
+
+
+def list_photo_prefix(prefix, listed, pet_ids=None):
+    # a pet missing from the listing has nothing uploaded (any more), be it
+    # one of pet_ids or, when the whole prefix is listed, one already cached
+    keys_by_pet = {pet_id: set() for pet_id in pet_ids or ()}
+    if prefix == photo_prefix:
+        keys_by_pet.update({cached_pet_id: set() for cached_pet_id in photo_inventory})
+
+    try:
+        paginator = get_s3().get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=photo_bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                key_pet_id, _, filename = item["Key"][len(photo_prefix):].partition("/")
+                if filename:
+                    keys_by_pet.setdefault(key_pet_id, set()).add(filename)
+    except ClientError as e:
+        logger.error(e)
+        return
+
+    for key_pet_id, keys in keys_by_pet.items():
+        photo_inventory[key_pet_id] = {"keys": keys, "listed": listed}
+
+
+def add_to_inventory(pet_id, photo_filename):
+    entry = photo_inventory.get(pet_id)
+    if entry:
+        entry["keys"].add(photo_filename)
+
+
+def get_content_addressed_inventory():
+    # returns {pet_id: set of filenames} already referenced by the manifest
+    manifest = load_state(photo_manifest_name, {"photos": {}, "attachments": {}})
+    photos = {}
+    for reference in manifest["photos"]:
+        pet_id, _, filename = reference.partition("/")
+        photos.setdefault(pet_id, set()).add(filename)
+    return photos
+
+
+def mirror_photos_content_addressed(photos):
+    manifest = load_state(photo_manifest_name, {"photos": {}, "attachments": {}})
+    stored = get_photo_inventory([content_addressed_folder]).get(
+        content_addressed_folder, set()
+    )
+    lock = threading.Lock()
+
+    def mirror(photo):
+        # an attachment that was already stored doesn't need downloading again
+        digest_key = manifest["attachments"].get(photo["attachment_id"])
+        try:
+            if not digest_key:
+                digest_key = store_by_digest(photo, stored, lock)
+        except Exception:
+            logger.exception(f"Error uploading {photo['key']}")
+
+        if digest_key:
+            with lock:
+                manifest["photos"][photo["pet_id"] + "/" + photo["filename"]] = digest_key
+                manifest["attachments"][photo["attachment_id"]] = digest_key
+        return {
+            "key": digest_key,
+            "pet_id": photo["pet_id"],
+            "filename": photo["filename"],
+            "uploaded": bool(digest_key),
+        }
+
+    if not photos:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(mirror_workers, len(photos))) as executor:
+        results = list(executor.map(mirror, photos))
+
+    save_state(photo_manifest_name, manifest)
+    write_pet_manifests(
+        {result["pet_id"] for result in results if result["uploaded"]},
+        manifest,
+    )
+    return results
+
+
+def store_by_digest(photo, stored, lock):
+    with http_session.get(photo["url"], stream=True) as r:
+        if r.status_code != requests.codes.ok:
+            logger.error(f"Downloading {photo['url']} failed with status code {r.status_code}")
+            return None
+
+        # hash while buffering, since the key depends on the whole photo
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=spool_size) as buffer:
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                digest.update(chunk)
+                buffer.write(chunk)
+
+            extension = os.path.splitext(photo["filename"])[1].lower()
+            filename = digest.hexdigest() + extension
+            digest_key = photo_prefix + content_addressed_folder + "/" + filename
+
+            with lock:
+                already_stored = filename in stored
+                stored.add(filename)
+            if already_stored:
+                logger.info(f"{photo['key']} is already stored as {digest_key}")
+                return digest_key
+
+            extra_args = {
+                "ACL": "public-read",
+                "Metadata": {"sha256": digest.hexdigest()},
+            }
+            content_type, _ = mimetypes.guess_type(photo["filename"])
+            if content_type:
+                extra_args["ContentType"] = content_type
+
+            buffer.seek(0)
+            try:
+                get_s3().upload_fileobj(
+                    buffer,
+                    photo_bucket,
+                    digest_key,
+                    ExtraArgs=extra_args,
+                    Config=get_transfer_config(),
+                )
+            except Exception:
+                with lock:
+                    stored.discard(filename)
+                raise
+
+    add_to_inventory(content_addressed_folder, filename)
+    return digest_key
+
+
+def prune_pet_manifests(pet_filenames):
+    # pet_filenames is {pet_id: the filenames the pet has now}. references to
+    # photos a pet no longer has are dropped and its manifest rewritten
+    manifest = load_state(photo_manifest_name, {"photos": {}, "attachments": {}})
+    pruned = set()
+    for reference in list(manifest["photos"]):
+        pet_id, _, filename = reference.partition("/")
+        if pet_id in pet_filenames and filename not in pet_filenames[pet_id]:
+            del manifest["photos"][reference]
+            pruned.add(pet_id)
+
+    if pruned:
+        save_state(photo_manifest_name, manifest)
+        write_pet_manifests(pruned, manifest)
+    return pruned
+
+
+def write_pet_manifests(pet_ids, manifest):
+    # the site reads new-digs-photos/<pet id>/manifest.json to find each
+    # pet's photos in the shared content addressed folder
+    pet_photos = {pet_id: {} for pet_id in pet_ids}
+    for reference, digest_key in manifest["photos"].items():
+        pet_id, _, filename = reference.partition("/")
+        if pet_id in pet_photos:
+            pet_photos[pet_id][filename] = photo_base_url + digest_key
+
+    for pet_id, photos in pet_photos.items():
+        try:
+            get_s3().put_object(
+                Bucket=photo_bucket,
+                Key=photo_prefix + pet_id + "/manifest.json",
+                Body=json.dumps(photos).encode("utf-8"),
+                ACL="public-read",
+                ContentType="application/json",
+            )
+        except ClientError as e:
+            logger.error(e)
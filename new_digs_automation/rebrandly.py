@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from .config import rebrandly_domain_key, rebrandly_api_key
+from .http_client import HttpClient
+from .state import load_state, save_state
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+links_url = "https://api.rebrandly.com/v1/links"
+max_workers = 5
+# Rebrandly allows 10 API calls a second, and lists and deletes links at
+# most 25 at a time
+max_requests_per_second = 10
+page_size = 25
+# maps a hash of each destination to the short link already made for it
+link_cache_name = "rebrandly-links"
+
+client = HttpClient(
+    headers={
+        "Content-type": "application/json",
+        "apikey": rebrandly_api_key,
+    },
+    rate_limits={"api.rebrandly.com": max_requests_per_second},
+    pool_maxsize=max_workers,
+)
+
+
+def destination_key(destination):
+    return hashlib.sha256(destination.encode("utf-8")).hexdigest()
+
+
+def create_link(destination):
+    linkRequest = {
+        "destination": destination,
+        "domain": {
+            "id": rebrandly_domain_key
+        },
+    }
+
+    try:
+        r = client.post(links_url, data=json.dumps(linkRequest))
+    except requests.RequestException:
+        logger.exception(f"Error shortening {destination}")
+        return None
+
+    if r.status_code != requests.codes.ok:
+        logger.error(f"Rebrandly returned status code {r.status_code}")
+        logger.error(r.content)
+        return None
+
+    link = r.json()
+    logger.info("Long URL was %s, short URL is %s" % (link["destination"], link["shortUrl"]))
+    return link
+
+
+def shorten_links(destinations):
+    # returns the short URL for each destination, or None if it couldn't be made
+    cache = load_state(link_cache_name, {})
+
+    to_create = []
+    for destination in destinations:
+        if destination_key(destination) not in cache and destination not in to_create:
+            to_create.append(destination)
+
+    if to_create:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(to_create))) as executor:
+            links = list(executor.map(create_link, to_create))
+
+        created = False
+        for destination, link in zip(to_create, links):
+            if link:
+                cache[destination_key(destination)] = {
+                    "id": link.get("id"),
+                    "shortUrl": link["shortUrl"],
+                }
+                created = True
+        if created:
+            save_state(link_cache_name, cache)
+
+    short_urls = {}
+    for destination in destinations:
+        link = cache.get(destination_key(destination))
+        short_urls[destination] = link["shortUrl"] if link else None
+    return short_urls
+
+
+def list_links():
+    # every link on the account. if a page can't be fetched the links listed
+    # so far are returned, rather than paging on forever
+    links = []
+    last_link = ""
+    while True:
+        try:
+            r = client.get(links_url, params={"limit": page_size, "last": last_link})
+        except requests.RequestException:
+            logger.exception("Error listing Rebrandly links")
+            break
+
+        if r.status_code != requests.codes.ok:
+            logger.error(f"Listing links returned status code {r.status_code}")
+            logger.error(r.content)
+            break
+
+        page = r.json()
+        links.extend(page)
+        if len(page) < page_size:
+            break
+        last_link = page[-1]["id"]
+    return links
+
+
+def delete_links(link_ids):
+    # returns the ids of the links that were deleted
+    deleted = []
+    for i in range(0, len(link_ids), page_size):
+        batch = link_ids[i:i + page_size]
+        try:
+            r = client.delete(links_url, json={"links": batch})
+        except requests.RequestException:
+            logger.exception("Error deleting Rebrandly links")
+            continue
+
+        if r.status_code != requests.codes.ok:
+            logger.error(f"Deleting links returned status code {r.status_code}")
+            logger.error(r.content)
+            continue
+        deleted.extend(batch)
+
+    forget_links(deleted)
+    return deleted
+
+
+def forget_links(link_ids):
+    # drop deleted links so they're never handed out again
+    link_ids = set(link_ids)
+    cache = load_state(link_cache_name, {})
+    remaining = {
+        key: link for key, link in cache.items()
+        if link.get("id") not in link_ids
+    }
+    if len(remaining) != len(cache):
+        save_state(link_cache_name, remaining)
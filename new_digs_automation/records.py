@@ -0,0 +1,151 @@
+import collections
+import enum
+import hashlib
+import json
+
+
+class PetStatus(enum.Enum):
+    ACCEPTED = "Accepted, Not Yet Published"
+    AVAILABLE = "Published - Available for Adoption"
+    PENDING = "Adoption Pending"
+    ADOPTED = "Adopted"
+    REMOVED = "Removed from Program"
+
+
+statuses_by_name = {status.value: status for status in PetStatus}
+
+# an attachment of the Pictures field; hash_url is Airtable's large
+# thumbnail, which is plenty for a perceptual hash
+Attachment = collections.namedtuple("Attachment", ["id", "url", "filename", "hash_url"])
+
+
+class Pet:
+    # a Pets record, parsed once when the table is fetched so the stages
+    # don't each dig through (and re-decode) the raw fields
+    __slots__ = (
+        "id",
+        "name",
+        "number",
+        "species",
+        "status",
+        "status_name",
+        "owner_id",
+        "disclaimers",
+        "thumbnail_url",
+        "variants_manifest_url",
+        "dates",
+        "attachments",
+        "picture_map_json",
+        "_picture_map",
+    )
+
+    # the date fields the status date stage reads
+    date_fields = (
+        "Made Available for Adoption Date",
+        "Adopted Date",
+        "Removed from Program Date",
+    )
+
+    def __init__(self, record_id, fields):
+        self.id = record_id
+        self.name = fields.get("Pet Name") or None
+        self.number = fields.get("Pet ID - do not edit") or None
+        self.species = fields.get("Pet Species") or None
+        self.status_name = fields.get("Status") or ""
+        self.status = statuses_by_name.get(self.status_name)
+        owners = fields.get("Original Owner")
+        self.owner_id = owners[0] if owners else None
+        self.disclaimers = fields.get("Disclaimers") or None
+        self.thumbnail_url = fields.get("ThumbnailURL") or None
+        self.variants_manifest_url = fields.get("VariantsManifestURL") or None
+        self.dates = {field: fields.get(field) for field in self.date_fields}
+        self.attachments = tuple(
+            Attachment(
+                photo.get("id"),
+                photo.get("url"),
+                photo["filename"],
+                photo.get("thumbnails", {}).get("large", {}).get("url", photo.get("url")),
+            )
+            for photo in fields.get("Pictures") or []
+        )
+        self.picture_map_json = fields.get("PictureMap-DoNotModify") or ""
+        self._picture_map = None
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record["id"], record["fields"])
+
+    @property
+    def is_dog(self):
+        return self.species == "Dog"
+
+    @property
+    def picture_map(self):
+        # the decoded PictureMap-DoNotModify, from attachment filename to
+        # the name it's stored under
+        if self._picture_map is None:
+            self._picture_map = json.loads(self.picture_map_json or "{}")
+        return self._picture_map
+
+    def set_picture_map(self, picture_map):
+        # returns the field value to send back to Airtable
+        self._picture_map = picture_map
+        self.picture_map_json = json.dumps(picture_map)
+        return self.picture_map_json
+
+    def photo_filenames(self):
+        # pairs each attachment with the filename it is stored under in S3
+        photos = []
+        for attachment in self.attachments:
+            filename = self.picture_map.get(attachment.filename, attachment.filename)
+            filename = filename.replace(" ", "_").replace("%20", "_")
+            photos.append((attachment, filename))
+        return photos
+
+    def picture_fingerprint(self):
+        # changes whenever an attachment is added, removed or reordered, or
+        # the stored filenames change
+        digest = hashlib.sha256()
+        for attachment in self.attachments:
+            digest.update(attachment.id.encode("utf-8") + b"\0")
+        digest.update(b"\0" + self.picture_map_json.encode("utf-8"))
+        return digest.hexdigest()
+
+
+class Applicant:
+    __slots__ = ("id", "name", "pet_id", "contract_link")
+
+    def __init__(self, record_id, fields):
+        self.id = record_id
+        self.name = fields.get("Name") or None
+        applied_for = fields.get("Applied For")
+        self.pet_id = applied_for[0] if applied_for else None
+        self.contract_link = fields.get("Contract Link") or None
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record["id"], record["fields"])
+
+
+class Owner:
+    __slots__ = ("id", "name", "email")
+
+    def __init__(self, record_id, fields):
+        self.id = record_id
+        self.name = fields.get("Name") or None
+        self.email = fields.get("Email Address") or None
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record["id"], record["fields"])
+
+
+def as_pet(pet):
+    # the stages take parsed pets, but still accept raw Airtable records
+    if isinstance(pet, Pet):
+        return pet
+    return Pet.from_record(pet)
+
+
+def as_pets(pets):
+    return [as_pet(pet) for pet in pets]
@@ -0,0 +1,31 @@
+import os
+
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# only fetch records modified since the last run and merge them into a
+# locally kept snapshot of each table
+incremental_sync = env_flag("NEW_DIGS_INCREMENTAL_SYNC")
+
+# store each distinct photo once under its SHA-256 and have pets reference
+# it through a manifest, instead of a copy per pet and filename
+content_addressed_photos = env_flag("NEW_DIGS_CONTENT_ADDRESSED_PHOTOS")
+
+# write WebP variants of every picture at several widths, listed in a
+# manifest whose URL goes in the Pets table's VariantsManifestURL field
+responsive_variants = env_flag("NEW_DIGS_RESPONSIVE_VARIANTS")
+# also write AVIF variants, when Pillow was built with AVIF support
+avif_variants = env_flag("NEW_DIGS_AVIF_VARIANTS")
+
+# also print the run's metrics as CloudWatch Embedded Metric Format lines so
+# they become CloudWatch metrics without any extra API calls
+emit_metrics_emf = env_flag("NEW_DIGS_METRICS_EMF")
+
+# export the Pets, applicant and owner tables to S3 once a day as Parquet
+# (or gzipped CSV when pyarrow isn't installed), for reporting
+table_exports = env_flag("NEW_DIGS_TABLE_EXPORTS")
@@ -0,0 +1,251 @@
+import logging
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from .metrics import metrics
+from .state import load_state, save_state
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# stop starting or waiting on stages this long before the Lambda is killed,
+# so there's still time to log and return the results
+deadline_margin = 5
+# a backlog only starts another chunk when there's this many times as long
+# left as the slowest chunk so far took
+chunk_time_headroom = 1.5
+
+
+class Stage:
+    # a step of the run: func is called with the values named by inputs and
+    # its return value is stored under outputs (a tuple when there are
+    # several). after lists stages that must finish first without handing
+    # anything over, like the renames the thumbnails read from the pets.
+    # reserve is the time kept back for the stages that come after it.
+    def __init__(
+        self,
+        name,
+        func,
+        inputs=(),
+        outputs=(),
+        after=(),
+        reserve=0,
+        defaults=None,
+    ):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.after = tuple(after)
+        self.reserve = reserve
+        # the outputs used when the stage fails or runs out of time
+        self.defaults = defaults or {}
+
+    def run(self, values):
+        with metrics.stage(self.name):
+            result = self.func(*[values[name] for name in self.inputs])
+        if not self.outputs:
+            return {}
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: result}
+        return dict(zip(self.outputs, result))
+
+    def default_values(self):
+        return {name: self.defaults.get(name) for name in self.outputs}
+
+
+def deadline_from_context(context):
+    # the monotonic time the Lambda has to be finished by, or None when
+    # running without a Lambda context
+    if context is None:
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - deadline_margin
+
+
+def remaining_seconds(deadline):
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def process_backlog(name, items, process_chunk, key, priority=None, deadline=None, chunk_size=16):
+    # works through items a chunk at a time, most important first, until
+    # they're done or there isn't time for another chunk before the deadline.
+    # process_chunk should persist its own work so nothing is lost when the
+    # backlog stops early. what's left is checkpointed, and the next run
+    # takes those items before the new ones of the same priority.
+    # returns the results of every chunk and the items that weren't reached.
+    checkpoint_name = "checkpoint-" + name
+    checkpoint = load_state(checkpoint_name, {})
+    waiting = set(checkpoint.get("remaining", []))
+    # last run's chunk time is the estimate until this run has one of its own
+    chunk_seconds = checkpoint.get("chunk_seconds", 0)
+
+    items = sorted(
+        items,
+        key=lambda item: (
+            priority(item) if priority else 0,
+            key(item) not in waiting,
+        ),
+    )
+
+    results = []
+    processed = 0
+    slowest_chunk = 0
+    while processed < len(items):
+        left = remaining_seconds(deadline)
+        if left is not None and left < max(slowest_chunk, chunk_seconds) * chunk_time_headroom:
+            logger.warning(
+                f"stopping {name} with {len(items) - processed} left, "
+                f"{left:.1f}s before the deadline"
+            )
+            break
+
+        started = time.monotonic()
+        results += process_chunk(items[processed:processed + chunk_size])
+        processed += chunk_size
+        slowest_chunk = max(slowest_chunk, time.monotonic() - started)
+
+    remaining = items[processed:]
+    if remaining or waiting:
+        save_state(checkpoint_name, {
+            "remaining": [key(item) for item in remaining],
+            "chunk_seconds": slowest_chunk or chunk_seconds,
+        })
+    return results, remaining
+
+
+def check_stages(stages, values):
+    # every input has to come from values or from exactly one stage, and the
+    # stages can't depend on each other in a loop
+    producers = {}
+    names = set()
+    for stage in stages:
+        if stage.name in names:
+            raise ValueError(f"stage {stage.name} is declared twice")
+        names.add(stage.name)
+        for output in stage.outputs:
+            if output in producers or output in values:
+                raise ValueError(f"{output} is produced more than once")
+            producers[output] = stage.name
+
+    depends_on = {}
+    for stage in stages:
+        depends_on[stage.name] = set(stage.after)
+        for name in stage.inputs:
+            if name in values:
+                continue
+            if name not in producers:
+                raise ValueError(f"stage {stage.name} needs {name}, which nothing produces")
+            depends_on[stage.name].add(producers[name])
+        unknown = depends_on[stage.name] - names
+        if unknown:
+            raise ValueError(f"stage {stage.name} runs after unknown stages {sorted(unknown)}")
+
+    finished = set()
+    while len(finished) < len(names):
+        ready = {
+            name for name in names - finished
+            if depends_on[name] <= finished
+        }
+        if not ready:
+            raise ValueError(f"stages {sorted(names - finished)} depend on each other")
+        finished |= ready
+
+    return depends_on
+
+
+def run_stages(stages, values=None, deadline=None):
+    # runs every stage as soon as the ones it depends on are done, so the
+    # run takes as long as its slowest chain of stages rather than the sum
+    # of all of them. a stage that raises, or is still going when its share
+    # of the deadline is up, is given its default outputs and the stages
+    # after it carry on, so one failure doesn't lose what the others queued.
+    # a thread can't be stopped, so long stages take "deadline" and stop
+    # themselves; one that's late is waited on until the run's deadline
+    # rather than left to resume in the next invocation.
+    # returns the values and the names of the stages that timed out and
+    # that failed.
+    values = dict(values or {})
+    # stages that can budget their own work take "deadline" as an input, and
+    # are given the time they have to finish by
+    values["deadline"] = deadline
+    depends_on = check_stages(stages, values)
+
+    pending = {stage.name: stage for stage in stages}
+    finished = set()
+    timed_out = []
+    failed = []
+    running = {}
+    late = []
+
+    # a thread per stage, so a stage never waits for a worker while its
+    # share of the deadline runs down; the stages mostly wait on I/O
+    executor = ThreadPoolExecutor(max_workers=max(1, len(stages)))
+    try:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if not depends_on[name] <= finished:
+                    continue
+                del pending[name]
+
+                stage_deadline = None
+                if deadline is not None:
+                    stage_deadline = deadline - stage.reserve
+                    if time.monotonic() >= stage_deadline:
+                        logger.error(f"no time left to run {name}")
+                        values.update(stage.default_values())
+                        timed_out.append(name)
+                        finished.add(name)
+                        continue
+
+                # a copy, since values is added to while the stage runs
+                stage_values = dict(values)
+                stage_values["deadline"] = stage_deadline
+                future = executor.submit(stage.run, stage_values)
+                running[future] = (stage, stage_deadline)
+
+            if not running:
+                # stages were skipped for lack of time, which may have made
+                # more of them ready
+                continue
+
+            stage_deadlines = [
+                stage_deadline for _, stage_deadline in running.values()
+                if stage_deadline is not None
+            ]
+            timeout = None
+            if stage_deadlines:
+                timeout = max(0, min(stage_deadlines) - time.monotonic())
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage, _ = running.pop(future)
+                try:
+                    values.update(future.result())
+                except Exception:
+                    logger.exception(f"{stage.name} failed")
+                    values.update(stage.default_values())
+                    failed.append(stage.name)
+                finished.add(stage.name)
+
+            now = time.monotonic()
+            for future, (stage, stage_deadline) in list(running.items()):
+                if stage_deadline is not None and now >= stage_deadline:
+                    logger.error(f"{stage.name} ran out of time")
+                    del running[future]
+                    late.append(future)
+                    values.update(stage.default_values())
+                    timed_out.append(stage.name)
+                    finished.add(stage.name)
+
+        if late:
+            # given their deadline, late stages stop after the piece of work
+            # they're on
+            _, still_running = wait(late, timeout=max(0, remaining_seconds(deadline)))
+            if still_running:
+                logger.error(f"{len(still_running)} stages are still running at the deadline")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return values, timed_out, failed
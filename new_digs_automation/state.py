@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+
+from botocore.exceptions import ClientError
+from .clients import get_s3
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# small JSON documents that need to survive between runs live in S3, with a
+# copy in /tmp so warm invocations don't have to download them again
+state_bucket = "dpa-media"
+state_prefix = "new-digs-automation/state/"
+local_state_dir = "/tmp/new-digs-state/"
+
+
+def load_state(name, default=None):
+    local_path = local_state_dir + name + ".json"
+    if os.path.exists(local_path):
+        try:
+            with open(local_path) as fp:
+                return json.load(fp)
+        except ValueError:
+            logger.warning(f"Discarding unreadable local state {name}")
+
+    try:
+        response = get_s3().get_object(
+            Bucket=state_bucket,
+            Key=state_prefix + name + ".json",
+        )
+        data = json.loads(response["Body"].read())
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+            logger.error(e)
+        return default
+    except ValueError:
+        logger.warning(f"Discarding unreadable state {name}")
+        return default
+
+    write_local_state(name, data)
+    return data
+
+
+def save_state(name, data):
+    write_local_state(name, data)
+    try:
+        get_s3().put_object(
+            Bucket=state_bucket,
+            Key=state_prefix + name + ".json",
+            Body=json.dumps(data, default=str).encode("utf-8"),
+            ContentType="application/json",
+        )
+    except ClientError as e:
+        logger.error(e)
+        return False
+    return True
+
+
+def write_local_state(name, data):
+    os.makedirs(local_state_dir, exist_ok=True)
+    local_path = local_state_dir + name + ".json"
+    # write then rename so a crash never leaves a half written file behind
+    with open(local_path + ".tmp", "w") as fp:
+        json.dump(data, fp, default=str)
+    os.replace(local_path + ".tmp", local_path)
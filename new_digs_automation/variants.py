@@ -0,0 +1,200 @@
+import io
+import json
+import logging
+import mimetypes
+import os
+
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .images import (
+    download_image,
+    image_worker_pool,
+    io_workers,
+    variants_bytes,
+)
+from .clients import get_s3
+from .metrics import metrics
+from .photos import (
+    photo_base_url,
+    photo_bucket,
+    upload_image,
+)
+from .stages import process_backlog
+from .state import load_state, save_state
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+variant_prefix = "new-digs-variants/"
+# {pet_id: {filename: [variant, ...]}} for every picture that has variants
+variant_manifests_name = "variant-manifests"
+# {pet_id: {"fingerprint": ..., "filenames": [...]}} for pictures whose
+# variants couldn't be made; they're skipped until the pet's pictures change
+variant_failures_name = "variant-failures"
+# pictures are worked through this many at a time to bound memory
+variant_chunk_size = 16
+
+
+def variant_manifest_url(pet_id):
+    return photo_base_url + variant_prefix + pet_id + "/manifest.json"
+
+
+def update_variants(pets_by_id, updates, avif=False, deadline=None, priority=None):
+    # turning variants on means a backlog of every picture, so it's worked
+    # through a chunk at a time until the deadline, saving the manifests
+    # after each one so the next run carries on from there
+    manifests = load_state(variant_manifests_name, {})
+    saved_failures = load_state(variant_failures_name, {})
+    failures = {}
+
+    jobs = []
+    changed_pet_ids = set()
+    for pet_id, pet in pets_by_id.items():
+        photos = [
+            (photo, filename)
+            for photo, filename in pet.photo_filenames()
+            if "pdf" not in os.path.splitext(filename)[1].lower()
+        ]
+        current = {filename for _, filename in photos}
+        manifest = manifests.get(pet_id, {})
+
+        # drop pictures that were taken off the pet
+        if set(manifest) - current:
+            manifests[pet_id] = {
+                filename: variants for filename, variants in manifest.items()
+                if filename in current
+            }
+            changed_pet_ids.add(pet_id)
+
+        failed = saved_failures.get(pet_id)
+        failed_filenames = set()
+        if failed and failed["fingerprint"] == pet.picture_fingerprint():
+            failures[pet_id] = failed
+            failed_filenames = set(failed["filenames"])
+
+        for photo, filename in photos:
+            if filename not in manifest and filename not in failed_filenames:
+                jobs.append((pet_id, photo.url, filename))
+
+        if manifest and pet.variants_manifest_url != variant_manifest_url(pet_id):
+            changed_pet_ids.add(pet_id)
+
+    def publish(pet_ids):
+        for pet_id in pet_ids:
+            if write_variant_manifest(pet_id, manifests.get(pet_id, {})):
+                updates.add("/Pets", pet_id, {
+                    "VariantsManifestURL": variant_manifest_url(pet_id),
+                })
+        if pet_ids:
+            save_state(variant_manifests_name, manifests)
+        return list(pet_ids)
+
+    updated = publish(changed_pet_ids)
+    if failures != saved_failures:
+        save_state(variant_failures_name, failures)
+
+    with ThreadPoolExecutor(max_workers=io_workers) as io_pool, image_worker_pool() as image_pool:
+        def make_chunk(chunk):
+            chunk_pet_ids = set()
+            chunk_failed = False
+            for pet_id, filename, variants in make_variants_for(chunk, io_pool, image_pool, avif):
+                if variants is None:
+                    failures.setdefault(pet_id, {
+                        "fingerprint": pets_by_id[pet_id].picture_fingerprint(),
+                        "filenames": [],
+                    })["filenames"].append(filename)
+                    chunk_failed = True
+                    continue
+                manifests.setdefault(pet_id, {})[filename] = variants
+                chunk_pet_ids.add(pet_id)
+            if chunk_failed:
+                save_state(variant_failures_name, failures)
+            return publish(chunk_pet_ids)
+
+        results, _ = process_backlog(
+            "variants",
+            jobs,
+            make_chunk,
+            key=lambda job: job[0] + "/" + job[2],
+            priority=(lambda job: priority(pets_by_id[job[0]])) if priority else None,
+            deadline=deadline,
+            chunk_size=variant_chunk_size,
+        )
+
+    return len(set(updated) | set(results))
+
+
+def make_variants_for(jobs, io_pool, image_pool, avif):
+    # yields (pet_id, filename, manifest entries) for every job, with None
+    # for the entries of pictures whose variants couldn't be made
+    downloads = {}
+    for pet_id, url, filename in jobs:
+        downloads[io_pool.submit(download_image, url)] = (pet_id, filename)
+
+    decodes = {}
+    for future in as_completed(downloads):
+        pet_id, filename = downloads[future]
+        try:
+            data = future.result()
+        except Exception:
+            logger.exception(f"Error downloading {filename} for pet {pet_id}")
+            data = None
+        if not data:
+            yield pet_id, filename, None
+            continue
+        decodes[image_pool.submit(
+            variants_bytes,
+            data.getvalue(),
+            filename,
+            avif=avif,
+        )] = (pet_id, filename)
+
+    uploads = {}
+    for future in as_completed(decodes):
+        pet_id, filename = decodes[future]
+        try:
+            variants, timings = future.result()
+            metrics.record_timings(timings)
+        except Exception:
+            logger.exception(f"Error making variants of {filename} for pet {pet_id}")
+            variants = None
+        if not variants:
+            yield pet_id, filename, None
+            continue
+
+        # keys are derived from the stored filename, so a rerun overwrites
+        # rather than duplicates
+        path = variant_prefix + pet_id + "/" + os.path.splitext(filename)[0] + "/"
+        futures = []
+        entries = []
+        for name, data, width in variants:
+            futures.append(io_pool.submit(upload_image, io.BytesIO(data), path, name))
+            entries.append({
+                "width": width,
+                "type": mimetypes.guess_type(name)[0],
+                "url": photo_base_url + path + name,
+            })
+        uploads[(pet_id, filename)] = (futures, entries)
+
+    for (pet_id, filename), (futures, entries) in uploads.items():
+        try:
+            uploaded = all(future.result() for future in futures)
+        except Exception:
+            logger.exception(f"Error uploading variants of {filename} for pet {pet_id}")
+            uploaded = False
+        yield pet_id, filename, entries if uploaded else None
+
+
+def write_variant_manifest(pet_id, manifest):
+    try:
+        get_s3().put_object(
+            Bucket=photo_bucket,
+            Key=variant_prefix + pet_id + "/manifest.json",
+            Body=json.dumps(manifest).encode("utf-8"),
+            ACL="public-read",
+            ContentType="application/json",
+        )
+    except ClientError as e:
+        logger.error(e)
+        return False
+    return True
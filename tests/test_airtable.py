@@ -0,0 +1,149 @@
+from new_digs_automation.config import base
+from new_digs_automation import airtable
+from new_digs_automation.airtable import (
+    UpdateQueue,
+    get_table,
+    get_table_incremental,
+    get_tables,
+    union_fields,
+    update_records,
+)
+
+base_url = "https://api.airtable.com/v0/" + base
+
+
+def test_get_table_follows_offsets(requests_mock):
+    url = base_url + "/Pets"
+    requests_mock.get(
+        url,
+        [
+            {"json": {"records": [{"id": "1"}], "offset": "page2"}},
+            {"json": {"records": [{"id": "2"}]}},
+        ],
+    )
+
+    records = get_table("/Pets")
+
+    assert [record["id"] for record in records] == ["1", "2"]
+    assert requests_mock.last_request.qs["offset"] == ["page2"]
+
+
+def test_get_tables_returns_each_table(requests_mock):
+    requests_mock.get(base_url + "/Pets", json={"records": [{"id": "pet"}]})
+    requests_mock.get(
+        base_url + "/Original%20Owners",
+        json={"records": [{"id": "owner"}]},
+    )
+
+    tables = get_tables(["/Pets", "/Original%20Owners"])
+
+    assert tables["/Pets"] == [{"id": "pet"}]
+    assert tables["/Original%20Owners"] == [{"id": "owner"}]
+
+
+def test_get_table_incremental_merges_changes(requests_mock, monkeypatch):
+    saved = {}
+    monkeypatch.setattr(airtable, "load_state", lambda name: saved.get(name))
+    monkeypatch.setattr(
+        airtable, "save_state", lambda name, data: saved.update({name: data})
+    )
+    url = base_url + "/Pets"
+    requests_mock.get(
+        url,
+        [
+            {"json": {"records": [
+                {"id": "1", "fields": {"Status": "Adopted"}},
+                {"id": "2", "fields": {"Status": "Adoption Pending"}},
+            ]}},
+            {"json": {"records": [
+                {"id": "2", "fields": {"Status": "Adopted"}},
+                {"id": "3", "fields": {"Status": "Adoption Pending"}},
+            ]}},
+        ],
+    )
+
+    get_table_incremental("/Pets")
+    records = get_table_incremental("/Pets")
+
+    assert "last_modified_time()" in requests_mock.last_request.qs["filterbyformula"][0]
+    assert records == [
+        {"id": "1", "fields": {"Status": "Adopted"}},
+        {"id": "2", "fields": {"Status": "Adopted"}},
+        {"id": "3", "fields": {"Status": "Adoption Pending"}},
+    ]
+
+
+def test_get_table_requests_only_given_fields(requests_mock):
+    requests_mock.get(base_url + "/Pets", json={"records": []})
+
+    get_table("/Pets", fields=union_fields(["Status", "Pictures"], ["Status"]))
+
+    assert requests_mock.last_request.qs["fields[]"] == ["pictures", "status"]
+
+
+def test_update_records_coalesces_and_batches(requests_mock):
+    def echo(request, context):
+        return {"records": request.json()["records"]}
+
+    requests_mock.patch(base_url + "/Pets", json=echo)
+
+    records = [
+        {"id": str(i), "fields": {"Adopted Date": "2021-01-01"}}
+        for i in range(12)
+    ]
+    records.append({"id": "0", "fields": {"ThumbnailURL": "thumb"}})
+
+    results = update_records("/Pets", records)
+
+    assert requests_mock.call_count == 2
+    assert len(results) == 12
+    assert results["0"] == {"Adopted Date": "2021-01-01", "ThumbnailURL": "thumb"}
+
+
+def test_update_queue_flushes_only_the_given_fields(requests_mock):
+    def echo(request, context):
+        return {"records": request.json()["records"]}
+
+    requests_mock.patch(base_url + "/Pets", json=echo)
+    updates = UpdateQueue()
+    updates.add("/Pets", "1", {"ThumbnailURL": "thumb", "Adopted Date": "2021-01-01"})
+    updates.add("/Pets", "2", {"Adopted Date": "2021-01-02"})
+
+    updates.flush(fields=["ThumbnailURL"])
+
+    assert requests_mock.last_request.json()["records"] == [{"id": "1", "fields": {"ThumbnailURL": "thumb"}}]
+    assert updates.pending["/Pets"] == {
+        "1": {"Adopted Date": "2021-01-01"},
+        "2": {"Adopted Date": "2021-01-02"},
+    }
+
+    updates.flush()
+
+    assert requests_mock.call_count == 2
+    assert updates.results["/Pets"]["1"] == {"ThumbnailURL": "thumb", "Adopted Date": "2021-01-01"}
+
+
+def test_update_records_reports_failed_batches(requests_mock, caplog):
+    requests_mock.patch(base_url + "/Pets", status_code=422)
+
+    results = update_records("/Pets", [{"id": "1", "fields": {"Status": ""}}])
+
+    assert results == {"1": None}
+    assert "Patch failed." in caplog.text
+
+
+def test_get_table_retries_rate_limited_pages(requests_mock, monkeypatch):
+    monkeypatch.setattr("new_digs_automation.http_client.time.sleep", lambda seconds: None)
+    requests_mock.get(
+        base_url + "/Pets",
+        [
+            {"json": {"records": [{"id": "1"}], "offset": "page2"}},
+            {"status_code": 429, "headers": {"Retry-After": "30"}},
+            {"json": {"records": [{"id": "2"}]}},
+        ],
+    )
+
+    records = get_table("/Pets")
+
+    assert [record["id"] for record in records] == ["1", "2"]
+    assert requests_mock.call_count == 3
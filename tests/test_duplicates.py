@@ -0,0 +1,100 @@
+import io
+
+from PIL import Image, ImageDraw
+from new_digs_automation import duplicates, stages
+from new_digs_automation.duplicates import BKTree, find_duplicate_photos
+from new_digs_automation.images import dhash
+from new_digs_automation.records import as_pets
+
+
+def picture(size, format="JPEG"):
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, size[0] // 3, size[1]), fill="black")
+    draw.ellipse((size[0] // 2, size[1] // 4, size[0], size[1]), fill="grey")
+    data = io.BytesIO()
+    img.save(data, format=format)
+    return data.getvalue()
+
+
+def test_dhash_matches_resized_copies():
+    original = dhash(picture((1200, 900)))
+    smaller = dhash(picture((300, 225), format="PNG"))
+
+    assert bin(original ^ smaller).count("1") <= 6
+
+
+def test_bk_tree_search():
+    tree = BKTree()
+    tree.add(0b0000, "a")
+    tree.add(0b0001, "b")
+    tree.add(0b0111, "c")
+    tree.add(0b1111, "d")
+
+    assert sorted(tree.search(0b0000, 1)) == ["a", "b"]
+    assert sorted(tree.search(0b0011, 1)) == ["b", "c"]
+    assert tree.search(0b0000, 0) == ["a"]
+
+
+def test_new_hashes_are_saved_a_chunk_at_a_time(monkeypatch):
+    saved = {"photo-hashes": {"gone": "0000000000000000"}}
+    for module in (duplicates, stages):
+        monkeypatch.setattr(module, "load_state", lambda name, default=None: saved.get(name, default))
+        monkeypatch.setattr(module, "save_state", lambda name, data: saved.update({name: data}))
+    monkeypatch.setattr(duplicates, "hash_chunk_size", 1)
+    monkeypatch.setattr(duplicates, "image_worker_pool", lambda: duplicates.ThreadPoolExecutor(1))
+    hashed = []
+
+    def hash_attachments(attachments, io_pool, image_pool):
+        hashed.extend(attachments)
+        return {attachment_id: 0b1111 for attachment_id in attachments}
+
+    monkeypatch.setattr(duplicates, "hash_attachments", hash_attachments)
+    # time for one chunk, then none
+    left = iter([100, 0])
+    monkeypatch.setattr(stages, "remaining_seconds", lambda deadline: next(left, None) if deadline else None)
+    pets = as_pets([
+        {"id": "rec1", "fields": {"Pet Name": "Rex", "Pictures": [
+            {"id": "att1", "filename": "a.jpg", "url": "https://dl.test/a.jpg"},
+            {"id": "att2", "filename": "b.jpg", "url": "https://dl.test/b.jpg"},
+        ]}},
+    ])
+
+    found, _ = find_duplicate_photos(pets, deadline=1)
+
+    assert found == []
+    assert hashed == ["att1"]
+    assert saved["photo-hashes"] == {"att1": "000000000000000f"}
+    assert saved["checkpoint-photo-hashes"]["remaining"] == ["att2"]
+
+    found, _ = find_duplicate_photos(pets)
+
+    assert found == [("att1", "att2")]
+    assert hashed == ["att1", "att2"]
+    assert sorted(saved["photo-hashes"]) == ["att1", "att2"]
+
+
+def test_attachments_that_cant_be_hashed_are_tried_once(monkeypatch, requests_mock):
+    saved = {}
+    for module in (duplicates, stages):
+        monkeypatch.setattr(module, "load_state", lambda name, default=None: saved.get(name, default))
+        monkeypatch.setattr(module, "save_state", lambda name, data: saved.update({name: data}))
+    monkeypatch.setattr(duplicates, "image_worker_pool", lambda: duplicates.ThreadPoolExecutor(1))
+    requests_mock.get("https://dl.test/a.jpg", content=picture((400, 300)))
+    requests_mock.get("https://dl.test/b.jpg", content=b"not a picture")
+    requests_mock.get("https://dl.test/c.jpg", status_code=404)
+    pets = as_pets([
+        {"id": "rec1", "fields": {"Pet Name": "Rex", "Pictures": [
+            {"id": f"att-{name}", "filename": f"{name}.jpg", "url": f"https://dl.test/{name}.jpg"}
+            for name in "abc"
+        ]}},
+    ])
+
+    assert find_duplicate_photos(pets)[0] == []
+    assert saved["photo-hashes"]["att-b"] is None
+    assert saved["photo-hashes"]["att-c"] is None
+    assert saved["photo-hashes"]["att-a"] is not None
+    requests_mock.reset_mock()
+
+    assert find_duplicate_photos(pets, full_report=True)[0] == []
+    assert requests_mock.call_count == 0
@@ -0,0 +1,128 @@
+import csv
+import gzip
+import io
+
+import pytest
+
+from new_digs_automation import exports
+from new_digs_automation.exports import CsvPart, ParquetPart, TableExport, merge_type
+
+
+class FakeS3:
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.upload_args = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        self.objects[key] = fileobj.read()
+        self.upload_args[key] = ExtraArgs
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        return [{"Contents": [{"Key": key} for key in self.objects if key.startswith(Prefix)]}]
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            del self.objects[item["Key"]]
+
+
+def record(record_id, **fields):
+    return {"id": record_id, "createdTime": "2024-01-01T00:00:00.000Z", "fields": fields}
+
+
+def test_merge_type():
+    assert merge_type(None, "int") == "int"
+    assert merge_type("int", "float") == "float"
+    assert merge_type("bool", "int") == "string"
+
+
+def test_csv_export_has_one_part_with_every_column(monkeypatch):
+    prefix = "new-digs-exports/pets/export_date=2024-01-02/"
+    s3 = FakeS3({prefix + "part-00009.csv.gz": b"old"})
+    monkeypatch.setattr(exports, "get_s3", lambda: s3)
+    monkeypatch.setattr(exports, "row_group_size", 2)
+
+    export = TableExport("/Pets", "2024-01-02", CsvPart)
+    export.add_page([record("rec1", Name="Rex", Age=3), record("rec2", Name="Tom", Pictures=[{}])])
+    export.add_page([record("rec3", Name="Kit", Notes=None)])
+    keys = export.close()
+
+    assert keys == [prefix + "part-00000.csv.gz"]
+    assert sorted(s3.objects) == keys
+    assert s3.upload_args[keys[0]] == {"ContentType": "text/csv", "ContentEncoding": "gzip"}
+    rows = list(csv.reader(io.StringIO(gzip.decompress(s3.objects[keys[0]]).decode())))
+    assert rows == [
+        ["Age", "Name", "Notes", "createdTime", "id"],
+        ["3", "Rex", "", "2024-01-01T00:00:00.000Z", "rec1"],
+        ["", "Tom", "", "2024-01-01T00:00:00.000Z", "rec2"],
+        ["", "Kit", "", "2024-01-01T00:00:00.000Z", "rec3"],
+    ]
+    assert export.rows == 3
+
+
+def test_an_empty_table_counts_as_exported(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(exports, "load_state", lambda name, default=None: saved.get(name, default))
+    monkeypatch.setattr(exports, "save_state", lambda name, data: saved.update({name: data}))
+    monkeypatch.setattr(exports, "get_s3", FakeS3)
+    monkeypatch.setattr(exports, "part_format", lambda: CsvPart)
+    pages = {"/Pets": [[record("rec1", Name="Rex")]]}
+    monkeypatch.setattr(exports, "iter_table_pages", lambda table_name: pages.get(table_name, []))
+
+    rows = exports.export_tables_if_due()
+
+    assert rows == dict.fromkeys(exports.export_tables, 0) | {"/Pets": 1}
+    assert "export_date" in saved["table-exports"]
+    assert exports.export_tables_if_due() == {}
+
+
+def test_a_failed_table_is_exported_again(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(exports, "load_state", lambda name, default=None: saved.get(name, default))
+    monkeypatch.setattr(exports, "save_state", lambda name, data: saved.update({name: data}))
+    monkeypatch.setattr(exports, "get_s3", FakeS3)
+    monkeypatch.setattr(exports, "part_format", lambda: CsvPart)
+
+    def iter_table_pages(table_name):
+        if table_name == "/Pets":
+            raise ConnectionError("Airtable is down")
+        return []
+
+    monkeypatch.setattr(exports, "iter_table_pages", iter_table_pages)
+
+    assert exports.export_tables_if_due()["/Pets"] is None
+    assert "table-exports" not in saved
+
+
+def test_parquet_export_keeps_types(monkeypatch):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    s3 = FakeS3()
+    monkeypatch.setattr(exports, "get_s3", lambda: s3)
+
+    export = TableExport("/Adoption%20Applicants", "2024-01-02", ParquetPart)
+    export.add_page([record("rec1", Age=3, Adopted=True), record("rec2", Age=4.5)])
+    [key] = export.close()
+
+    assert key.startswith("new-digs-exports/adoption_applicants/export_date=2024-01-02/")
+    table = parquet.read_table(io.BytesIO(s3.objects[key]))
+    assert table.column("Age").to_pylist() == [3.0, 4.5]
+    assert table.column("Adopted").to_pylist() == [True, None]
+
+
+def test_parquet_export_widens_types_across_row_groups(monkeypatch):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    s3 = FakeS3()
+    monkeypatch.setattr(exports, "get_s3", lambda: s3)
+    monkeypatch.setattr(exports, "row_group_size", 1)
+
+    export = TableExport("/Pets", "2024-01-02", ParquetPart)
+    export.add_page([record("rec1", Age=3)])
+    export.add_page([record("rec2", Age="old")])
+    keys = export.close()
+
+    assert len(keys) == 1
+    table = parquet.read_table(io.BytesIO(s3.objects[keys[0]]))
+    assert str(table.schema.field("Age").type) == "string"
+    assert table.column("Age").to_pylist() == ["3", "old"]
@@ -0,0 +1,142 @@
+import re
+
+from new_digs_automation.config import base
+from new_digs_automation.google_sheets import (
+    cell_name,
+    sheet_updates,
+    sync_sheet,
+    table_rows,
+)
+
+
+class FakeWorksheet:
+    def __init__(self, data):
+        self.data = data
+        self.batches = []
+
+    def get_all_values(self, value_render_option=None):
+        return self.data
+
+    def batch_update(self, data):
+        self.batches.append(data)
+
+
+class FakeSheets:
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def open_by_key(self, file_key):
+        return self
+
+    def get_worksheet(self, index):
+        return self.worksheet
+
+
+def apply_updates(data, updates):
+    # what the sheet looks like after a batch_update of value ranges
+    grid = [list(row) for row in data]
+    for update in updates:
+        letters, row = re.match(r"([A-Z]+)(\d+)", update["range"]).groups()
+        column = 0
+        for letter in letters:
+            column = column * 26 + ord(letter) - ord("A") + 1
+        for i, values in enumerate(update["values"]):
+            while len(grid) < int(row) + i:
+                grid.append([])
+            target = grid[int(row) + i - 1]
+            for j, value in enumerate(values):
+                while len(target) < column + j:
+                    target.append("")
+                target[column + j - 1] = value
+    # the sheet API leaves out rows that are empty
+    while grid and not any(grid[-1]):
+        grid.pop()
+    return grid
+
+
+def test_cell_name():
+    assert cell_name(1, 1) == "A1"
+    assert cell_name(12, 26) == "Z12"
+    assert cell_name(3, 28) == "AB3"
+
+
+def test_unchanged_sheet_sends_nothing():
+    data = [["id", "Name"], ["rec1", "Rex"], ["rec2", "Tom"]]
+    assert sheet_updates(data, data) == []
+
+
+def test_only_changed_cells_are_sent():
+    current = [["id", "Age", "Name"], ["rec1", 3, "Rex"], ["rec2", 5, "Tom"]]
+    output = [["id", "Age", "Name"], ["rec1", 3, "Rex"], ["rec2", 6, "Tom"]]
+
+    updates = sheet_updates(current, output)
+
+    assert updates == [{"range": "B3", "values": [[6]]}]
+
+
+def test_deleted_rows_are_reused_and_cleared():
+    current = [
+        ["id", "Name"],
+        ["rec1", "Rex"],
+        ["rec2", "Tom"],
+        ["rec3", "Kit"],
+        ["rec4", "Bo"],
+    ]
+    output = [["id", "Name"], ["rec3", "Kit"], ["rec5", "Max"]]
+
+    result = apply_updates(current, sheet_updates(current, output))
+
+    assert result[0] == ["id", "Name"]
+    assert sorted(result[1:]) == sorted(output[1:])
+
+
+def test_appended_rows():
+    current = [["id", "Name"], ["rec1", "Rex"]]
+    output = [["id", "Name"], ["rec1", "Rex"], ["rec2", "Tom"], ["rec3", "Kit"]]
+
+    updates = sheet_updates(current, output)
+
+    assert updates == [{"range": "A3", "values": [["rec2", "Tom"], ["rec3", "Kit"]]}]
+
+
+def test_new_columns_rewrite_the_sheet():
+    current = [["id", "Name"], ["rec1", "Rex"], ["rec2", "Tom"]]
+    output = [["Age", "id", "Name"], [3, "rec1", "Rex"]]
+
+    result = apply_updates(current, sheet_updates(current, output))
+
+    assert result == output
+
+
+def test_table_rows_flattens_records():
+    records = [
+        {"id": "rec1", "createdTime": "t1", "fields": {"Name": "Rex", "Pictures": [{}]}},
+        {"id": "rec2", "createdTime": "t2", "fields": {"Age": 3, "Applied For": ["rec9"]}},
+    ]
+
+    assert table_rows(records) == [
+        ["Age", "Name", "createdTime", "id"],
+        ["", "Rex", "t1", "rec1"],
+        [3, "", "t2", "rec2"],
+    ]
+
+
+def test_sync_sheet_pages_through_the_table(requests_mock):
+    requests_mock.get(
+        "https://api.airtable.com/v0/" + base + "/Pets",
+        [
+            {"json": {
+                "records": [{"id": "rec1", "createdTime": "t", "fields": {"Name": "Rex"}}],
+                "offset": "page2",
+            }},
+            {"json": {
+                "records": [{"id": "rec2", "createdTime": "t", "fields": {"Name": "Tom"}}],
+            }},
+        ],
+    )
+    worksheet = FakeWorksheet([["Name", "createdTime", "id"], ["Rex", "t", "rec1"]])
+
+    rows = sync_sheet(FakeSheets(worksheet), "key", "/Pets")
+
+    assert rows == 3
+    assert worksheet.batches == [[{"range": "A3", "values": [["Tom", "t", "rec2"]]}]]
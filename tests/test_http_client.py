@@ -0,0 +1,152 @@
+import time
+
+import pytest
+import requests
+
+from new_digs_automation import http_client
+from new_digs_automation.http_client import (
+    CircuitBreaker,
+    CircuitOpenError,
+    HttpClient,
+    TokenBucket,
+    retry_after,
+)
+
+url = "https://api.example.com/things"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(http_client.time, "sleep", slept.append)
+    return slept
+
+
+def test_retries_honor_retry_after(requests_mock, sleeps):
+    requests_mock.get(
+        url,
+        [
+            {"status_code": 429, "headers": {"Retry-After": "2"}},
+            {"status_code": 503},
+            {"json": {"ok": True}},
+        ],
+    )
+
+    response = HttpClient().get(url)
+
+    assert response.json() == {"ok": True}
+    assert requests_mock.call_count == 3
+    assert sleeps[0] == 2
+    assert 0 <= sleeps[1] <= http_client.backoff_base * 2
+
+
+def test_gives_up_after_max_retries(requests_mock, sleeps):
+    requests_mock.get(url, status_code=502)
+
+    response = HttpClient().get(url)
+
+    assert response.status_code == 502
+    assert requests_mock.call_count == http_client.max_retries + 1
+
+
+def test_long_retry_after_is_not_waited_out(requests_mock, sleeps):
+    requests_mock.get(url, status_code=429, headers={"Retry-After": "3600"})
+
+    assert HttpClient().get(url).status_code == 429
+    assert sleeps == []
+
+
+def test_client_errors_are_not_retried(requests_mock, sleeps):
+    requests_mock.patch(url, status_code=422)
+
+    assert HttpClient().patch(url).status_code == 422
+    assert requests_mock.call_count == 1
+
+
+def test_connection_errors_are_retried_then_raised(requests_mock, sleeps):
+    requests_mock.get(url, exc=requests.ConnectTimeout)
+
+    with pytest.raises(requests.ConnectTimeout):
+        HttpClient().get(url)
+    assert requests_mock.call_count == http_client.max_retries + 1
+
+
+def test_circuit_opens_after_repeated_failures(requests_mock, sleeps):
+    requests_mock.get(url, status_code=500)
+    client = HttpClient()
+
+    client.get(url)
+
+    with pytest.raises(CircuitOpenError):
+        client.get(url)
+    assert requests_mock.call_count == http_client.failure_threshold
+
+
+def test_circuit_half_opens_after_timeout(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(http_client.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(threshold=2, timeout=30)
+
+    breaker.failed()
+    breaker.failed()
+    assert not breaker.allow()
+
+    now[0] = 31
+    assert breaker.allow()
+    # only one request tries the host while it's half open
+    assert not breaker.allow()
+
+    breaker.succeeded()
+    assert breaker.allow()
+
+
+def test_retry_after_http_date():
+    response = requests.Response()
+    response.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+
+    assert retry_after(response) == 0
+
+
+def test_rate_limit_has_no_burst():
+    bucket = TokenBucket(100, 1)
+    started = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+
+    # the first request goes straight away and the other ten are spaced out
+    assert time.monotonic() - started >= 0.09
+
+
+def test_rate_limited_wait_without_retry_after(requests_mock, sleeps):
+    requests_mock.get(url, [{"status_code": 429}, {"json": {}}])
+
+    HttpClient(rate_limited_waits={"api.example.com": 30}).get(url)
+
+    assert sleeps == [30]
+
+
+def test_posts_are_not_resent_once_sent(requests_mock, sleeps):
+    client = HttpClient()
+
+    requests_mock.post(url, status_code=503)
+    assert client.post(url).status_code == 503
+
+    requests_mock.post(url, exc=requests.ReadTimeout)
+    with pytest.raises(requests.ReadTimeout):
+        client.post(url)
+
+    assert requests_mock.call_count == 2
+
+
+def test_posts_are_resent_when_rate_limited_or_not_connected(requests_mock, sleeps):
+    requests_mock.post(
+        url,
+        [
+            {"exc": requests.ConnectTimeout},
+            {"status_code": 429},
+            {"json": {"ok": True}},
+        ],
+    )
+
+    assert HttpClient().post(url).json() == {"ok": True}
+    assert requests_mock.call_count == 3
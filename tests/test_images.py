@@ -0,0 +1,94 @@
+import io
+
+from PIL import Image
+from new_digs_automation import automation, stages
+from new_digs_automation.airtable import UpdateQueue, base_url
+from new_digs_automation.images import make_thumbnail, make_variants
+from new_digs_automation.records import as_pets
+
+
+def image_bytes(size, format, mode="RGB"):
+    data = io.BytesIO()
+    Image.new(mode, size).save(data, format=format)
+    data.seek(0)
+    return data
+
+
+def test_make_thumbnail_crops_and_shrinks_jpeg():
+    thumbnail = make_thumbnail(image_bytes((1600, 1200), "JPEG"), "nd_ABC.jpg")
+
+    with Image.open(thumbnail) as img:
+        assert img.format == "JPEG"
+        assert img.size == (400, 400)
+
+
+def test_make_thumbnail_keeps_small_png():
+    thumbnail = make_thumbnail(
+        image_bytes((300, 200), "PNG", mode="RGBA"),
+        "nd_ABC.png",
+    )
+
+    with Image.open(thumbnail) as img:
+        assert img.format == "PNG"
+        assert img.mode == "RGB"
+        assert img.size == (200, 200)
+
+
+def test_make_thumbnail_unreadable_image(caplog):
+    assert make_thumbnail(io.BytesIO(b"not an image"), "nd_ABC.jpg") is None
+    assert "Could not open image nd_ABC.jpg" in caplog.text
+
+
+def test_make_variants_never_upscales():
+    variants = make_variants(
+        image_bytes((1000, 500), "JPEG").getvalue(),
+        "nd_ABC.jpg",
+        widths=[400, 1600],
+    )
+
+    assert [(name, width) for name, _, width in variants] == [
+        ("1000w.webp", 1000),
+        ("400w.webp", 400),
+    ]
+    with Image.open(io.BytesIO(variants[1][1])) as img:
+        assert img.format == "WEBP"
+        assert img.size == (400, 200)
+
+
+def test_update_thumbnails_sends_each_chunk(monkeypatch, requests_mock):
+    saved = {}
+    monkeypatch.setattr(stages, "load_state", lambda name, default=None: saved.get(name, default))
+    monkeypatch.setattr(stages, "save_state", lambda name, data: saved.update({name: data}))
+    monkeypatch.setattr(automation, "thumbnail_chunk_size", 1)
+    uploaded = {}
+
+    def upload_image(fileobj, path, filename):
+        uploaded[filename] = fileobj.read()
+        return "https://cdn.test/" + path + filename
+
+    monkeypatch.setattr(automation, "upload_image", upload_image)
+    requests_mock.get("https://dl.test/a.jpg", content=image_bytes((800, 600), "JPEG").getvalue())
+    requests_mock.get("https://dl.test/b.png", content=b"not an image")
+    patches = []
+
+    def echo(request, context):
+        patches.append(request.json()["records"])
+        return {"records": request.json()["records"]}
+
+    requests_mock.patch(base_url + "/Pets", json=echo)
+    pets = as_pets([
+        {"id": "rec1", "fields": {"Pictures": [{"id": "att1", "filename": "a.jpg", "url": "https://dl.test/a.jpg"}]}},
+        {"id": "rec2", "fields": {"Pictures": [{"id": "att2", "filename": "b.png", "url": "https://dl.test/b.png"}]}},
+    ])
+    pets_by_id = {pet.id: pet for pet in pets}
+    updates = UpdateQueue()
+    updates.add("/Pets", "rec1", {"Adopted Date": "2024-01-02"})
+
+    updated = automation.update_thumbnails(pets_by_id, ["rec1", "rec2"], updates)
+
+    assert updated == ["rec1"]
+    with Image.open(io.BytesIO(uploaded["a.jpg"])) as img:
+        assert img.size == (400, 400)
+    assert patches == [[{"id": "rec1", "fields": {"ThumbnailURL": "https://cdn.test/new-digs-thumbnails/a.jpg"}}]]
+    # the other stages' changes wait for the final flush
+    assert updates.pending["/Pets"] == {"rec1": {"Adopted Date": "2024-01-02"}}
@@ -0,0 +1,80 @@
+import boto3
+import requests
+import requests_mock
+
+from moto import mock_aws
+
+from new_digs_automation.metrics import Metrics, percentile
+
+
+def test_instrumented_session_counts_requests_by_upstream():
+    metrics = Metrics()
+    session = requests.Session()
+    metrics.instrument_session(session)
+
+    with requests_mock.Mocker() as m:
+        m.get("https://api.airtable.com/v0/base/Pets", json={}, headers={"Content-Length": "2"})
+        m.get("https://dl.airtable.com/photo.jpg", status_code=404)
+        session.get("https://api.airtable.com/v0/base/Pets")
+        session.get("https://dl.airtable.com/photo.jpg")
+
+    upstreams = metrics.summary()["upstreams"]
+    assert upstreams["airtable"]["requests"] == 1
+    assert upstreams["airtable"]["bytes"] == 2
+    assert upstreams["airtable"]["errors"] == 0
+    assert upstreams["downloads"]["errors"] == 1
+
+
+def test_stages_and_timings_accumulate():
+    metrics = Metrics()
+    with metrics.stage("update_thumbnails"):
+        pass
+    metrics.record_timings({"image_decode": 0.5})
+    metrics.record_timings({"image_decode": 0.25})
+
+    summary = metrics.summary()
+    assert "update_thumbnails" in summary["stages_seconds"]
+    assert summary["timings"]["image_decode"] == {
+        "count": 2,
+        "seconds": 0.75,
+        "max_seconds": 0.5,
+    }
+
+    documents = metrics.emf_documents()
+    assert documents[0]["Stage"] == "update_thumbnails"
+    assert documents[0]["_aws"]["CloudWatchMetrics"][0]["Namespace"] == "NewDigsAutomation"
+
+
+def test_percentile():
+    assert percentile([], 50) == 0
+    assert percentile(list(range(1, 101)), 90) == 91
+
+
+def test_bytes_count_request_and_unstreamed_response_bodies():
+    metrics = Metrics()
+    session = requests.Session()
+    metrics.instrument_session(session)
+
+    with requests_mock.Mocker() as m:
+        m.patch("https://api.airtable.com/v0/base/Pets", text="0123456789")
+        m.get("https://dl.airtable.com/photo.jpg", content=b"streamed")
+        session.patch("https://api.airtable.com/v0/base/Pets", data=b"12345")
+        session.get("https://dl.airtable.com/photo.jpg", stream=True)
+
+    upstreams = metrics.summary()["upstreams"]
+    assert upstreams["airtable"]["bytes"] == 15
+    # a streamed body without a Content-Length isn't read to be counted
+    assert upstreams["downloads"]["bytes"] == 0
+
+
+def test_instrumented_client_counts_uploaded_bytes(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    metrics = Metrics()
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-2")
+        s3.create_bucket(Bucket="dpa-media", CreateBucketConfiguration={"LocationConstraint": "us-east-2"})
+        metrics.instrument_client(s3, "s3")
+        s3.put_object(Bucket="dpa-media", Key="photo.jpg", Body=b"x" * 1000)
+
+    assert metrics.summary()["upstreams"]["s3"]["bytes"] >= 1000
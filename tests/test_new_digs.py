@@ -3,6 +3,7 @@ from datetime import date
 from new_digs_automation.config import base
 from new_digs_automation.automation import (
     get_available_pets_to_update,
+    plan_status_dates,
     update_available_pets,
 )
 
@@ -161,3 +162,44 @@ def test_request_pet_available_update_wrong_date(requests_mock, caplog):
 
     assert not update_available_pets(input)
     assert "Patch returned the wrong date." in caplog.text
+
+
+def test_plan_status_dates_single_pass(caplog):
+    test_pets = [
+        {
+            "id": "1",
+            "fields": {
+                "Pet Name": "Test Doggo",
+                "Status": "Adopted",
+            },
+        },
+        {
+            "id": "2",
+            "fields": {
+                "Pet Name": "Test Cat",
+                "Made Available for Adoption Date": "some date",
+                "Status": "Removed from Program",
+            },
+        },
+        {
+            "id": "3",
+            "fields": {
+                "Pet Name": "Test Birdie",
+                "Status": "Something Random",
+            },
+        },
+        {
+            "id": "4",
+            "fields": {
+                "Pet Name": "Spot",
+            },
+        },
+    ]
+    pets_to_update, report = plan_status_dates(test_pets)
+    assert pets_to_update == {
+        "Made Available for Adoption Date": ["1"],
+        "Adopted Date": ["1"],
+        "Removed from Program Date": ["2"],
+    }
+    assert report == {"unknown_status": ["3"], "missing_status": ["4"]}
+    assert caplog.text.count("Unknown pet status: Something Random id: 3") == 1
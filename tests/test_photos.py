@@ -0,0 +1,298 @@
+import datetime
+import hashlib
+import io
+import json
+
+import boto3
+import pytest
+
+from moto import mock_aws
+from urllib3.exceptions import ProtocolError
+
+from new_digs_automation import automation, clients, photos, stages, state
+from new_digs_automation.photos import (
+    abort_stale_uploads,
+    get_content_addressed_inventory,
+    get_pets_with_changed_pictures,
+    get_photo_inventory,
+    mirror_photos,
+    mirror_photos_content_addressed,
+)
+from new_digs_automation.records import Pet, as_pet, as_pets
+
+photo_url = "https://dl.airtable.test/"
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-2")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setattr(state, "local_state_dir", str(tmp_path) + "/")
+    monkeypatch.setattr(photos, "photo_inventory", {})
+    clients.aws_clients.clear()
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(
+            Bucket=photos.photo_bucket,
+            CreateBucketConfiguration={"LocationConstraint": "us-east-2"},
+        )
+        yield client
+    clients.aws_clients.clear()
+
+
+def stored_keys(s3):
+    response = s3.list_objects_v2(Bucket=photos.photo_bucket, Prefix=photos.photo_prefix)
+    return sorted(item["Key"] for item in response.get("Contents", []))
+
+
+def photo(pet_id, filename):
+    return {
+        "key": photos.photo_prefix + pet_id + "/" + filename,
+        "url": photo_url + pet_id + "/" + filename,
+        "filename": filename,
+        "pet_id": pet_id,
+        "attachment_id": "att-" + pet_id + "-" + filename,
+    }
+
+
+class DroppedStream(io.RawIOBase):
+    # a download whose connection drops part way through
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        raise ProtocolError("Connection broken")
+
+
+def test_pet_photo_filenames_uses_picture_map():
+    pet = Pet("rec1", {
+        "Pictures": [
+            {"id": "att1", "filename": "my dog.jpg"},
+            {"id": "att2", "filename": "other%20dog.png"},
+        ],
+        "PictureMap-DoNotModify": '{"my dog.jpg": "nd_ABC.jpg"}',
+    })
+
+    assert [filename for _, filename in pet.photo_filenames()] == [
+        "nd_ABC.jpg",
+        "other_dog.png",
+    ]
+
+
+def test_unchanged_pictures_are_skipped():
+    pets = [
+        {"id": "1", "fields": {"Pictures": [{"id": "att1", "filename": "a.jpg"}]}},
+        {"id": "2", "fields": {"Pictures": [{"id": "att2", "filename": "b.jpg"}]}},
+    ]
+    fingerprints = {pet["id"]: as_pet(pet).picture_fingerprint() for pet in pets}
+
+    pets[1]["fields"]["Pictures"].append({"id": "att3", "filename": "c.jpg"})
+
+    assert get_pets_with_changed_pictures(pets, fingerprints) == [pets[1]]
+
+
+def test_mirror_photos_reports_each_photo(s3, requests_mock):
+    requests_mock.get(photo_url + "rec1/a.jpg", content=b"a photo")
+    requests_mock.get(photo_url + "rec1/b.jpg", status_code=404)
+    requests_mock.get(photo_url + "rec2/c.jpg", body=DroppedStream())
+
+    results = mirror_photos([photo("rec1", "a.jpg"), photo("rec1", "b.jpg"), photo("rec2", "c.jpg")])
+
+    assert [(result["key"], result["uploaded"]) for result in results] == [
+        ("new-digs-photos/rec1/a.jpg", True),
+        ("new-digs-photos/rec1/b.jpg", False),
+        ("new-digs-photos/rec2/c.jpg", False),
+    ]
+    assert stored_keys(s3) == ["new-digs-photos/rec1/a.jpg"]
+
+
+def test_abort_stale_uploads(s3, monkeypatch):
+    # moto dates every multipart upload 2010-11-10
+    s3.create_multipart_upload(Bucket=photos.photo_bucket, Key="new-digs-photos/rec1/a.jpg")
+
+    with monkeypatch.context() as m:
+        m.setattr(photos, "stale_upload_age", datetime.timedelta(days=365 * 100))
+        abort_stale_uploads()
+    uploads = s3.list_multipart_uploads(Bucket=photos.photo_bucket).get("Uploads", [])
+    assert len(uploads) == 1
+
+    abort_stale_uploads()
+    assert s3.list_multipart_uploads(Bucket=photos.photo_bucket).get("Uploads", []) == []
+
+
+def test_upload_photos_resumes_where_the_backlog_stopped(s3, requests_mock, monkeypatch):
+    monkeypatch.setattr(automation, "upload_chunk_size", 1)
+    # time for one chunk, then none
+    left = iter([100, 0])
+    monkeypatch.setattr(stages, "remaining_seconds", lambda deadline: next(left, None) if deadline else None)
+    requests_mock.get(photo_url + "rec1/a.jpg", content=b"a photo")
+    requests_mock.get(photo_url + "rec2/b.jpg", content=b"b photo")
+    pets = as_pets([
+        {"id": pet_id, "fields": {
+            "Status": "Published - Available for Adoption",
+            "Pictures": [{"id": "att" + pet_id, "filename": filename, "url": photo_url + pet_id + "/" + filename}],
+        }}
+        for pet_id, filename in [("rec1", "a.jpg"), ("rec2", "b.jpg")]
+    ])
+
+    results = automation.upload_photos({}, pets, deadline=1)
+
+    assert [(result["pet_id"], result["uploaded"]) for result in results] == [
+        ("rec1", True),
+        ("rec2", False),
+    ]
+    assert state.load_state("checkpoint-photo-uploads")["remaining"] == ["rec2"]
+
+    results = automation.upload_photos({"rec1": {"a.jpg"}}, pets)
+
+    assert [(result["pet_id"], result["uploaded"]) for result in results] == [("rec2", True)]
+    assert stored_keys(s3) == ["new-digs-photos/rec1/a.jpg", "new-digs-photos/rec2/b.jpg"]
+    assert state.load_state("checkpoint-photo-uploads")["remaining"] == []
+
+
+def digest_key(content, extension=".jpg"):
+    return photos.photo_prefix + "sha256/" + hashlib.sha256(content).hexdigest() + extension
+
+
+def test_content_addressed_photos_are_stored_once(s3, requests_mock, monkeypatch):
+    uploads = []
+    client = photos.get_s3()
+    upload_fileobj = client.upload_fileobj
+
+    def counted_upload(fileobj, bucket, key, **kwargs):
+        uploads.append(key)
+        return upload_fileobj(fileobj, bucket, key, **kwargs)
+
+    monkeypatch.setattr(client, "upload_fileobj", counted_upload)
+    requests_mock.get(photo_url + "rec1/a.jpg", content=b"same photo")
+    requests_mock.get(photo_url + "rec2/b.jpg", content=b"same photo")
+
+    results = mirror_photos_content_addressed([photo("rec1", "a.jpg"), photo("rec2", "b.jpg")])
+
+    key = digest_key(b"same photo")
+    assert [(result["key"], result["uploaded"]) for result in results] == [(key, True), (key, True)]
+    assert uploads == [key]
+    assert stored_keys(s3) == [
+        "new-digs-photos/rec1/manifest.json",
+        "new-digs-photos/rec2/manifest.json",
+        key,
+    ]
+
+
+def test_content_addressed_manifests(s3, requests_mock):
+    requests_mock.get(photo_url + "rec1/a.jpg", content=b"photo a")
+    requests_mock.get(photo_url + "rec1/b.png", content=b"photo b")
+
+    mirror_photos_content_addressed([photo("rec1", "a.jpg"), photo("rec1", "b.png")])
+
+    key_a, key_b = digest_key(b"photo a"), digest_key(b"photo b", ".png")
+    assert state.load_state(photos.photo_manifest_name) == {
+        "photos": {"rec1/a.jpg": key_a, "rec1/b.png": key_b},
+        "attachments": {"att-rec1-a.jpg": key_a, "att-rec1-b.png": key_b},
+    }
+    pet_manifest = s3.get_object(Bucket=photos.photo_bucket, Key="new-digs-photos/rec1/manifest.json")
+    assert json.loads(pet_manifest["Body"].read()) == {
+        "a.jpg": photos.photo_base_url + key_a,
+        "b.png": photos.photo_base_url + key_b,
+    }
+    assert get_content_addressed_inventory() == {"rec1": {"a.jpg", "b.png"}}
+
+
+def test_reattached_attachment_is_not_downloaded_again(s3, requests_mock):
+    requests_mock.get(photo_url + "rec1/a.jpg", content=b"photo a")
+    mirror_photos_content_addressed([photo("rec1", "a.jpg")])
+    requests_mock.reset_mock()
+
+    # the same attachment, added to another pet under a new name
+    moved = dict(photo("rec2", "nd_A.jpg"), attachment_id="att-rec1-a.jpg")
+    [result] = mirror_photos_content_addressed([moved])
+
+    assert result == {
+        "key": digest_key(b"photo a"),
+        "pet_id": "rec2",
+        "filename": "nd_A.jpg",
+        "uploaded": True,
+    }
+    assert requests_mock.call_count == 0
+    pet_manifest = s3.get_object(Bucket=photos.photo_bucket, Key="new-digs-photos/rec2/manifest.json")
+    assert json.loads(pet_manifest["Body"].read()) == {
+        "nd_A.jpg": photos.photo_base_url + digest_key(b"photo a"),
+    }
+
+
+def test_removed_photos_are_dropped_from_the_manifest(s3, requests_mock, monkeypatch):
+    monkeypatch.setattr(automation, "content_addressed_photos", True)
+    requests_mock.get(photo_url + "rec1/a.jpg", content=b"photo a")
+    requests_mock.get(photo_url + "rec1/b.png", content=b"photo b")
+    mirror_photos_content_addressed([photo("rec1", "a.jpg"), photo("rec1", "b.png")])
+    requests_mock.reset_mock()
+
+    # b.png was taken off the pet
+    pets = as_pets([{"id": "rec1", "fields": {"Pictures": [
+        {"id": "att-rec1-a.jpg", "filename": "a.jpg", "url": photo_url + "rec1/a.jpg"},
+    ]}}])
+    assert automation.mirror_changed_photos(pets) == []
+
+    assert requests_mock.call_count == 0
+    assert state.load_state(photos.photo_manifest_name)["photos"] == {"rec1/a.jpg": digest_key(b"photo a")}
+    pet_manifest = s3.get_object(Bucket=photos.photo_bucket, Key="new-digs-photos/rec1/manifest.json")
+    assert json.loads(pet_manifest["Body"].read()) == {
+        "a.jpg": photos.photo_base_url + digest_key(b"photo a"),
+    }
+
+
+def put_photo(s3, pet_id, filename):
+    s3.put_object(Bucket=photos.photo_bucket, Key=photos.photo_prefix + pet_id + "/" + filename, Body=b"x")
+
+
+def watch_listings(monkeypatch):
+    prefixes = []
+    list_photo_prefix = photos.list_photo_prefix
+
+    def listed(prefix, *args):
+        prefixes.append(prefix)
+        return list_photo_prefix(prefix, *args)
+
+    monkeypatch.setattr(photos, "list_photo_prefix", listed)
+    return prefixes
+
+
+def test_inventory_lists_each_pet_and_reuses_the_cache(s3, monkeypatch):
+    prefixes = watch_listings(monkeypatch)
+    put_photo(s3, "rec1", "a.jpg")
+
+    # a pet missing from the listing has nothing uploaded
+    assert get_photo_inventory(["rec1", "rec2"]) == {"rec1": {"a.jpg"}, "rec2": set()}
+    assert sorted(prefixes) == ["new-digs-photos/rec1/", "new-digs-photos/rec2/"]
+
+    put_photo(s3, "rec2", "b.jpg")
+    assert get_photo_inventory(["rec1", "rec2"]) == {"rec1": {"a.jpg"}, "rec2": set()}
+    assert len(prefixes) == 2
+
+    # once the cached listings are old enough they're listed again
+    monkeypatch.setattr(photos, "inventory_ttl", datetime.timedelta(0))
+    assert get_photo_inventory(["rec1", "rec2"]) == {"rec1": {"a.jpg"}, "rec2": {"b.jpg"}}
+    assert len(prefixes) == 4
+
+
+def test_inventory_lists_everything_past_max_prefix_listings(s3, monkeypatch):
+    prefixes = watch_listings(monkeypatch)
+    monkeypatch.setattr(photos, "max_prefix_listings", 1)
+    put_photo(s3, "rec1", "a.jpg")
+    put_photo(s3, "rec3", "c.jpg")
+    # a cached pet whose photos have all gone since
+    photos.photo_inventory["rec4"] = {
+        "keys": {"d.jpg"},
+        "listed": datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1),
+    }
+
+    assert get_photo_inventory(["rec1", "rec2"]) == {"rec1": {"a.jpg"}, "rec2": set()}
+    assert prefixes == ["new-digs-photos/"]
+    assert get_photo_inventory() == {
+        "rec1": {"a.jpg"},
+        "rec2": set(),
+        "rec3": {"c.jpg"},
+        "rec4": set(),
+    }
+    assert prefixes == ["new-digs-photos/", "new-digs-photos/"]
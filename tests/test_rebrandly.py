@@ -0,0 +1,67 @@
+from new_digs_automation import rebrandly
+from new_digs_automation.rebrandly import delete_links, links_url, list_links, shorten_links
+
+
+def test_shorten_links_reuses_cached_links(requests_mock, monkeypatch):
+    saved = {}
+    monkeypatch.setattr(
+        rebrandly, "load_state", lambda name, default: saved.get(name, default)
+    )
+    monkeypatch.setattr(
+        rebrandly, "save_state", lambda name, data: saved.update({name: data})
+    )
+    requests_mock.post(
+        links_url,
+        json={
+            "id": "link1",
+            "destination": "https://form.jotform.com/1?petId=1",
+            "shortUrl": "rebrand.ly/abc",
+        },
+    )
+
+    destinations = [
+        "https://form.jotform.com/1?petId=1",
+        "https://form.jotform.com/1?petId=1",
+    ]
+    first = shorten_links(destinations)
+    second = shorten_links(destinations[:1])
+
+    assert first == {"https://form.jotform.com/1?petId=1": "rebrand.ly/abc"}
+    assert second == first
+    assert requests_mock.call_count == 1
+
+
+def test_shorten_links_failure(requests_mock, monkeypatch):
+    monkeypatch.setattr(rebrandly, "load_state", lambda name, default: default)
+    requests_mock.post(links_url, status_code=403)
+
+    assert shorten_links(["https://form.jotform.com/1"]) == {
+        "https://form.jotform.com/1": None
+    }
+
+
+def test_list_links_stops_on_error(requests_mock):
+    requests_mock.get(
+        links_url,
+        [
+            {"json": [{"id": f"link{i}"} for i in range(rebrandly.page_size)]},
+            {"status_code": 403},
+        ],
+    )
+
+    links = list_links()
+
+    assert len(links) == rebrandly.page_size
+    assert requests_mock.last_request.qs["last"] == [f"link{rebrandly.page_size - 1}"]
+    assert requests_mock.call_count == 2
+
+
+def test_delete_links_forgets_only_deleted(requests_mock, monkeypatch):
+    forgotten = []
+    monkeypatch.setattr(rebrandly, "forget_links", forgotten.extend)
+    requests_mock.delete(links_url, [{"json": {}}, {"status_code": 403}])
+
+    link_ids = [f"link{i}" for i in range(rebrandly.page_size + 1)]
+
+    assert delete_links(link_ids) == link_ids[:rebrandly.page_size]
+    assert forgotten == link_ids[:rebrandly.page_size]
@@ -0,0 +1,53 @@
+from new_digs_automation.records import Applicant, Pet, PetStatus, as_pet
+
+
+def test_pet_parses_fields():
+    pet = Pet("rec1", {
+        "Pet Name": "Rex",
+        "Pet ID - do not edit": 7,
+        "Pet Species": "Dog",
+        "Status": "Adoption Pending",
+        "Original Owner": ["own1"],
+        "Pictures": [
+            {
+                "id": "att1",
+                "url": "https://dl.test/1.jpg",
+                "filename": "my dog.jpg",
+                "thumbnails": {"large": {"url": "https://dl.test/1-large.jpg"}},
+            },
+        ],
+        "PictureMap-DoNotModify": '{"my dog.jpg": "nd_ABC.jpg"}',
+    })
+
+    assert pet.status is PetStatus.PENDING
+    assert pet.is_dog
+    assert pet.owner_id == "own1"
+    assert pet.attachments[0].hash_url == "https://dl.test/1-large.jpg"
+    assert [filename for _, filename in pet.photo_filenames()] == ["nd_ABC.jpg"]
+    assert pet.dates["Adopted Date"] is None
+
+
+def test_pet_with_unknown_status():
+    pet = Pet("rec1", {"Status": "Bogus"})
+
+    assert pet.status is None
+    assert pet.status_name == "Bogus"
+    assert pet.attachments == ()
+    assert pet.picture_map == {}
+
+
+def test_set_picture_map_changes_fingerprint():
+    pet = as_pet({"id": "rec1", "fields": {"Pictures": [{"id": "att1", "filename": "a.jpg"}]}})
+    fingerprint = pet.picture_fingerprint()
+
+    assert pet.set_picture_map({"a.jpg": "nd_A.jpg"}) == '{"a.jpg": "nd_A.jpg"}'
+    assert pet.picture_map == {"a.jpg": "nd_A.jpg"}
+    assert pet.picture_fingerprint() != fingerprint
+    assert as_pet(pet) is pet
+
+
+def test_applicant_without_pet():
+    applicant = Applicant.from_record({"id": "app1", "fields": {"Name": "Jo Smith"}})
+
+    assert applicant.pet_id is None
+    assert applicant.contract_link is None
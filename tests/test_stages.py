@@ -0,0 +1,154 @@
+import threading
+import time
+
+import pytest
+
+from new_digs_automation import stages as stages_module
+from new_digs_automation.stages import Stage, process_backlog, run_stages
+
+
+def test_stages_run_in_dependency_order():
+    order = []
+
+    def step(name, value=None):
+        order.append(name)
+        return name
+
+    stages = [
+        Stage("flush", lambda a, b: step("flush"), inputs=("a", "b"), outputs=("done",)),
+        Stage("a", lambda: step("a"), outputs=("a",)),
+        Stage("b", lambda a: step("b"), inputs=("a",), outputs=("b",)),
+    ]
+    values, timed_out, failed = run_stages(stages)
+
+    assert order == ["a", "b", "flush"]
+    assert values["done"] == "flush"
+    assert timed_out == []
+    assert failed == []
+
+
+def test_independent_stages_run_concurrently():
+    # every stage has to be running at once to get past the barrier, however
+    # many are ready together
+    barrier = threading.Barrier(6, timeout=5)
+    stages = [
+        Stage(f"stage{i}", barrier.wait, outputs=(f"stage{i}",))
+        for i in range(6)
+    ]
+    values, timed_out, failed = run_stages(stages)
+
+    assert sorted(values[f"stage{i}"] for i in range(6)) == list(range(6))
+    assert timed_out == failed == []
+
+
+def test_stage_out_of_time_gets_defaults():
+    release = threading.Event()
+    slow_finished = threading.Event()
+
+    def slow():
+        release.wait(5)
+        slow_finished.set()
+        return ["late"]
+
+    def after(slow):
+        release.set()
+        return len(slow)
+
+    stages = [
+        Stage(
+            "slow",
+            slow,
+            outputs=("slow",),
+            reserve=4.9,
+            defaults={"slow": []},
+        ),
+        Stage("after", after, inputs=("slow",), outputs=("after",)),
+    ]
+    values, timed_out, _ = run_stages(stages, deadline=time.monotonic() + 5)
+
+    assert timed_out == ["slow"]
+    assert values["slow"] == []
+    assert values["after"] == 0
+    # the late stage was waited on rather than left running
+    assert slow_finished.is_set()
+
+
+def test_failed_stage_gets_defaults():
+    def broken():
+        raise ConnectionError("upstream is down")
+
+    stages = [
+        Stage("broken", broken, outputs=("broken",), defaults={"broken": 0}),
+        Stage("queue", lambda: "queued", outputs=("queue",)),
+        Stage(
+            "flush",
+            lambda broken, queue: (broken, queue),
+            inputs=("broken", "queue"),
+            outputs=("flushed",),
+        ),
+    ]
+    values, timed_out, failed = run_stages(stages)
+
+    assert failed == ["broken"]
+    assert timed_out == []
+    assert values["flushed"] == (0, "queued")
+
+
+def test_stage_loops_are_rejected():
+    stages = [
+        Stage("a", lambda b: b, inputs=("b",), outputs=("a",)),
+        Stage("b", lambda a: a, inputs=("a",), outputs=("b",)),
+    ]
+    with pytest.raises(ValueError):
+        run_stages(stages)
+
+
+def fake_state(monkeypatch, saved):
+    monkeypatch.setattr(stages_module, "load_state", lambda name, default=None: saved.get(name, default))
+    monkeypatch.setattr(stages_module, "save_state", lambda name, data: saved.update({name: data}))
+
+
+def test_backlog_goes_by_priority_then_checkpoint(monkeypatch):
+    saved = {"checkpoint-test": {"remaining": ["c"], "chunk_seconds": 0}}
+    fake_state(monkeypatch, saved)
+    chunks = []
+
+    def process(chunk):
+        chunks.append(chunk)
+        return chunk
+
+    items = [("a", 1), ("b", 0), ("c", 1), ("d", 1)]
+    results, remaining = process_backlog(
+        "test",
+        items,
+        process,
+        key=lambda item: item[0],
+        priority=lambda item: item[1],
+        chunk_size=2,
+    )
+
+    assert chunks == [[("b", 0), ("c", 1)], [("a", 1), ("d", 1)]]
+    assert remaining == []
+    assert saved["checkpoint-test"]["remaining"] == []
+
+
+def test_backlog_stops_before_deadline_and_checkpoints(monkeypatch):
+    saved = {}
+    fake_state(monkeypatch, saved)
+
+    def process(chunk):
+        time.sleep(0.05)
+        return chunk
+
+    results, remaining = process_backlog(
+        "test",
+        list(range(10)),
+        process,
+        key=lambda item: item,
+        deadline=time.monotonic() + 0.1,
+        chunk_size=2,
+    )
+
+    assert 0 < len(results) < 10
+    assert results + remaining == list(range(10))
+    assert saved["checkpoint-test"]["remaining"] == remaining
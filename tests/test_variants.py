@@ -0,0 +1,75 @@
+from new_digs_automation import stages, variants
+from new_digs_automation.airtable import UpdateQueue
+from new_digs_automation.records import as_pet
+from new_digs_automation.variants import update_variants, variant_manifest_url
+
+
+def pet(pet_id, *filenames):
+    return as_pet({"id": pet_id, "fields": {
+        "Pictures": [
+            {"id": f"att-{filename}", "filename": filename, "url": f"https://dl.test/{filename}"}
+            for filename in filenames
+        ],
+    }})
+
+
+def test_variants_backlog_saves_each_chunk_and_resumes(monkeypatch):
+    saved = {}
+    for module in (variants, stages):
+        monkeypatch.setattr(module, "load_state", lambda name, default=None: saved.get(name, default))
+        monkeypatch.setattr(module, "save_state", lambda name, data: saved.update({name: data}))
+    monkeypatch.setattr(variants, "variant_chunk_size", 1)
+    monkeypatch.setattr(variants, "write_variant_manifest", lambda pet_id, manifest: True)
+    monkeypatch.setattr(variants, "image_worker_pool", lambda: variants.ThreadPoolExecutor(1))
+
+    made = []
+
+    def make_variants_for(jobs, io_pool, image_pool, avif):
+        for pet_id, url, filename in jobs:
+            made.append(filename)
+            yield pet_id, filename, [{"width": 320, "url": url}]
+
+    monkeypatch.setattr(variants, "make_variants_for", make_variants_for)
+    # time for one chunk, then none
+    left = iter([100, 0])
+    monkeypatch.setattr(stages, "remaining_seconds", lambda deadline: next(left, None) if deadline else None)
+    pets_by_id = {"rec1": pet("rec1", "a.jpg"), "rec2": pet("rec2", "b.jpg")}
+
+    updates = UpdateQueue()
+    assert update_variants(pets_by_id, updates, deadline=1) == 1
+    assert made == ["a.jpg"]
+    assert list(saved["variant-manifests"]) == ["rec1"]
+    assert saved["checkpoint-variants"]["remaining"] == ["rec2/b.jpg"]
+    assert updates.pending["/Pets"] == {"rec1": {"VariantsManifestURL": variant_manifest_url("rec1")}}
+
+    pets_by_id["rec1"].variants_manifest_url = variant_manifest_url("rec1")
+    assert update_variants(pets_by_id, UpdateQueue()) == 1
+    assert made == ["a.jpg", "b.jpg"]
+    assert sorted(saved["variant-manifests"]) == ["rec1", "rec2"]
+
+
+def test_failed_variants_wait_for_the_pictures_to_change(monkeypatch, requests_mock):
+    saved = {}
+    for module in (variants, stages):
+        monkeypatch.setattr(module, "load_state", lambda name, default=None: saved.get(name, default))
+        monkeypatch.setattr(module, "save_state", lambda name, data: saved.update({name: data}))
+    monkeypatch.setattr(variants, "write_variant_manifest", lambda pet_id, manifest: True)
+    monkeypatch.setattr(variants, "image_worker_pool", lambda: variants.ThreadPoolExecutor(1))
+    requests_mock.get("https://dl.test/a.jpg", content=b"not a picture")
+    pets_by_id = {"rec1": pet("rec1", "a.jpg")}
+
+    assert update_variants(pets_by_id, UpdateQueue()) == 0
+    assert saved["variant-failures"] == {
+        "rec1": {"fingerprint": pets_by_id["rec1"].picture_fingerprint(), "filenames": ["a.jpg"]},
+    }
+    assert requests_mock.call_count == 1
+
+    assert update_variants(pets_by_id, UpdateQueue()) == 0
+    assert requests_mock.call_count == 1
+
+    # a new picture changes the fingerprint, so everything is tried again
+    pets_by_id = {"rec1": pet("rec1", "a.jpg", "b.jpg")}
+    requests_mock.get("https://dl.test/b.jpg", status_code=404)
+    update_variants(pets_by_id, UpdateQueue())
+    assert requests_mock.call_count == 3
+    assert sorted(saved["variant-failures"]["rec1"]["filenames"]) == ["a.jpg", "b.jpg"]